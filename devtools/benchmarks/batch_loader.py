@@ -0,0 +1,65 @@
+"""
+Epoch time of EnergyNetwork training data loading with torch's DataLoader
+over network.Dataset (collates every batch sample by sample) and with
+BatchLoader (slices batches from one tensor per species), for different batch
+sizes. With --train every batch also goes through a forward and backward pass
+of an EnergyNetwork, as in train_net.
+
+Usage: python batch_loader.py [--samples 20000] [--species OHH] [--features 30] [--prefetch 0] [--train]
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from neuralxc.ml.network import BatchLoader, Dataset, EnergyNetwork
+
+BATCH_SIZES = [32, 128, 512, 2048, 0]
+
+
+def epoch_time(loader, net, optimizer, epochs):
+    loss_fn = torch.nn.MSELoss()
+    best = np.inf
+    for _ in range(epochs):
+        start = time.perf_counter()
+        for rho, energy in loader:
+            if net is not None:
+                loss = loss_fn(net(rho), energy)
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--samples', type=int, default=20000)
+    parser.add_argument('--species', default='OHH')
+    parser.add_argument('--features', type=int, default=30, help='Features per atom')
+    parser.add_argument('--prefetch', type=int, default=0, help='Batches prepared ahead by BatchLoader')
+    parser.add_argument('--train', action='store_true', help='Include forward and backward pass')
+    parser.add_argument('--epochs', type=int, default=3)
+    args = parser.parse_args()
+
+    np.random.seed(0)
+    torch.manual_seed(0)
+    rho = {spec: np.random.rand(args.samples, args.species.count(spec), args.features) for spec in set(args.species)}
+    energies = np.random.rand(args.samples)
+
+    net, optimizer = None, None
+    if args.train:
+        net = EnergyNetwork(n_nodes=8, n_layers=2, activation='GELU')
+        net.build_species_nets(rho)
+        optimizer = torch.optim.Adam(net.parameters())
+
+    print('{:>8} {:>16} {:>17} {:>8}'.format('batch', 'DataLoader [ms]', 'BatchLoader [ms]', 'speedup'))
+    for batch_size in BATCH_SIZES:
+        dataset = Dataset(rho, energies)
+        data_loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size or len(dataset), shuffle=True)
+        batch_loader = BatchLoader(rho, energies, batch_size=batch_size, shuffle=True, prefetch=args.prefetch)
+        t_old = epoch_time(data_loader, net, optimizer, args.epochs)
+        t_new = epoch_time(batch_loader, net, optimizer, args.epochs)
+        print('{:>8} {:>16.1f} {:>17.1f} {:>8.1f}'.format(batch_size or args.samples, t_old * 1e3, t_new * 1e3,
+                                                         t_old / t_new))
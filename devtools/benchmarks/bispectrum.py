@@ -0,0 +1,74 @@
+"""
+Time of the bispectrum symmetrizer (precomputed coupling coefficients, one
+matrix multiplication per pair of angular momenta) compared to a loop over
+radial channels and (l1, l2, l) triples in Python and to the trace
+symmetrizer, whose output it extends. Combinations whose descriptors exceed
+--max_mb are skipped.
+
+Usage: python bispectrum.py [--n 2 4 8] [--l 2 4 6] [--atoms 1 100 10000] [--grad]
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from neuralxc.symmetrizer.symmetrizer import (BispectrumSymmetrizer, TraceSymmetrizer, bispectrum_triples,
+                                              real_coupling)
+
+
+def reference_bispectrum(c, n_l, n, *args):
+    c_shape = c.size()
+    c = c.reshape(-1, n, n_l**2)
+    invariants = [c[..., l**2:(l + 1)**2].pow(2).sum(-1) for l in range(n_l)]
+    invariants = [torch.stack(invariants, -1).reshape(len(c), -1)]
+    for n_ in range(n):
+        for l1, l2, l in bispectrum_triples(n_l):
+            coupling = torch.from_numpy(real_coupling(l1, l2, l)).to(c.dtype)
+            invariants.append(
+                torch.einsum('abc,ia,ib,ic->i', coupling, c[:, n_, l1**2:(l1 + 1)**2], c[:, n_, l2**2:(l2 + 1)**2],
+                             c[:, n_, l**2:(l + 1)**2]).unsqueeze(-1))
+    invariants = torch.cat(invariants, -1)
+    # Same column order as BispectrumSymmetrizer: traces, then bispectrum of every radial channel
+    n_triples = len(bispectrum_triples(n_l))
+    return invariants.view(*c_shape[:-1], n * n_l + n * n_triples)
+
+
+def timed(func, c, n_l, n, grad, repeat):
+    best = np.inf
+    for _ in range(repeat):
+        c_ = c.detach().requires_grad_(grad)
+        start = time.perf_counter()
+        result = func(c_, n_l, n)
+        if grad:
+            result.sum().backward()
+        best = min(best, time.perf_counter() - start)
+    return result.detach(), best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n', type=int, nargs='+', default=[2, 4, 8], help='Radial basis functions')
+    parser.add_argument('--l', type=int, nargs='+', default=[2, 4, 6], help='Angular momenta')
+    parser.add_argument('--atoms', type=int, nargs='+', default=[1, 100, 10000])
+    parser.add_argument('--grad', action='store_true', help='Include backward pass')
+    parser.add_argument('--max_mb', type=float, default=100, help='Skip larger descriptor arrays')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    print('{:>3} {:>3} {:>8} {:>10} {:>12} {:>10} {:>15} {:>8}'.format('n', 'l', 'atoms', 'trace [ms]', 'loop [ms]',
+                                                                      'bisp. [ms]', 'speedup (loop)', 'x trace'))
+    for n in args.n:
+        for n_l in args.l:
+            for atoms in args.atoms:
+                if atoms * n * n_l**2 * 8 / 1e6 > args.max_mb:
+                    continue
+                c = torch.rand(atoms, n * n_l**2, dtype=torch.float64)
+                BispectrumSymmetrizer._symmetrize_function(c[:1], n_l, n)  # Coupling coefficients are cached
+                _, t_trace = timed(TraceSymmetrizer._symmetrize_function, c, n_l, n, args.grad, args.repeat)
+                D_ref, t_ref = timed(reference_bispectrum, c, n_l, n, args.grad, args.repeat)
+                D, t_new = timed(BispectrumSymmetrizer._symmetrize_function, c, n_l, n, args.grad, args.repeat)
+                assert torch.allclose(D_ref, D)
+                print('{:>3} {:>3} {:>8} {:>10.3f} {:>12.3f} {:>10.3f} {:>15.1f} {:>8.1f}'.format(
+                    n, n_l, atoms, t_trace * 1e3, t_ref * 1e3, t_new * 1e3, t_ref / t_new, t_new / t_trace))
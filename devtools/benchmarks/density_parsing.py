@@ -0,0 +1,106 @@
+"""
+Throughput (MB/s) of the formatted SIESTA RHO and cube readers on synthetic
+files of increasing size, compared to the legacy per-line (RHO) and pandas
+(cube) parsers. Legacy parsers are skipped above --legacy_max grid points.
+
+Usage: python density_parsing.py [--grids 20 50 100 150] [--legacy_max 100]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from neuralxc.utils.density_getter import CubeDensityGetter, SiestaDensityGetter
+
+
+def write_rho(path, rho, unitcell):
+    with open(path, 'w') as rhofile:
+        for vec in unitcell:
+            rhofile.write('{:16.8f}{:16.8f}{:16.8f}\n'.format(*vec))
+        rhofile.write('{} {} {} 1\n'.format(*rho.shape))
+        np.savetxt(rhofile, rho.transpose(2, 1, 0).reshape(-1, 1), fmt='%.10e')
+
+
+def write_cube(path, rho, unitcell):
+    grid = rho.shape
+    with open(path, 'w') as cubefile:
+        cubefile.write('synthetic density\nbenchmark\n')
+        cubefile.write('    3    0.000000    0.000000    0.000000\n')
+        for g, vec in zip(grid, unitcell):
+            cubefile.write('{:5d}{:12.6f}{:12.6f}{:12.6f}\n'.format(g, *(vec / g)))
+        cubefile.write('    8    0.000000    0.000000    0.000000    0.000000\n' * 3)
+        rows = rho.reshape(-1, grid[2])
+        full = grid[2] // 6 * 6
+        for row in rows:
+            lines = [' '.join(['{:13.5e}'] * 6).format(*row[i:i + 6]) for i in range(0, full, 6)]
+            if full < grid[2]:
+                lines.append(' '.join(['{:13.5e}'] * (grid[2] - full)).format(*row[full:]))
+            cubefile.write('\n'.join(lines) + '\n')
+
+
+def legacy_rho(path):
+    unitcell = np.zeros([3, 3])
+    grid = np.zeros([4])
+    with open(path, 'r') as rhofile:
+        for i in range(0, 3):
+            unitcell[i, :] = rhofile.readline().split()
+        grid[:] = rhofile.readline().split()
+        grid = grid.astype(int)
+        rho = np.zeros(grid)
+        for z in range(grid[2]):
+            for y in range(grid[1]):
+                for x in range(grid[0]):
+                    rho[x, y, z, 0] = rhofile.readline()
+    return rho[:, :, :, 0]
+
+
+def legacy_cube(path):
+    rho = pd.read_csv(path, sep=r'\s+', skiprows=9, header=None)
+    mask = (~rho.isna()).values.flatten()
+    rho = rho.values.flatten()[mask]
+    grid = pd.read_csv(path, sep=r'\s+', skiprows=3, header=None, nrows=3).values[:, 0].astype(int)
+    return rho.reshape(*grid)
+
+
+def timed(func, path):
+    start = time.perf_counter()
+    rho = func(path)
+    return rho, time.perf_counter() - start
+
+
+def benchmark(n_grid, legacy_max, tmpdir):
+    rho_ref = np.random.rand(n_grid, n_grid, n_grid)
+    unitcell = np.eye(3) * 10
+    results = []
+    for fmt, write, read, legacy, tol in [
+        ('RHO', write_rho, lambda p: SiestaDensityGetter.get_density_formatted(p)[0], legacy_rho, 1e-9),
+        ('cube', write_cube, lambda p: CubeDensityGetter().get_density(p)[0], legacy_cube, 1e-4)
+    ]:
+        path = os.path.join(tmpdir, 'density.' + fmt)
+        write(path, rho_ref, unitcell)
+        size = os.path.getsize(path) / 1e6
+        rho, t_read = timed(read, path)
+        assert np.allclose(rho, rho_ref, atol=tol)
+        t_legacy = np.nan
+        if n_grid <= legacy_max:
+            rho_legacy, t_legacy = timed(legacy, path)
+            assert np.allclose(rho_legacy, rho)
+        results.append((fmt, size, size / t_read, size / t_legacy))
+        os.remove(path)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--grids', type=int, nargs='+', default=[20, 50, 100, 150])
+    parser.add_argument('--legacy_max', type=int, default=100)
+    args = parser.parse_args()
+
+    print('{:>6} {:>6} {:>10} {:>14} {:>14}'.format('grid', 'format', 'size [MB]', 'bulk [MB/s]', 'legacy [MB/s]'))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for n_grid in args.grids:
+            for fmt, size, mbs, mbs_legacy in benchmark(n_grid, args.legacy_max, tmpdir):
+                print('{:>6} {:>6} {:>10.1f} {:>14.1f} {:>14.1f}'.format(n_grid, fmt, size, mbs, mbs_legacy))
@@ -0,0 +1,58 @@
+"""
+Per-call latency of symmetrizer -> GroupedVarianceThreshold ->
+GroupedStandardScaler over many consecutive calls with numpy and torch input,
+as happens over a long SCF or training run. numpy/torch dispatch is set up
+once per class, latency should stay constant (earlier versions wrapped the
+transform functions again on every call).
+
+Usage: python dispatch_overhead.py [--calls 100000] [--windows 10]
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from neuralxc.ml.transformer import GroupedStandardScaler, GroupedVarianceThreshold
+from neuralxc.symmetrizer import Symmetrizer
+
+BASIS = {'O': {'n': 2, 'l': 3, 'r_o': 1}, 'H': {'n': 2, 'l': 2, 'r_o': 1}}
+
+
+def call_latencies(steps, C, calls):
+    times = np.zeros(calls)
+    for i in range(calls):
+        start = time.perf_counter()
+        X = C
+        for step in steps:
+            X = step.transform(X)
+        times[i] = time.perf_counter() - start
+    return times
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=100000)
+    parser.add_argument('--windows', type=int, default=10, help='Report median latency for this many windows')
+    args = parser.parse_args()
+
+    np.random.seed(0)
+    C_fit = [{spec: np.random.rand(100, 1 if spec == 'O' else 2, b['n'] * b['l']**2) for spec, b in BASIS.items()}]
+    symmetrizer = Symmetrizer({'symmetrizer_type': 'trace', 'basis': BASIS})
+    steps = [symmetrizer, GroupedVarianceThreshold(threshold=1e-10), GroupedStandardScaler()]
+    X = symmetrizer.transform(C_fit)
+    for step in steps[1:]:
+        X = step.fit(X).transform(X)
+
+    C = {'numpy': [{spec: c[:1] for spec, c in C_fit[0].items()}]}
+    C['torch'] = [{spec: torch.from_numpy(c) for spec, c in C['numpy'][0].items()}]
+
+    window = args.calls // args.windows
+    print('{:>8} {:>12} {:>12}'.format('calls', 'numpy [us]', 'torch [us]'))
+    latencies = {kind: call_latencies(steps, C[kind], args.calls) for kind in C}
+    for start in range(0, window * args.windows, window):
+        medians = [np.median(latencies[kind][start:start + window]) * 1e6 for kind in C]
+        print('{:>8} {:>12.1f} {:>12.1f}'.format(start + window, *medians))
+    for kind in C:
+        ratio = np.median(latencies[kind][-window:]) / np.median(latencies[kind][:window])
+        print('{}: last/first window {:.2f}'.format(kind, ratio))
@@ -0,0 +1,109 @@
+"""
+File size and read throughput of descriptor datasets stored with different
+storage options (see datastructures.hdf5.storage_options) for the access
+patterns of load_sets: reading the full set, iterating over mini-batches of
+shuffled rows (lazy loading) and reading single systems. Throughput is given
+in MB/s of float64 descriptors returned. Descriptors are synthetic: two kinds
+of systems with different numbers of descriptors, the shorter ones are zero
+padded as in files written by neuralxc pre.
+
+Usage: python hdf5_storage.py [--systems 20000] [--width 600] [--batch_size 1000]
+"""
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+import time
+
+import h5py
+import numpy as np
+
+from neuralxc.datastructures.hdf5 import add_data, hdf5plugin
+from neuralxc.ml.utils import load_sets
+
+STORAGE = {
+    'default': {},
+    'chunked': {
+        'dtype': 'float64'
+    },
+    'lzf': {
+        'compression': 'lzf'
+    },
+    'gzip': {
+        'compression': 'gzip',
+        'compression_opts': 4
+    },
+    'float32': {
+        'dtype': 'float32',
+        'chunk_rows': 0
+    },
+    'float32+chunked': {
+        'dtype': 'float32'
+    },
+    'float32+lzf': {
+        'dtype': 'float32',
+        'compression': 'lzf'
+    },
+}
+if hdf5plugin is not None:
+    STORAGE['blosc'] = {'compression': 'blosc'}
+
+
+def make_descriptors(n_systems, width):
+    """ Descriptors fluctuating around a mean value per system kind"""
+    kind = np.arange(n_systems) % 2
+    mean = np.random.rand(2, width) * np.exp(-np.linspace(0, 5, width))
+    data = mean[kind] * (1 + 0.05 * np.random.randn(n_systems, width))
+    data[kind == 1, width // 2:] = 0
+    return data
+
+
+def write(path, data, storage):
+    with h5py.File(path, 'w') as file, contextlib.redirect_stdout(io.StringIO()):
+        for method in ['base', 'ref']:
+            add_data('energy', file, np.random.rand(len(data)), 'system', method)
+        add_data('key', file, data, 'system', 'base', storage=storage)
+
+
+def throughput(func, n_bytes, repeat=3):
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return n_bytes / best / 1e6
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--systems', type=int, default=20000)
+    parser.add_argument('--width', type=int, default=600, help='Descriptors per system')
+    parser.add_argument('--batch_size', type=int, default=1000)
+    parser.add_argument('--single', type=int, default=200, help='Number of single system reads')
+    args = parser.parse_args()
+
+    np.random.seed(0)
+    data = make_descriptors(args.systems, args.width)
+    row_bytes = data.shape[1] * 8
+
+    print('{:>16} {:>10} {:>12} {:>12} {:>13} {:>10}'.format('storage', 'size [MB]', 'full [MB/s]', 'batch [MB/s]',
+                                                             'single [MB/s]', 'max error'))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name, storage in STORAGE.items():
+            path = os.path.join(tmpdir, name + '.hdf5')
+            write(path, data, storage)
+            size = os.path.getsize(path) / 1e6
+            with h5py.File(path, 'r') as file:
+                full = load_sets(file, 'system/base', 'system/ref', 'key')
+                error = np.max(np.abs(full[:, 1:-1] - data))
+                t_full = throughput(lambda: load_sets(file, 'system/base', 'system/ref', 'key'), data.nbytes)
+
+                lazy = load_sets(file, 'system/base', 'system/ref', 'key', lazy=True)
+                shuffled = lazy.subset(np.random.permutation(len(lazy)))
+                t_batch = throughput(lambda: [b for b in shuffled.iter_batches(args.batch_size)], data.nbytes)
+
+                rows = np.random.randint(0, len(lazy), args.single)
+                t_single = throughput(lambda: [lazy.take([r]) for r in rows], row_bytes * args.single)
+            print('{:>16} {:>10.1f} {:>12.0f} {:>12.0f} {:>13.1f} {:>10.1e}'.format(
+                name, size, t_full, t_batch, t_single, error))
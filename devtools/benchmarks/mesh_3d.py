@@ -0,0 +1,63 @@
+"""
+Benchmark of EuclideanProjector.mesh_3d (analytic int64 index ranges, shared
+between scaled and unscaled mesh) against the traceable implementation that
+masks fixed arange(-1000, 1000) ranges and is called twice per atom.
+
+Usage: python mesh_3d.py [--grids 50 100 200 300] [--natoms 50] [--r_o 2.0]
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from neuralxc.projector import OrthoEuclideanProjector
+from neuralxc.projector.projector import shift
+
+
+def legacy(projector, rmax, my_box, cm):
+    Xm = projector.mesh_3d_traceable(projector.U, projector.a, rmax, my_box, cm, scaled=False)
+    X = projector.mesh_3d_traceable(projector.U, projector.a, rmax, my_box, cm, scaled=True)
+    cms = shift(cm, projector.grid) - my_box[:, 0]
+    Xm = torch.fmod((Xm + cms.view(-1, 1, 1, 1)), projector.grid.view(-1, 1, 1, 1))
+    return Xm.long(), X
+
+
+def current(projector, rmax, my_box, cm):
+    return projector.mesh_3d(projector.U, projector.a, rmax, my_box, cm, both=True)
+
+
+def benchmark(n_grid, natoms, r_o, cell_length):
+    unitcell = np.eye(3) * cell_length
+    grid = np.array([n_grid] * 3)
+    projector = OrthoEuclideanProjector(unitcell, grid, {'X': {'n': 2, 'l': 2, 'r_o': r_o}})
+    projector.set_cell_parameters(torch.from_numpy(unitcell), torch.from_numpy(grid).double())
+    my_box = torch.Tensor([[0, n_grid]] * 3).double()
+    rmax = torch.ceil(r_o / projector.a) + 2
+    cms = torch.round(torch.rand(natoms, 3) * n_grid).double()
+
+    timings = {}
+    for name, func in [('legacy', legacy), ('analytic', current)]:
+        start = time.perf_counter()
+        results = [func(projector, rmax, my_box, cm) for cm in cms]
+        timings[name] = (time.perf_counter() - start) / natoms
+        timings[name + '_res'] = results
+
+    for (Xm_l, X_l), (Xm_c, X_c) in zip(timings['legacy_res'], timings['analytic_res']):
+        assert torch.all(Xm_l == Xm_c) and torch.allclose(X_l, X_c)
+    return int(torch.prod(2 * rmax + 1)), timings['legacy'], timings['analytic']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--grids', type=int, nargs='+', default=[50, 100, 200, 300])
+    parser.add_argument('--natoms', type=int, default=50)
+    parser.add_argument('--r_o', type=float, default=2.0)
+    parser.add_argument('--cell', type=float, default=20.0, help='Cubic cell length in Bohr')
+    args = parser.parse_args()
+
+    print('{:>6} {:>10} {:>14} {:>14} {:>8}'.format('grid', 'box pts', 'legacy [ms]', 'analytic [ms]', 'speedup'))
+    for n_grid in args.grids:
+        npoints, t_legacy, t_analytic = benchmark(n_grid, args.natoms, args.r_o, args.cell)
+        print('{:>6} {:>10} {:>14.3f} {:>14.3f} {:>8.1f}'.format(n_grid, npoints, t_legacy * 1e3, t_analytic * 1e3,
+                                                               t_legacy / t_analytic))
@@ -0,0 +1,96 @@
+"""
+Benchmark of multi-channel projection (e.g. rho, |grad rho|, tau for
+GGA/MGGA descriptors). Compares projecting all channels in a single pass
+(basis built once, one matrix product) with projecting every channel
+separately.
+
+Usage: python multichannel_projection.py [--projector ortho] [--channels 1 2 4 8] [--grid 100] [--natoms 20]
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+import torch
+
+from neuralxc.projector import GaussianEuclideanProjector, OrthoEuclideanProjector
+
+BASIS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'neuralxc', 'tests', 'basis-test')
+
+
+def setup(projector_type, n_grid, natoms, cell_length):
+    np.random.seed(0)
+    unitcell = np.eye(3) * cell_length
+    grid = np.array([n_grid] * 3)
+    if projector_type == 'ortho':
+        projector = OrthoEuclideanProjector(unitcell, grid, {'X': {'n': 4, 'l': 5, 'r_o': 2.5}})
+    else:
+        projector = GaussianEuclideanProjector(unitcell, grid, {'basis': {'file': BASIS_FILE, 'sigma': 2}, 'X': {}})
+    positions = np.random.rand(natoms, 3) * cell_length
+    return projector, positions
+
+
+def project_onto(projector, rho, rad, ang):
+    if isinstance(projector, OrthoEuclideanProjector):
+        return projector.project_onto(rho, rad, ang, None)
+    return projector.project_onto(rho, rad, ang, projector.basis['X'], None, None)
+
+
+def timed(func, repeat=3):
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def project_onto_level(projector, positions, rho):
+    """ Time projection only, basis functions are built beforehand"""
+    unitcell, grid = projector.unitcell, projector.grid
+    my_box = torch.Tensor([[0, g] for g in grid]).double()
+    projector.species = 'X'
+    atoms = []
+    for pos in torch.from_numpy(positions):
+        rad, ang, mesh = projector.forward_basis(pos, unitcell, grid, my_box)
+        mesh = mesh[:3].long()
+        atoms.append((rho[..., mesh[0], mesh[1], mesh[2]], rad, ang))
+
+    single, C_single = timed(lambda: [project_onto(projector, r, rad, ang) for r, rad, ang in atoms])
+    separate, C_separate = timed(
+        lambda: [torch.cat([project_onto(projector, c, rad, ang) for c in r]) for r, rad, ang in atoms])
+    for a, b in zip(C_single, C_separate):
+        assert torch.allclose(a, b)
+    return single, separate
+
+
+def full_level(projector, positions, rho):
+    """ Time complete basis representation (basis construction + projection)"""
+    species = ['X'] * len(positions)
+    single, C_single = timed(lambda: projector.get_basis_rep(rho, positions, species), repeat=1)
+    separate, C_separate = timed(lambda: [projector.get_basis_rep(r, positions, species) for r in rho], repeat=1)
+    assert np.allclose(C_single['X'].reshape(len(positions), len(rho), -1),
+                       np.stack([c['X'] for c in C_separate], axis=1))
+    return single, separate
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--projector', choices=['ortho', 'gaussian'], default='ortho')
+    parser.add_argument('--channels', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--grid', type=int, default=100)
+    parser.add_argument('--natoms', type=int, default=20)
+    parser.add_argument('--cell', type=float, default=15.0, help='Cubic cell length in Bohr')
+    args = parser.parse_args()
+
+    projector, positions = setup(args.projector, args.grid, args.natoms, args.cell)
+    print('{:>9} | {:>12} {:>12} {:>8} | {:>12} {:>12} {:>8}'.format('channels', 'proj. single', 'proj. sep.',
+                                                                      'speedup', 'full single', 'full sep.',
+                                                                      'speedup'))
+    for n_channels in args.channels:
+        rho = np.random.rand(n_channels, *[args.grid] * 3)
+        p_single, p_separate = project_onto_level(projector, positions, torch.from_numpy(rho))
+        f_single, f_separate = full_level(projector, positions, rho)
+        print('{:>9} | {:>11.1f}ms {:>11.1f}ms {:>8.1f} | {:>11.1f}ms {:>11.1f}ms {:>8.1f}'.format(
+            n_channels, p_single * 1e3, p_separate * 1e3, p_separate / p_single, f_single * 1e3, f_separate * 1e3,
+            f_separate / f_single))
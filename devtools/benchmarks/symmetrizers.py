@@ -0,0 +1,88 @@
+"""
+Time of the trace and mixed_trace symmetrizers (vectorized over n and l)
+compared to the previous implementations that loop over radial channels and
+angular momenta in Python, for n, l up to 8 and up to 10^6 atoms. Use --grad
+to include the backward pass (forces at SCF time). Combinations whose
+descriptors exceed --max_mb are skipped.
+
+Usage: python symmetrizers.py [--n 2 4 8] [--l 2 4 8] [--atoms 1 100 10000 1000000] [--grad]
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from neuralxc.symmetrizer import Symmetrizer
+
+
+def reference_trace(c, n_l, n, *args):
+    c_shape = c.size()
+    c = c.view(-1, c_shape[-1])
+    traces = []
+    idx = 0
+    for n_ in range(0, n):
+        for l in range(n_l):
+            traces.append(torch.norm(c[:, idx:idx + (2 * l + 1)], dim=1)**2)
+            idx += 2 * l + 1
+    traces = torch.stack(traces).T
+    return traces.view(*c_shape[:-1], -1)
+
+
+def reference_mixed_trace(c, n_l, n, *args):
+    c_shape = c.size()
+    c = c.view(-1, c_shape[-1])
+    c = c.view(len(c), n, -1)
+    traces = []
+    for n1 in range(0, n):
+        for n2 in range(n1, n):
+            idx = 0
+            for l in range(n_l):
+                traces.append(torch.sum(c[:, n1, idx:idx + (2 * l + 1)] * c[:, n2, idx:idx + (2 * l + 1)], dim=-1))
+                idx += 2 * l + 1
+    traces = torch.stack(traces).T
+    return traces.view(*c_shape[:-1], -1)
+
+
+REFERENCE = {'trace': reference_trace, 'mixed_trace': reference_mixed_trace}
+
+
+def timed(func, c, n_l, n, grad, repeat):
+    best = np.inf
+    for _ in range(repeat):
+        c_ = c.detach().requires_grad_(grad)
+        start = time.perf_counter()
+        result = func(c_, n_l, n)
+        if grad:
+            result.sum().backward()
+        best = min(best, time.perf_counter() - start)
+    return result.detach(), best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n', type=int, nargs='+', default=[2, 4, 8], help='Radial basis functions')
+    parser.add_argument('--l', type=int, nargs='+', default=[2, 4, 8], help='Angular momenta')
+    parser.add_argument('--atoms', type=int, nargs='+', default=[1, 100, 10000, 1000000])
+    parser.add_argument('--grad', action='store_true', help='Include backward pass')
+    parser.add_argument('--max_mb', type=float, default=500, help='Skip larger descriptor arrays')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    print('{:>12} {:>3} {:>3} {:>8} {:>14} {:>15} {:>8}'.format('symmetrizer', 'n', 'l', 'atoms', 'reference [ms]',
+                                                                'vectorized [ms]', 'speedup'))
+    for symtype, reference in REFERENCE.items():
+        for n in args.n:
+            for n_l in args.l:
+                basis = {'X': {'n': n, 'l': n_l, 'r_o': 1}}
+                symmetrize = type(Symmetrizer({'symmetrizer_type': symtype, 'basis': basis}))._symmetrize_function
+                for atoms in args.atoms:
+                    if atoms * n * n_l**2 * 8 / 1e6 > args.max_mb:
+                        continue
+                    c = torch.rand(atoms, n * n_l**2, dtype=torch.float64)
+                    D_ref, t_ref = timed(reference, c, n_l, n, args.grad, args.repeat)
+                    D, t_new = timed(symmetrize, c, n_l, n, args.grad, args.repeat)
+                    assert torch.allclose(D_ref, D)
+                    print('{:>12} {:>3} {:>3} {:>8} {:>14.3f} {:>15.3f} {:>8.1f}'.format(
+                        symtype, n, n_l, atoms, t_ref * 1e3, t_new * 1e3, t_ref / t_new))
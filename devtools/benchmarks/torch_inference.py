@@ -0,0 +1,75 @@
+"""
+Latency of energy predictions through SpeciesGrouper -> symmetrizer ->
+GroupedVarianceThreshold -> GroupedStandardScaler -> EnergyNetwork for
+different batch sizes (number of samples of the same system). Compares the
+numpy API (transform of every step followed by predict) to the torch path
+(NXCPipeline.forward on a tensor). Descriptors are random, the network is
+not trained.
+
+Usage: python torch_inference.py [--species OHH] [--n 4] [--l 4] [--calls 20]
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from neuralxc.ml.utils import get_default_pipeline
+
+BATCH_SIZES = [1, 10, 100, 1000, 10000]
+
+
+def numpy_path(steps, X):
+    for step in steps[:-1]:
+        X = step.transform(X)
+    return steps[-1].predict(X)[0]
+
+
+def torch_path(pipeline, X):
+    with torch.no_grad():
+        return pipeline.forward(X)[0]
+
+
+def latency(func, *args, calls=20):
+    """ Median time per call"""
+    times = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    return np.median(times)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--species', default='OHH')
+    parser.add_argument('--n', type=int, default=4, help='Radial basis functions')
+    parser.add_argument('--l', type=int, default=4, help='Angular momenta')
+    parser.add_argument('--symmetrizer', default='trace')
+    parser.add_argument('--calls', type=int, default=20)
+    args = parser.parse_args()
+
+    basis = {spec: {'n': args.n, 'l': args.l, 'r_o': 2} for spec in set(args.species)}
+    pipeline = get_default_pipeline(basis, [args.species], symmetrizer_type=args.symmetrizer)
+    steps = [step[1] for step in pipeline.steps]
+    width = len(args.species) * args.n * args.l**2
+
+    np.random.seed(0)
+    X_fit = np.random.rand(1000, width + 2)
+    X_fit[:, 0] = 0
+    transformed = X_fit
+    for step in steps[:-1]:
+        transformed = step.fit(transformed).transform(transformed)
+    steps[-1].build_network()
+    steps[-1]._network.build_species_nets(transformed[0][0])
+    pipeline.to_torch()
+
+    print('{:>10} {:>12} {:>12} {:>8}'.format('batch', 'numpy [ms]', 'torch [ms]', 'speedup'))
+    for batch_size in BATCH_SIZES:
+        X = X_fit[np.arange(batch_size) % len(X_fit)]
+        X_torch = torch.from_numpy(X)
+        assert np.allclose(numpy_path(steps, X), torch_path(pipeline, X_torch).numpy())
+        t_numpy = latency(numpy_path, steps, X, calls=args.calls)
+        t_torch = latency(torch_path, pipeline, X_torch, calls=args.calls)
+        print('{:>10} {:>12.3f} {:>12.3f} {:>8.1f}'.format(batch_size, t_numpy * 1e3, t_torch * 1e3,
+                                                          t_numpy / t_torch))
@@ -0,0 +1,86 @@
+"""
+Per-system cost of preprocessing (transform_one: reading a density file and
+projecting it) when density getter and projector are reused from the worker
+pool compared to building them for every system. Setup is the time spent
+obtaining density getter and projector, the remainder is I/O and projection.
+
+Usage: python transform_one.py [--projector ortho] [--systems 20] [--grid 60] [--natoms 12]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+from scipy.io import FortranFile
+
+from neuralxc.preprocessor import preprocessor as pre_module
+
+BASIS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'neuralxc', 'tests', 'basis-test')
+
+
+def write_density(path, n_grid, cell_length):
+    with FortranFile(path, 'w') as rhofile:
+        rhofile.write_record(np.eye(3) * cell_length)
+        rhofile.write_record(np.array([n_grid] * 3 + [1], dtype=np.int32))
+        for _ in range(n_grid * n_grid):
+            rhofile.write_record(np.random.rand(n_grid).astype(np.float32))
+
+
+def timed_setup(func, setup_time):
+    def wrapper(*args):
+        start = time.perf_counter()
+        result = func(*args)
+        setup_time[0] += time.perf_counter() - start
+        return result
+
+    return wrapper
+
+
+def run(paths, positions, basis, pooled):
+    pool = pre_module.get_worker_pool()
+    pool.clear()
+    setup_time = [0]
+    get_density_getter, get_projector = pre_module.get_density_getter, pre_module.get_projector
+    pre_module.get_density_getter = timed_setup(get_density_getter, setup_time)
+    pre_module.get_projector = timed_setup(get_projector, setup_time)
+    start = time.perf_counter()
+    results = []
+    try:
+        for path, pos in zip(paths, positions):
+            if not pooled:
+                pool.clear()
+            results.append(pre_module.transform_one(path, pos, ['X'] * len(pos), basis))
+    finally:
+        pre_module.get_density_getter, pre_module.get_projector = get_density_getter, get_projector
+    return results, (time.perf_counter() - start) / len(paths), setup_time[0] / len(paths)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--projector', choices=['ortho', 'gaussian'], default='ortho')
+    parser.add_argument('--systems', type=int, default=20)
+    parser.add_argument('--grid', type=int, default=60)
+    parser.add_argument('--natoms', type=int, default=12)
+    parser.add_argument('--cell', type=float, default=15.0, help='Cubic cell length in Bohr')
+    args = parser.parse_args()
+
+    if args.projector == 'ortho':
+        basis = {'X': {'n': 4, 'l': 5, 'r_o': 2.5}, 'projector_type': 'ortho'}
+    else:
+        basis = {'basis': {'file': BASIS_FILE, 'sigma': 2}, 'X': {}, 'projector_type': 'gaussian'}
+
+    np.random.seed(0)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        paths = [os.path.join(tmpdir, '{}.RHOXC'.format(i)) for i in range(args.systems)]
+        for path in paths:
+            write_density(path, args.grid, args.cell)
+        positions = [np.random.rand(args.natoms, 3) * args.cell for _ in paths]
+
+        results = {}
+        print('{:>8} {:>14} {:>14}'.format('mode', 'total [ms/sys]', 'setup [ms/sys]'))
+        for mode in ['fresh', 'pooled']:
+            results[mode], t_total, t_setup = run(paths, positions, basis, pooled=(mode == 'pooled'))
+            print('{:>8} {:>14.2f} {:>14.3f}'.format(mode, t_total * 1e3, t_setup * 1e3))
+        for r_fresh, r_pooled in zip(results['fresh'], results['pooled']):
+            assert np.allclose(r_fresh, r_pooled)
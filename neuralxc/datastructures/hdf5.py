@@ -1,10 +1,20 @@
+import h5py
 import numpy as np
 from ase.io import read
 
 import neuralxc.ml.utils
+from neuralxc.formatter import fix_species
 from neuralxc.utils import ConfigFile
 
-__all__ = ['add_data', 'merge_sets', 'basis_to_hash', 'add_species', 'add_energy', 'add_forces', 'add_density']
+try:
+    import hdf5plugin
+except ModuleNotFoundError:
+    hdf5plugin = None
+
+__all__ = [
+    'add_data', 'merge_sets', 'basis_to_hash', 'add_species', 'add_energy', 'add_forces', 'add_density',
+    'storage_options', 'RaggedDescriptors', 'is_ragged', 'read_density'
+]
 
 
 def add_energy(*args, **kwargs):
@@ -19,6 +29,319 @@ def add_density(key, *args, **kwargs):
     return add_data(key, *args, **kwargs)
 
 
+def storage_options(storage, width, n_rows=None, chunk_bytes=2**16):
+    """
+    Keyword arguments for h5py's create_dataset used to store descriptors.
+    Chunks always span full rows (systems), so that reading a single system
+    only touches a single chunk.
+
+    Parameters
+    ----------
+
+    storage: dict
+        Storage options (preprocessor['storage']) with optional entries
+        'dtype' ('float64' or 'float32'), 'compression' ('lzf', 'gzip' or 'blosc',
+        the latter requires hdf5plugin), 'compression_opts', 'shuffle' and
+        'chunk_rows' (number of systems per chunk, by default chosen so that a
+        chunk holds about chunk_bytes, 0: contiguous storage unless compressed)
+    width: int
+        Number of descriptors per system
+    n_rows: int
+        Number of systems if known (fixed size datasets)
+    chunk_bytes: int
+        Target size of a chunk in bytes
+
+    Returns
+    --------
+
+    dict
+        Keyword arguments, empty if storage is empty
+    """
+    if not storage:
+        return {}
+
+    dtype = np.dtype(storage.get('dtype', 'float64'))
+    if not dtype in [np.float64, np.float32]:
+        raise Exception('Storage dtype {} not supported, use float64 or float32'.format(dtype))
+    options = {'dtype': dtype}
+
+    chunk_rows = storage.get('chunk_rows', max(1, chunk_bytes // (max(width, 1) * dtype.itemsize)))
+    if chunk_rows:
+        if n_rows is not None:
+            chunk_rows = min(chunk_rows, max(n_rows, 1))
+        options['chunks'] = (chunk_rows, max(width, 1))
+
+    compression = storage.get('compression', None)
+    if compression == 'blosc':
+        if hdf5plugin is None:
+            raise Exception('blosc compression requires hdf5plugin')
+        options.update(hdf5plugin.Blosc(**storage.get('compression_opts', {})))
+    elif compression:
+        options['compression'] = compression
+        if 'compression_opts' in storage:
+            options['compression_opts'] = storage['compression_opts']
+        # Byte shuffling considerably improves compression of floating point data
+        options['shuffle'] = storage.get('shuffle', True)
+    return options
+
+
+def is_ragged(obj):
+    """ Whether obj is a hdf5 group containing ragged descriptors (see RaggedDescriptors)
+    """
+    return isinstance(obj, h5py.Group) and 'values' in obj and 'offsets' in obj and 'kind' in obj
+
+
+def read_density(file, path):
+    """ Descriptors stored at path, either as a (padded) h5py.Dataset or as RaggedDescriptors
+    """
+    density = file[path]
+    if is_ragged(density):
+        return RaggedDescriptors.read(density)
+    return density
+
+
+class RaggedDescriptors():
+    def __init__(self, values, offsets, kind, kinds, columns, width, group=None):
+        """ Descriptors of systems with differing numbers of descriptors stored
+        without padding. Row i contains values[offsets[i]:offsets[i+1]], the
+        descriptors of a system of kind kinds[kind[i]] (joined chemical symbols).
+        In the padded layout produced by Preprocessor.transform these occupy the
+        columns starting at columns[kind[i]] of a row with width entries.
+
+        Indexing returns rows in the padded layout, so that RaggedDescriptors
+        can be used in place of a padded h5py.Dataset. If values is an h5py.Dataset
+        only the rows accessed are read.
+
+        Parameters
+        ----------
+        values: np.ndarray or h5py.Dataset (total number of descriptors)
+        offsets: np.ndarray int (nrows + 1)
+        kind: np.ndarray int (nrows)
+            Index into kinds for every row
+        kinds: list of str
+            Kinds of systems, e.g. ['OHH', 'HH']
+        columns: np.ndarray int (nkinds)
+            Column offset of every kind in padded layout
+        width: int
+            Width of padded layout
+        group: h5py.Group
+            Group the descriptors are stored in (if any)
+        """
+        self.values = values
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.kind = np.asarray(kind, dtype=np.int64)
+        self.kinds = [str(k) for k in kinds]
+        self.columns = np.asarray(columns, dtype=np.int64)
+        self.width = int(width)
+        self.group = group
+
+    @classmethod
+    def from_rows(cls, rows, labels, columns, width):
+        """
+        Parameters
+        ----------
+        rows: list of np.ndarray
+            Descriptors of every system
+        labels: list of str
+            Kind of every system
+        columns: dict
+            Column offset in padded layout for every kind
+        width: int
+            Width of padded layout
+        """
+        kinds = list(columns)
+        index = {k: i for i, k in enumerate(kinds)}
+        offsets = np.concatenate([[0], np.cumsum([len(r) for r in rows], dtype=np.int64)])
+        values = np.concatenate(rows) if len(rows) else np.zeros(0)
+        return cls(values, offsets, [index[l] for l in labels], kinds, [columns[k] for k in kinds], width)
+
+    @classmethod
+    def from_dense(cls, data, label):
+        """ Every row of (padded) data becomes a system of kind label
+        """
+        data = np.asarray(data)
+        return cls(data.reshape(-1),
+                   np.arange(len(data) + 1) * data.shape[1], np.zeros(len(data)), [label], [0], data.shape[1])
+
+    @classmethod
+    def read(cls, group):
+        return cls(group['values'], group['offsets'][:], group['kind'][:], group.attrs['kinds'],
+                   group.attrs['columns'], group.attrs['width'], group)
+
+    @classmethod
+    def create(cls, parent, name, columns, width, storage=None):
+        """ Create empty, resizable ragged descriptors in parent[name] to which
+        systems are added with append
+        """
+        kinds = list(columns)
+        group = parent.create_group(name)
+        group.create_dataset('values', shape=(0, ), maxshape=(None, ), **_values_options(storage, width))
+        group.create_dataset('offsets', data=np.zeros(1, dtype=np.int64), maxshape=(None, ), chunks=True)
+        group.create_dataset('kind', shape=(0, ), maxshape=(None, ), dtype=np.int64, chunks=True)
+        group.attrs.update({'kinds': kinds, 'columns': [columns[k] for k in kinds], 'width': width})
+        return cls.read(group)
+
+    def write(self, parent, name, storage=None):
+        """ Store in hdf5 group parent[name]
+
+        Returns
+        -------
+        RaggedDescriptors
+            Reading from file
+        """
+        values = np.asarray(self.values[:])
+        group = parent.create_group(name)
+        lengths = np.diff(self.offsets)
+        group.create_dataset('values', data=values, **_values_options(storage, np.mean(lengths) if len(self) else 1))
+        group.create_dataset('offsets', data=self.offsets)
+        group.create_dataset('kind', data=self.kind)
+        group.attrs.update({'kinds': self.kinds, 'columns': self.columns, 'width': self.width})
+        return RaggedDescriptors.read(group)
+
+    @property
+    def attrs(self):
+        return self.group.attrs
+
+    @property
+    def shape(self):
+        return (len(self), self.width)
+
+    def __len__(self):
+        return len(self.kind)
+
+    def append(self, row, label):
+        """ Append the descriptors row of a system of kind label (file backed only)
+        """
+        n, n_values = len(self), self.offsets[-1]
+        self.group['values'].resize(n_values + len(row), axis=0)
+        self.group['values'][n_values:] = row
+        self.offsets = np.append(self.offsets, n_values + len(row))
+        self.kind = np.append(self.kind, self.kinds.index(label))
+        self.group['offsets'].resize(n + 2, axis=0)
+        self.group['offsets'][n + 1] = self.offsets[-1]
+        self.group['kind'].resize(n + 1, axis=0)
+        self.group['kind'][n] = self.kind[-1]
+
+    def resize(self, n):
+        """ Keep the first n rows (file backed only)
+        """
+        self.offsets = self.offsets[:n + 1]
+        self.kind = self.kind[:n]
+        self.group['values'].resize(self.offsets[-1], axis=0)
+        self.group['offsets'].resize(n + 1, axis=0)
+        self.group['kind'].resize(n, axis=0)
+
+    def subset(self, index):
+        """ In-memory RaggedDescriptors containing rows index
+        """
+        rows = np.arange(len(self))[index]
+        values, lengths = self._read(rows)
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        return RaggedDescriptors(values, offsets, self.kind[rows], self.kinds, self.columns, self.width)
+
+    def _read(self, rows):
+        """ Concatenated descriptors and number of descriptors of rows
+        """
+        start, end = self.offsets[rows], self.offsets[rows + 1]
+        lengths = end - start
+        total = np.sum(lengths)
+        if not total:
+            return np.zeros(0), lengths
+        lo, hi = np.min(start), np.max(end)
+        # Dense selections are read as one slab
+        if total >= (hi - lo) / 4:
+            block = np.asarray(self.values[lo:hi])
+            return block[_ragged_index(start - lo, lengths)], lengths
+        return np.concatenate([self.values[a:b] for a, b in zip(start, end)]), lengths
+
+    def __getitem__(self, index):
+        """ Rows index in padded layout
+        """
+        rows = np.arange(len(self))[index]
+        if np.ndim(rows) == 0:
+            return self[[rows]][0]
+        values, lengths = self._read(rows)
+        data = np.zeros([len(rows), self.width])
+        data[np.repeat(np.arange(len(rows)), lengths), _ragged_index(self.columns[self.kind[rows]], lengths)] = values
+        return data
+
+    def group_species(self, index, species, vec_len):
+        """ Descriptors of rows index grouped by species (see SpeciesGrouper) without
+        going through the padded layout. Atoms of a system are stored in order of
+        appearance, the remaining entries are zero.
+
+        Parameters
+        ----------
+        index: slice or np.ndarray
+            Rows
+        species: list of str
+            Species occurring in these rows (see formatter.fix_species)
+        vec_len: dict
+            Number of descriptors per atom for every species
+
+        Returns
+        -------
+        dict of np.ndarray (nrows, natoms, vec_len)
+        """
+        rows = np.arange(len(self))[index]
+        kind = self.kind[rows]
+        kinds = fix_species(self.kinds)
+        features = {}
+        for spec in species:
+            if not spec in features:
+                n_atoms = max([k.count(spec) for k in kinds])
+                features[spec] = np.zeros([len(rows), n_atoms, vec_len[spec]])
+
+        for k, this_kind in enumerate(kinds):
+            selection = np.where(kind == k)[0]
+            if not len(selection):
+                continue
+            values = self._read(rows[selection])[0].reshape(len(selection), -1)
+            idx = 0
+            spec_loc = {spec: 0 for spec in features}
+            for spec in this_kind:
+                features[spec][selection, spec_loc[spec]] = values[:, idx:idx + vec_len[spec]]
+                spec_loc[spec] += 1
+                idx += vec_len[spec]
+        return features
+
+    @staticmethod
+    def concatenate(ragged):
+        """ Stack list of RaggedDescriptors, padded layouts are placed next to each
+        other (block diagonal)
+        """
+        kinds, columns, kind, values, offsets = [], [], [], [], [np.zeros(1, dtype=np.int64)]
+        width, n_values = 0, 0
+        for r in ragged:
+            kind.append(r.kind + len(kinds))
+            kinds += r.kinds
+            columns.append(r.columns + width)
+            width += r.width
+            values.append(np.asarray(r.values[:]))
+            offsets.append(r.offsets[1:] + n_values)
+            n_values += r.offsets[-1]
+        return RaggedDescriptors(np.concatenate(values), np.concatenate(offsets), np.concatenate(kind), kinds,
+                                 np.concatenate(columns), width)
+
+
+def _ragged_index(start, lengths):
+    """ Indices start[i], ..., start[i] + lengths[i] - 1 for every i, concatenated
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    within = np.arange(np.sum(lengths)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return np.repeat(np.asarray(start, dtype=np.int64), lengths) + within
+
+
+def _values_options(storage, mean_width):
+    """ Options for the 1d values dataset of ragged descriptors, chunks hold
+    as many systems as chunks of a padded dataset would
+    """
+    options = {'dtype': np.float64, 'chunks': True}
+    options.update(storage_options(storage, max(int(mean_width), 1)))
+    if options['chunks'] is not True:
+        options['chunks'] = (options['chunks'][0] * options['chunks'][1], )
+    return options
+
 def add_species(file, system, traj_path=''):
     """
     Add an attribute containing the species string for a given
@@ -54,7 +377,7 @@ def add_species(file, system, traj_path=''):
         cg.attrs.update({'species': species})
 
 
-def add_data(which, file, data, system, method, override=False, E0=None):
+def add_data(which, file, data, system, method, override=False, E0=None, storage=None):
     """
     Add data to hdf5 file.
 
@@ -65,7 +388,7 @@ def add_data(which, file, data, system, method, override=False, E0=None):
         Add 'energy', 'forces' or 'density'
     file: hdf5 file handle
         File to add data to
-    data: numpy ndarray
+    data: numpy ndarray or RaggedDescriptors
         Data to add
     system: str
         System label defining first part of group
@@ -75,6 +398,8 @@ def add_data(which, file, data, system, method, override=False, E0=None):
         in datafile
     override: bool
         If dataset already exists in file, override it?
+    storage: dict
+        Storage options for densities (descriptors), see storage_options
     """
 
     order = [system, method]
@@ -96,12 +421,19 @@ def add_data(which, file, data, system, method, override=False, E0=None):
 
     print('{} systems found, adding {}'.format(len(data), which))
 
+    options = {}
+    if storage and not which in ['energy', 'forces'] and not isinstance(data, RaggedDescriptors):
+        options = storage_options(storage, np.shape(data)[1], len(data))
+
     def create_dataset():
-        cg.create_dataset(which, data=data)
+        if isinstance(data, RaggedDescriptors):
+            data.write(cg, which, storage)
+        else:
+            cg.create_dataset(which, data=data, **options)
 
     try:
         create_dataset()
-    except RuntimeError:
+    except (RuntimeError, ValueError):
         if override:
             del cg[which]
             create_dataset()
@@ -113,7 +445,7 @@ def merge_sets(file, datasets, density_key=None, new_name='merged', E0={}):
 
     energies = [file[data + '/energy'][:] for data in datasets]
     if not E0:
-        energies = [e - nxc.ml.utils.find_attr_in_tree(file, data, 'E0') for e, data in zip(energies, datasets)]
+        energies = [e - neuralxc.ml.utils.find_attr_in_tree(file, data, 'E0') for e, data in zip(energies, datasets)]
 
     forces_found = True
     try:
@@ -121,16 +453,26 @@ def merge_sets(file, datasets, density_key=None, new_name='merged', E0={}):
     except KeyError:
         forces_found = False
 
-    if density_key:
-        densities = [file[data + '/density/' + density_key][:] for data in datasets]
+    species = [neuralxc.ml.utils.find_attr_in_tree(file, data, 'species') for data in datasets]
 
-        densities_full = np.zeros([sum([len(d) for d in densities]), sum([d.shape[1] for d in densities])])
-        line_mark = 0
-        col_mark = 0
-        for d in densities:
-            densities_full[line_mark:line_mark + d.shape[0], col_mark:col_mark + d.shape[1]] = d
-            line_mark += d.shape[0]
-            col_mark += d.shape[1]
+    if density_key:
+        densities = [read_density(file, data + '/density/' + density_key) for data in datasets]
+
+        if any([isinstance(d, RaggedDescriptors) for d in densities]):
+            # Block diagonal layout is kept implicit, padded sets are added as a single kind each
+            densities_full = RaggedDescriptors.concatenate([
+                d if isinstance(d, RaggedDescriptors) else RaggedDescriptors.from_dense(d[:], s)
+                for d, s in zip(densities, species)
+            ])
+        else:
+            densities = [d[:] for d in densities]
+            densities_full = np.zeros([sum([len(d) for d in densities]), sum([d.shape[1] for d in densities])])
+            line_mark = 0
+            col_mark = 0
+            for d in densities:
+                densities_full[line_mark:line_mark + d.shape[0], col_mark:col_mark + d.shape[1]] = d
+                line_mark += d.shape[0]
+                col_mark += d.shape[1]
 
     if forces_found:
         forces_full = np.zeros([sum([len(d) for d in forces]), max([d.shape[1] for d in forces]), 3])
@@ -140,7 +482,6 @@ def merge_sets(file, datasets, density_key=None, new_name='merged', E0={}):
             forces_full[line_mark:line_mark + f.shape[0], :f.shape[1]] = f
             line_mark += f.shape[0]
 
-    species = [neuralxc.ml.utils.find_attr_in_tree(file, data, 'species') for data in datasets]
     if E0:
         energies = [
             e - sum([s.count(element) * value for element, value in E0.items()]) for e, s in zip(energies, species)
@@ -162,7 +503,9 @@ def merge_sets(file, datasets, density_key=None, new_name='merged', E0={}):
     file.create_dataset(new_name + '/energy', data=energies)
     if forces_found:
         file.create_dataset(new_name + '/forces', data=forces_full)
-    if density_key:
+    if density_key and isinstance(densities_full, RaggedDescriptors):
+        densities_full.write(file[new_name].create_group('density'), density_key)
+    elif density_key:
         file.create_dataset(new_name + '/density/' + density_key, data=densities_full)
 
 
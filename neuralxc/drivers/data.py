@@ -18,8 +18,18 @@ os.environ['PYTHONWARNINGS'] = 'ignore::DeprecationWarning'
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '10'
 
 
-def add_data_driver(hdf5, system, method, add, traj='', density='', override=False, slice=':', zero=None, addto=''):
-    """ Adds data to hdf5 file"""
+def add_data_driver(hdf5,
+                    system,
+                    method,
+                    add,
+                    traj='',
+                    density='',
+                    override=False,
+                    slice=':',
+                    zero=None,
+                    addto='',
+                    storage=None):
+    """ Adds data to hdf5 file, storage options only apply to densities"""
     try:
         file = h5py.File(hdf5, 'r+')
         file.close()
@@ -71,7 +81,13 @@ def add_data_driver(hdf5, system, method, add, traj='', density='', override=Fal
             elif which == 'density':
                 add_species(file, system, traj)
                 data = np.load(density)[ijk]
-                add_density((density.split('/')[-1]).split('.')[0], file, data, system, method, override)
+                add_density((density.split('/')[-1]).split('.')[0],
+                            file,
+                            data,
+                            system,
+                            method,
+                            override,
+                            storage=storage)
             else:
                 raise Exception('Option {} not recognized'.format(which))
 
@@ -120,6 +136,8 @@ def split_data_driver(hdf5, group, label, slice=':', comp=''):
         sets = {}
         if isinstance(file[path], h5py._hl.dataset.Dataset):
             return {path: file[path]}
+        elif is_ragged(file[path]):
+            return {path: RaggedDescriptors.read(file[path])}
         else:
             for key in file[path]:
                 sets.update(collect_all_sets(file, path + '/' + key))
@@ -130,13 +148,19 @@ def split_data_driver(hdf5, group, label, slice=':', comp=''):
     comp_sets = {}
     length = -1
     for path in all_sets:
-        new_len = len(all_sets[path][:])
+        new_len = len(all_sets[path])
         if length == -1:
             length = new_len
         elif new_len != length:
             raise Exception('Datasets contained in group dont have consistent lengths')
         idx = path.find(group) + len(group)
         new_path = path[:idx] + '/' + label + path[idx:]
+        if isinstance(all_sets[path], RaggedDescriptors):
+            if comp != '':
+                comp_path = path[:idx] + '/' + comp + path[idx:]
+                comp_sets[comp_path] = all_sets[path].subset(np.delete(np.arange(new_len), ijk))
+            split_sets[new_path] = all_sets[path].subset(ijk)
+            continue
         if comp != '':
             idx = path.find(group) + len(group)
             comp_path = path[:idx] + '/' + comp + path[idx:]
@@ -144,14 +168,21 @@ def split_data_driver(hdf5, group, label, slice=':', comp=''):
             del comp_sets[comp_path][ijk]
         split_sets[new_path] = all_sets[path][ijk]
 
+    def create_dataset(path, data):
+        if isinstance(data, RaggedDescriptors):
+            parent, name = path.rsplit('/', 1)
+            data.write(file.require_group(parent), name)
+        else:
+            file.create_dataset(path, data=data)
+
     for new_path in split_sets:
-        file.create_dataset(new_path, data=split_sets[new_path])
+        create_dataset(new_path, split_sets[new_path])
 
     for new_path, path in zip(split_sets, all_sets):
         file['/'.join(new_path.split('/')[:-1])].attrs.update(file['/'.join(path.split('/')[:-1])].attrs)
     if comp_sets:
         for comp_path in comp_sets:
-            file.create_dataset(comp_path, data=comp_sets[comp_path])
+            create_dataset(comp_path, comp_sets[comp_path])
         for new_path, path in zip(comp_sets, all_sets):
             file['/'.join(new_path.split('/')[:-1])].attrs.update(file['/'.join(path.split('/')[:-1])].attrs)
     # print(split_sets)
@@ -19,6 +19,7 @@ from neuralxc.ml.utils import *
 from neuralxc.preprocessor import driver
 from neuralxc.symmetrizer import symmetrizer_factory
 from neuralxc.utils import ConfigFile
+from neuralxc.utils.executor import config_executor
 
 __all__ = ['serialize', 'sc_driver', 'fit_driver', 'eval_driver']
 os.environ['KMP_AFFINITY'] = 'none'
@@ -192,7 +193,8 @@ def sc_driver(xyz,
            pre['preprocessor'].get('application', 'siesta'),
            workdir='workdir',
            nworkers=pre.get('n_workers', 1),
-           kwargs=engine_kwargs)
+           kwargs=engine_kwargs,
+           executor=config_executor(pre))
     print('\nProjecting onto basis ...')
     print('-----------------------------\n')
     pre_driver(xyz, 'workdir', preprocessor='pre.json', dest='data.hdf5/system/it{}'.format(iteration))
@@ -249,7 +251,8 @@ def sc_driver(xyz,
                pre['preprocessor'].get('application', 'siesta'),
                workdir='workdir',
                nworkers=pre.get('n_workers', 1),
-               kwargs=engine_kwargs)
+               kwargs=engine_kwargs,
+               executor=config_executor(pre))
 
         print('\nProjecting onto basis...')
         print('-----------------------------\n')
@@ -306,7 +309,8 @@ def sc_driver(xyz,
                pre['preprocessor'].get('application', 'siesta'),
                workdir='workdir',
                nworkers=pre.get('n_workers', 1),
-               kwargs=engine_kwargs)
+               kwargs=engine_kwargs,
+               executor=config_executor(pre))
         add_data_driver(hdf5='data.hdf5',
                         system='system',
                         method='testing/ref',
@@ -332,8 +336,51 @@ def sc_driver(xyz,
         print('testing.traj or testing.xyz not found.')
 
 
-def fit_driver(preprocessor, hyper, hdf5=None, sets='', sample='', cutoff=0.0, model='', hyperopt=False):
-    """ Fits a NXCPipeline to the provided data
+def predict_sets(model, data, batch_size=10000):
+    """ Predictions of a fitted model (as returned by get_grid_cv) for every row
+    of LazySets data, made in mini-batches of batch_size samples. A batch does
+    not contain samples of every set, so sets are predicted one at a time with
+    a species grouper that only knows this set.
+
+    Returns
+    -------
+    prediction: np.ndarray
+        Predicted energies in the row order of data
+    """
+    pipeline = model.steps[-1][1]
+    grouper = pipeline.steps[0][1]
+    prediction = np.zeros(len(data))
+    for set, species in enumerate(grouper.get_params()['sys_species']):
+        selection = np.where(data.system == set)[0]
+        if not len(selection):
+            continue
+        set_grouper = SpeciesGrouper(grouper.get_params()['attrs'], [species], grouper.get_params()['spec_agnostic'])
+        set_pipeline = NXCPipeline([('spec_group', set_grouper)] + pipeline.steps[1:],
+                                   basis_instructions=pipeline.get_basis_instructions(),
+                                   symmetrize_instructions=pipeline.get_symmetrize_instructions())
+        predictions = []
+        for batch in data.subset(selection).iter_batches(batch_size):
+            batch[:, 0] = 0
+            predictions.append(set_pipeline.predict(batch)[0].flatten())
+        prediction[selection] = np.concatenate(predictions)
+    return prediction
+
+
+def fit_driver(preprocessor,
+               hyper,
+               hdf5=None,
+               sets='',
+               sample='',
+               cutoff=0.0,
+               model='',
+               hyperopt=False,
+               batch_size=10000,
+               checkpoint='',
+               resume=False):
+    """ Fits a NXCPipeline to the provided data. Descriptors are read lazily,
+    predictions are made in mini-batches of batch_size samples (0: all at once).
+    If checkpoint is set, the training state is saved to this file periodically,
+    resume continues an interrupted fit from there.
     """
     inputfile = hyper
     if sets != '':
@@ -366,33 +413,43 @@ def fit_driver(preprocessor, hyper, hdf5=None, sets='', sample='', cutoff=0.0, m
         hyperopt = False
         new_model.steps[-1][1].steps[2:] = xc.ml.network.load_pipeline(model).steps
 
+    if resume and not checkpoint:
+        raise ValueError('resume requires a checkpoint')
+    if checkpoint:
+        if hyperopt:
+            raise ValueError('Checkpoints are not supported for hyperparameter optimization')
+        new_model.set_params(ml__estimator__checkpoint=checkpoint, ml__estimator__resume=resume)
+
     datafile = h5py.File(hdf5[0], 'r')
-    data = load_sets(datafile, hdf5[1], hdf5[2], basis_key, cutoff)
+    data = load_sets(datafile, hdf5[1], hdf5[2], basis_key, cutoff, lazy=True)
 
     if model:
         for set in apply_to:
-            selection = (data[:, 0] == set)
-            prediction = new_model.predict(data)[set][:, 0]
-            print('Dataset {} old STD: {}'.format(set, np.std(data[selection][:, -1])))
-            data[selection, -1] += prediction
-            print('Dataset {} new STD: {}'.format(set, np.std(data[selection][:, -1])))
+            selection = (data.system == set)
+            prediction = predict_sets(new_model, data.subset(selection), batch_size)
+            print('Dataset {} old STD: {}'.format(set, np.std(data.y[selection])))
+            data.y[selection] += prediction
+            print('Dataset {} new STD: {}'.format(set, np.std(data.y[selection])))
 
     if sample != '':
         sample = np.load(sample)
-        data = data[sample]
+        data = data.subset(sample)
         print("Using sample of size {}".format(len(sample)))
 
-    np.random.shuffle(data)
+    # Resumed fits have to see the data in the same order
+    data = data.subset((np.random.RandomState(0) if checkpoint else np.random).permutation(len(data)))
     if hyperopt:
         estimator = grid_cv
     else:
         estimator = new_model
 
-    real_targets = np.array(data[:, -1]).real.flatten()
+    real_targets = np.array(data.y).real.flatten()
 
-    estimator.fit(data)
+    # The species grouper reads lazy sets directly (ragged descriptors are grouped without padding),
+    # cross-validation needs an indexable array
+    estimator.fit(data.take() if hyperopt else data)
 
-    dev = estimator.predict(data)[0].flatten() - real_targets
+    dev = predict_sets(estimator.best_estimator_ if hyperopt else estimator, data, batch_size) - real_targets
     dev0 = np.abs(dev - np.mean(dev))
     results = {
         'mean deviation': np.mean(dev).round(4),
@@ -425,8 +482,10 @@ def eval_driver(hdf5,
                 invert_sample=False,
                 keep_mean=False,
                 hashkey='',
-                printout=True):
-    """ Evaluate fitted NXCPipeline on dataset and report statistics
+                printout=True,
+                batch_size=10000):
+    """ Evaluate fitted NXCPipeline on dataset and report statistics. Descriptors
+    are read and evaluated in mini-batches of batch_size samples (0: all at once).
     """
 
     if predict:
@@ -445,7 +504,7 @@ def eval_driver(hdf5,
     else:
         basis_key = ''
 
-    data = load_sets(datafile, hdf5[1], hdf5[2], basis_key, cutoff)
+    data = load_sets(datafile, hdf5[1], hdf5[2], basis_key, cutoff, lazy=True)
     results = {}
     if not model == '':
         symmetrizer_instructions = model.get_symmetrize_instructions()
@@ -457,8 +516,8 @@ def eval_driver(hdf5,
                                basis_instructions=basis,
                                symmetrize_instructions=symmetrizer_instructions)
 
-        targets = data[:, -1].real
-        predictions = pipeline.predict(data)[0]
+        targets = data.y.real
+        predictions = np.concatenate([pipeline.predict(batch)[0] for batch in data.iter_batches(batch_size)])
         if predict:
             np.save(dest, predictions)
             return 0
@@ -466,7 +525,7 @@ def eval_driver(hdf5,
     else:
         if predict:
             raise Exception('Must provide a model to make predictions')
-        dev = data[:, -1].real
+        dev = data.y.real
         # predictions = load_sets(datafile, hdf5[1], hdf5[1], basis_key, cutoff)[:,-1].flatten()
         # targets = load_sets(datafile, hdf5[2], hdf5[2], basis_key, cutoff)[:,-1].flatten()
 
@@ -13,6 +13,7 @@ from neuralxc.datastructures.hdf5 import *
 from neuralxc.ml.utils import *
 from neuralxc.preprocessor import driver
 from neuralxc.utils import ConfigFile
+from neuralxc.utils.executor import config_executor
 
 from ..formatter import make_nested_absolute
 from .data import add_data_driver
@@ -104,7 +105,8 @@ def run_engine_driver(xyz, preprocessor, workdir='.tmp/'):
            pre['engine'].pop('application', 'siesta'),
            workdir=workdir,
            nworkers=pre.get('n_workers', 1),
-           kwargs=pre.get('engine', {}))
+           kwargs=pre.get('engine', {}),
+           executor=config_executor(pre))
     # shutil.move(workdir + '/results.traj', './results.traj')
     shutil.copy(workdir + '/results.traj', './results.traj')
     if workdir == '.tmp/':
@@ -205,11 +207,37 @@ def pre_driver(xyz, srcdir, preprocessor, dest='.tmp/'):
             pre.update({'preprocessor': basis_instr})
             open(preprocessor_path, 'w').write(json.dumps(pre.__dict__))
 
+        if 'hdf5' in dest and basis_instr.get('stream', False):
+            # Descriptors are written to file[system/method/density] system by system
+            with h5py.File(file, 'a') as f:
+                add_species(f, system, xyz)
+                preprocessor.fit(None)
+                preprocessor.transform_to_hdf5(f, system, method, basis_to_hash(basis_instr))
+                f[system].attrs.update({'species': preprocessor.species_string})
+            continue
+
+        storage = basis_instr.get('storage', None)
+        if 'hdf5' in dest and storage and storage.get('ragged', False):
+            # Descriptors are stored without padding (see RaggedDescriptors)
+            data = preprocessor.fit(None).transform_ragged()
+            with h5py.File(file, 'a') as f:
+                add_species(f, system, xyz)
+                add_density(basis_to_hash(basis_instr), f, data, system, method, True, storage=storage)
+                f[system].attrs.update({'species': preprocessor.species_string})
+            continue
+
         filename = os.path.join(workdir, basis_to_hash(basis_instr) + '.npy')
         data = preprocessor.fit_transform(None)
         np.save(filename, data)
         if 'hdf5' in dest:
-            add_data_driver(hdf5=file, system=system, method=method, density=filename, add=[], traj=xyz, override=True)
+            add_data_driver(hdf5=file,
+                            system=system,
+                            method=method,
+                            density=filename,
+                            add=[],
+                            traj=xyz,
+                            override=True,
+                            storage=storage)
 
             f = h5py.File(file)
             f[system].attrs.update({'species': preprocessor.species_string})
@@ -1,6 +1,7 @@
 import os
 
 import numpy as np
+import torch
 from sklearn.base import BaseEstimator, TransformerMixin
 from collections import Mapping
 
@@ -133,15 +134,50 @@ class SpeciesGrouper(BaseEstimator, TransformerMixin):
             X = X['data']
             made_dict = True
 
+        if hasattr(X, 'densities'):
+            # LazySets (see ml.utils.load_sets): descriptors are read set by set, ragged
+            # descriptors are grouped without going through the padded layout
+            features, targets = self._transform_sets(X, sys_species)
+        else:
+            features, targets = self._transform_array(X, sys_species)
+
+        if made_dict:
+            return {'data': (shrink(features), targets), 'basis_instructions': basis_instructions}
+        else:
+            return shrink(features), targets
+
+    def _vec_len(self, spec):
+        return self._attrs[spec]['n'] * sum([2 * l + 1 for l in range(self._attrs[spec]['l'])])
+
+    def _transform_sets(self, X, sys_species):
+        if not len(X.densities) == len(sys_species):
+            raise ValueError(
+                'Number of systems in X and len(sys_species) incompatible: n_sys: {}, len(sys_species): {}'.format(
+                    len(X.densities), len(sys_species)))
+
+        features = []
+        targets = []
+        for this_sys, this_species in enumerate(sys_species):
+            sys_X = X.subset(X.system == this_sys)
+            density = X.densities[this_sys]
+            if hasattr(density, 'group_species'):
+                vec_len = {spec: self._vec_len(spec) for spec in this_species}
+                features.append(density.group_species(sys_X.rows, this_species, vec_len))
+            else:
+                features.append(self._group_system(sys_X.take()[:, 1:-1], this_species))
+            targets.append(sys_X.y.real)
+        return features, targets
+
+    def _transform_array(self, X, sys_species):
         y = X[:, -1].real
         X = X[:, :-1]
 
         # First column should give system index
-        if not isinstance(y, np.ndarray):
+        if not isinstance(y, (np.ndarray, torch.Tensor)):
             y = self._y
 
         system = X[:, 0]
-        n_sys = (np.max(system) + 1).real
+        n_sys = int(system.max().real) + 1
 
         X = X[:, 1:]
 
@@ -153,34 +189,60 @@ class SpeciesGrouper(BaseEstimator, TransformerMixin):
                 'Number of systems in X and len(sys_species) incompatible: n_sys: {}, len(sys_species): {}'.format(
                     n_sys, len(sys_species)))
 
-        for this_sys, _ in enumerate(sys_species):
-            this_species = sys_species[this_sys]
-
-            X_sys = X[system == this_sys]
-            y_sys = y[system == this_sys]
-            feat_dict = {}
-
+        for this_sys, this_species in enumerate(sys_species):
+            rows = (system == this_sys).nonzero()
+            rows = rows[0] if isinstance(rows, tuple) else rows[:, 0]
+            # Rows of a system are usually contiguous, avoid copying them before grouping
+            if len(rows) and rows[-1] - rows[0] + 1 == len(rows):
+                rows = slice(int(rows[0]), int(rows[-1]) + 1)
+            features.append(self._group_system(X[rows], this_species))
+            targets.append(y[rows].clone() if isinstance(y, torch.Tensor) else y[rows].copy())
+        return features, targets
+
+    def _gather_index(self, this_species, vec_len):
+        """ Blocks of consecutive atoms of the same species inside a row of a
+        system with species this_species as {spec: [(first column, natoms), ...]}.
+        Computed once per system and reused for grouping and ungrouping, which
+        then only copy (reshaped) blocks instead of single atoms.
+        """
+        cache = self.__dict__.setdefault('_index_cache', {})
+        key = (tuple(this_species), tuple(sorted(vec_len.items())))
+        if not key in cache:
+            index = {}
             idx = 0
+            previous = None
             for spec in this_species:
-                if spec not in feat_dict:
-                    feat_dict[spec] = []
-
-                vec_len = self._attrs[spec]['n'] * sum([2 * l + 1 for l in range(self._attrs[spec]['l'])])
-                x_atm = X_sys[:, idx:idx + vec_len]
-                # print(x_atm.shape)
-                feat_dict[spec].append(x_atm)
-                idx += vec_len
-
-            for spec in feat_dict:
-                feat_dict[spec] = np.array(feat_dict[spec])
-                feat_dict[spec] = np.array(feat_dict[spec]).swapaxes(0, 1)
-            features.append(feat_dict)
-            targets.append(y_sys)
+                if spec == previous:
+                    start, n_atoms = index[spec][-1]
+                    index[spec][-1] = (start, n_atoms + 1)
+                else:
+                    index.setdefault(spec, []).append((idx, 1))
+                idx += vec_len[spec]
+                previous = spec
+            cache[key] = index
+        return cache[key]
+
+    def _group_system(self, X_sys, this_species):
+        vec_len = {spec: self._vec_len(spec) for spec in this_species}
+        index = self._gather_index(this_species, vec_len)
+        features = {}
+        for spec, blocks in index.items():
+            vec = vec_len[spec]
+            parts = [
+                X_sys[:, start:start + n_atoms * vec].reshape(len(X_sys), n_atoms, vec) for start, n_atoms in blocks
+            ]
+            if not isinstance(X_sys, torch.Tensor):
+                features[spec] = np.concatenate(parts, axis=1)
+            elif len(parts) == 1:
+                features[spec] = parts[0].contiguous()  # Much faster than torch.cat for a single block
+            else:
+                features[spec] = torch.cat(parts, 1)
+        return features
 
-        if made_dict:
-            return {'data': (shrink(features), targets), 'basis_instructions': basis_instructions}
-        else:
-            return shrink(features), targets
+    def forward(self, X):
+        """ Same as transform, torch tensors are grouped without converting them
+        """
+        return self.transform(X)
 
     def get_gradient(self, X):
         # Required by NXCPipeline
@@ -198,8 +260,8 @@ class SpeciesGrouper(BaseEstimator, TransformerMixin):
         max_vec_len = np.max([np.sum([feat[spec].shape[1]*feat[spec].shape[2] for spec in feat])\
                        for feat in features])
 
-        X = np.zeros([total_length, max_vec_len + 1])
-        y = np.zeros(total_length)
+        # Columns: system index, features, target
+        X = np.zeros([total_length, max_vec_len + 2])
 
         if not len(features) == len(targets) == len(sys_species):
             raise ValueError('number of systems inconsistent')
@@ -209,22 +271,19 @@ class SpeciesGrouper(BaseEstimator, TransformerMixin):
             this_species = sys_species[sysidx]
             this_len = len(tar)
             X[sys_loc:sys_loc + this_len, 0] = sysidx
-            unique_species = np.unique([char for char in this_species])
-            spec_loc = {spec: 0 for spec in unique_species}
-            idx = 1
-
-            for spec in this_species:
-                insert = feat[spec][:, spec_loc[spec], :]
-                #                 print(insert.shape)
-                #                 print(X[sys_loc:sys_loc+this_len,idx:idx+insert.shape[-1]].shape)
-                X[sys_loc:sys_loc + this_len, idx:idx + insert.shape[-1]] = insert
-                spec_loc[spec] += 1
-                idx += insert.shape[-1]
-
-            y[sys_loc:sys_loc + this_len] = tar
+            index = self._gather_index(this_species, {spec: feat[spec].shape[-1] for spec in this_species})
+            for spec, blocks in index.items():
+                vec = feat[spec].shape[-1]
+                atom = 0
+                for start, n_atoms in blocks:
+                    X[sys_loc:sys_loc + this_len, 1 + start:1 + start + n_atoms * vec] = \
+                        feat[spec][:, atom:atom + n_atoms].reshape(this_len, -1)
+                    atom += n_atoms
+
+            X[sys_loc:sys_loc + this_len, -1] = tar
             sys_loc += this_len
 
-        return np.concatenate([X, y.reshape(-1, 1)], axis=-1)
+        return X
 
 
 def shrink(data):
@@ -233,9 +292,15 @@ def shrink(data):
 
     for idx, key, dat in expand(data):
         dat = dat[0]
-        mask = ~np.all(dat == 0, axis=-1)
+        # (CPU) tensors share their memory with the array, only the mask is converted
+        values = dat.detach().numpy() if isinstance(dat, torch.Tensor) else dat
+        mask = ~np.all(values == 0, axis=-1)
+        if np.all(mask):
+            continue
         min_col = max(np.sum(mask, axis=-1))
         mask = (mask | (~mask * np.cumsum(~mask, axis=-1) + np.cumsum(mask, axis=-1)[:, -1].reshape(-1, 1) <= min_col))
+        if isinstance(dat, torch.Tensor):
+            mask = torch.from_numpy(mask)
 
         dat = dat[mask].reshape(len(dat), min_col, -1)
 
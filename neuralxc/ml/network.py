@@ -1,5 +1,9 @@
 """ Module that implements a Behler-Parinello type neural network
 """
+import copy
+import os
+import queue
+import threading
 
 import numpy as np
 import torch
@@ -20,9 +24,16 @@ class NetworkEstimator(BaseEstimator):
                  valid_size=0.2,
                  batch_size=0,
                  activation='sigmoid',
+                 pin_memory=False,
+                 prefetch=0,
+                 patience=0,
+                 checkpoint='',
+                 resume=False,
                  **kwargs):
         """ Estimator (scikit-learn) wrapper for the PyTorch based EnergyNetwork class which
-        implements a Behler-Parinello type neural network
+        implements a Behler-Parinello type neural network. Training data is loaded in
+        mini-batches of batch_size samples (see BatchLoader for pin_memory and prefetch).
+        See train_net for early stopping (patience) and checkpoints.
         """
         self.n_nodes = n_nodes
         self.n_layers = n_layers
@@ -34,6 +45,11 @@ class NetworkEstimator(BaseEstimator):
         self._network = None
         self.batch_size = batch_size
         self.activation = activation
+        self.pin_memory = pin_memory
+        self.prefetch = prefetch
+        self.patience = patience
+        self.checkpoint = checkpoint
+        self.resume = resume
         self.verbose = False
         self.fitted = False
 
@@ -47,6 +63,11 @@ class NetworkEstimator(BaseEstimator):
             'valid_size': self.valid_size,
             'batch_size': self.batch_size,
             'activation': self.activation,
+            'pin_memory': self.pin_memory,
+            'prefetch': self.prefetch,
+            'patience': self.patience,
+            'checkpoint': self.checkpoint,
+            'resume': self.resume,
         }
 
     def build_network(self):
@@ -73,7 +94,12 @@ class NetworkEstimator(BaseEstimator):
                             max_steps=self.max_steps,
                             b_=self.b,
                             train_valid_split=1 - self.valid_size,
-                            batch_size=self.batch_size)
+                            batch_size=self.batch_size,
+                            pin_memory=self.pin_memory,
+                            prefetch=self.prefetch,
+                            patience=self.patience,
+                            checkpoint=self.checkpoint,
+                            resume=self.resume)
         self.fitted = True
 
     def predict(self, X, *args, **kwargs):
@@ -89,6 +115,19 @@ class NetworkEstimator(BaseEstimator):
         predictions = self._network.predict(X[0])
         return predictions
 
+    def forward(self, X):
+        """ Energies predicted for X (dict or list of dicts of torch tensors) by the
+        underlying EnergyNetwork, keeps the graph for differentiation.
+        """
+        if self._network is None:
+            self.build_network()
+
+        if isinstance(X, tuple):
+            X = X[0]
+        if isinstance(X, list):
+            return [self._network(x) for x in X]
+        return self._network(X)
+
     def score(self, X, y=None, metric='mae'):
 
         if isinstance(X, tuple):
@@ -116,24 +155,65 @@ class NetworkEstimator(BaseEstimator):
         self.path = path
 
 
-def train_net(net, dataloader, dataloader_val=None, max_steps=10000, n_checkpoints=20, lr=1e-3, weight_decay=1e-7):
-    # net.train()
+def train_net(net,
+              dataloader,
+              dataloader_val=None,
+              max_steps=10000,
+              n_checkpoints=20,
+              lr=1e-3,
+              weight_decay=1e-7,
+              patience=0,
+              checkpoint='',
+              resume=False):
+    """ Trains net on the batches provided by dataloader. Every max_steps // n_checkpoints
+    epochs the learning rate is adapted and, if dataloader_val is given, the
+    validation loss evaluated. The weights with the lowest validation loss are
+    loaded into net once training ends.
+
+    Parameters
+    ----------
+    patience: int
+        Stop once the validation loss did not improve for this many evaluations
+        (0: never stop early)
+    checkpoint: str
+        After every evaluation, save model, optimizer and scheduler state to this
+        file ('': no checkpoints)
+    resume: bool
+        Continue training from checkpoint (if it exists)
+    """
+
+    check_point_every = max(max_steps // n_checkpoints, 1)
 
-    check_point_every = max_steps//n_checkpoints
-    
     loss_fn = torch.nn.MSELoss()
 
     optimizer = torch.optim.Adam(net.parameters(), lr=lr, weight_decay=weight_decay)
 
     MIN_RATE = 1e-7
-    scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer,
-                                                           'min',
-                                                           verbose=True,
-                                                           patience=10,
-                                                           min_lr=MIN_RATE)
+    scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, 'min', patience=10, min_lr=MIN_RATE)
+
+    state = {'epoch': 0, 'best_loss': np.inf, 'best_model': None, 'bad_evaluations': 0, 'finished': False}
+    if resume and checkpoint and os.path.isfile(checkpoint):
+        saved = torch.load(checkpoint)
+        net.load_state_dict(saved.pop('model'))
+        optimizer.load_state_dict(saved.pop('optimizer'))
+        scheduler.load_state_dict(saved.pop('scheduler'))
+        state.update(saved)
+        print('Resuming training from epoch {} ({})'.format(state['epoch'], checkpoint))
+
+    def save_checkpoint():
+        if checkpoint:
+            saved = dict(state,
+                         model=net.state_dict(),
+                         optimizer=optimizer.state_dict(),
+                         scheduler=scheduler.state_dict())
+            # Write to temporary file first, so that a killed job does not leave a corrupted checkpoint
+            torch.save(saved, checkpoint + '.tmp')
+            os.replace(checkpoint + '.tmp', checkpoint)
 
     max_epochs = max_steps
-    for epoch in range(max_epochs):
+    for epoch in range(state['epoch'], max_epochs):
+        if state['finished']:
+            break
         logs = {}
         epoch_loss = 0
         for data in dataloader:
@@ -150,22 +230,40 @@ def train_net(net, dataloader, dataloader_val=None, max_steps=10000, n_checkpoin
             logs['lr_{}'.format(i)] = float(param_group['lr'])
 
         if logs['lr_0'] <= MIN_RATE:
-            return net
+            state['finished'] = True
 
-        if epoch % check_point_every == 0:
+        elif epoch % check_point_every == 0:
             scheduler.step(epoch_loss / len(dataloader))
             val_loss = 0
             if dataloader_val is not None:
-                for data in dataloader_val:
-                    rho, energy = data
-                    result = net(rho)
-                    loss = loss_fn(result, energy)
-                    val_loss += loss.item()
+                with torch.no_grad():
+                    for data in dataloader_val:
+                        rho, energy = data
+                        result = net(rho)
+                        loss = loss_fn(result, energy)
+                        val_loss += loss.item()
                 logs['val loss'] = np.sqrt(val_loss / len(dataloader_val))
+                if logs['val loss'] < state['best_loss']:
+                    state['best_loss'] = float(logs['val loss'])
+                    state['best_model'] = copy.deepcopy(net.state_dict())
+                    state['bad_evaluations'] = 0
+                else:
+                    state['bad_evaluations'] += 1
             else:
                 logs['val loss'] = 0
             print('Epoch {} ||'.format(epoch), ' Training loss : {:.6f}'.format(logs['log loss']),
                   ' Validation loss : {:.6f}'.format(logs['val loss']), ' Learning rate: {}'.format(logs['lr_0']))
+            if patience > 0 and state['bad_evaluations'] >= patience:
+                print('Validation loss did not improve for {} evaluations, stopping early'.format(patience))
+                state['finished'] = True
+            state['epoch'] = epoch + 1
+            save_checkpoint()
+
+    if state['finished']:
+        save_checkpoint()
+    if state['best_model'] is not None:
+        print('Best validation loss: {:.6f}'.format(state['best_loss']))
+        net.load_state_dict(state['best_model'])
     return net
 
 
@@ -188,6 +286,107 @@ class Dataset(object):
         return len(self.energies)
 
 
+class BatchLoader(object):
+    def __init__(self, rho, energies, batch_size=0, shuffle=False, pin_memory=False, share_memory=False, prefetch=0):
+        """ Iterates over mini-batches (rho, energy) like a torch DataLoader over
+        Dataset(rho, energies). The features of every species are stored as one
+        contiguous tensor and batches are sliced (or, if shuffled, gathered) from
+        them as a whole instead of being collated sample by sample.
+
+        Parameters
+        ----------
+        rho: dict of np.ndarray or torch.Tensor
+            Features per species, first dimension runs over samples
+        energies: np.ndarray or torch.Tensor
+            Target energies
+        batch_size: int
+            Samples per batch (0: all samples in one batch)
+        shuffle: bool
+            Draw a new order of samples every epoch
+        pin_memory: bool
+            Keep tensors and batches in page-locked memory for faster copies to
+            the GPU (ignored if CUDA is not available)
+        share_memory: bool
+            Move tensors to shared memory, so that they can be used by other
+            processes without copying
+        prefetch: int
+            Number of batches prepared ahead in a background thread (0: no thread)
+        """
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.rho = {spec: self._store(rho[spec], share_memory) for spec in rho}
+        self.energies = self._store(energies, share_memory).reshape(-1, 1)
+        self.batch_size = batch_size if batch_size > 0 else max(len(self.energies), 1)
+        self.shuffle = shuffle
+        self.prefetch = prefetch
+
+    def _store(self, data, share_memory):
+        data = torch.as_tensor(data).contiguous()
+        if share_memory:
+            data.share_memory_()
+        if self.pin_memory:
+            data = data.pin_memory()
+        return data
+
+    def _take(self, data, index):
+        if isinstance(index, slice):
+            return data[index]
+        batch = torch.empty((len(index), ) + data.shape[1:], dtype=data.dtype, pin_memory=self.pin_memory)
+        return torch.index_select(data, 0, index, out=batch)
+
+    def _batches(self):
+        n_samples = len(self.energies)
+        order = torch.randperm(n_samples) if self.shuffle and self.batch_size < n_samples else None
+        for start in range(0, n_samples, self.batch_size):
+            index = slice(start, start + self.batch_size) if order is None else order[start:start + self.batch_size]
+            yield {spec: self._take(self.rho[spec], index) for spec in self.rho}, self._take(self.energies, index)
+
+    def _prefetched_batches(self):
+        batches = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        end = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for batch in self._batches():
+                    if not put(batch):
+                        return
+                put(end)
+            except Exception as exception:
+                put(exception)
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch = batches.get()
+                if batch is end:
+                    return
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            # Also stops the thread if iteration is abandoned early
+            stop.set()
+            thread.join()
+
+    def __iter__(self):
+        if self.prefetch > 0:
+            return self._prefetched_batches()
+        return self._batches()
+
+    def __len__(self):
+        return -(-len(self.energies) // self.batch_size)
+
+
 class EnergyNetwork(torch.nn.Module):
     def __init__(self, n_nodes, n_layers, activation):
         super(EnergyNetwork, self).__init__()
@@ -199,53 +398,80 @@ class EnergyNetwork(torch.nn.Module):
             print('Activation unknown, defaulting to GELU')
             self.activation = torch.nn.GELU()
 
-    def train(self, X, y, step_size=0.01, max_steps=50001, b_=0, verbose=True, train_valid_split=0.8, batch_size=0):
+    def build_species_nets(self, X):
+        """ Create one (untrained) network per species in X with input size given
+        by the number of features
+        """
+        species_nets = {}
+        for spec in X:
+            if self.n_layers < 1:
+                species_nets[spec] = torch.nn.Linear(X[spec].shape[-1], 1)
+            else:
+                species_nets[spec] = torch.nn.Sequential(
+                    *([torch.nn.Linear(X[spec].shape[-1], self.n_nodes)] +\
+                    (self.n_layers-1)* [self.activation,torch.nn.Linear(self.n_nodes, self.n_nodes)] +\
+                    [self.activation, torch.nn.Linear(self.n_nodes,1)])
+                )
+        self.species_nets = torch.nn.ModuleDict(species_nets)
+
+    def train(self,
+              X,
+              y,
+              step_size=0.01,
+              max_steps=50001,
+              b_=0,
+              verbose=True,
+              train_valid_split=0.8,
+              batch_size=0,
+              pin_memory=False,
+              prefetch=0,
+              patience=0,
+              checkpoint='',
+              resume=False):
 
         if not hasattr(self, 'species_nets'):
-            species_nets = {}
-            for spec in X:
-                if self.n_layers < 1:
-                    species_nets[spec] = torch.nn.Linear(X[spec].shape[-1], 1)
-                else:
-                    species_nets[spec] = torch.nn.Sequential(
-                        *([torch.nn.Linear(X[spec].shape[-1], self.n_nodes)] +\
-                        (self.n_layers-1)* [self.activation,torch.nn.Linear(self.n_nodes, self.n_nodes)] +\
-                        [self.activation, torch.nn.Linear(self.n_nodes,1)])
-                    )
-            self.species_nets = torch.nn.ModuleDict(species_nets)
+            self.build_species_nets(X)
             print(self.species_nets)
         if train_valid_split < 1.0:
             indices = np.arange(len(y))
-            np.random.shuffle(indices)
+            # Resumed training has to see the same validation set
+            (np.random.RandomState(0) if checkpoint else np.random).shuffle(indices)
             ti = int(len(indices) * train_valid_split)
             train_idx = indices[:ti]
             val_idx = indices[ti:]
-            dataset_val = Dataset({spec: X[spec][val_idx] for spec in X}, y[val_idx])
-            dataloader_val = torch.utils.data.DataLoader(dataset_val, batch_size=len(dataset_val), shuffle=False)
+            dataloader_val = BatchLoader({spec: X[spec][val_idx] for spec in X}, y[val_idx], pin_memory=pin_memory)
         else:
             train_idx = np.arange(len(y))
             dataloader_val = None
 
-        dataset_train = Dataset({spec: X[spec][train_idx] for spec in X}, y[train_idx])
-        if batch_size == 0:
-            batch_size = len(dataset_train)
-        dataloader_train = torch.utils.data.DataLoader(dataset_train, batch_size=batch_size, shuffle=True)
-
-        train_net(self, dataloader_train, dataloader_val, max_steps=max_steps, lr=step_size, weight_decay=b_)
+        # Without validation set all samples are used in order, no need to copy them
+        if dataloader_val is None:
+            X_train, y_train = X, y
+        else:
+            X_train, y_train = {spec: X[spec][train_idx] for spec in X}, y[train_idx]
+        dataloader_train = BatchLoader(X_train,
+                                       y_train,
+                                       batch_size=batch_size,
+                                       shuffle=True,
+                                       pin_memory=pin_memory,
+                                       prefetch=prefetch)
+
+        train_net(self,
+                  dataloader_train,
+                  dataloader_val,
+                  max_steps=max_steps,
+                  lr=step_size,
+                  weight_decay=b_,
+                  patience=patience,
+                  checkpoint=checkpoint,
+                  resume=resume)
 
     def predict(self, X):
-        data_len = 0
-        for spec in X:
-            data_len = max([data_len, len(X[spec])])
-
-        y = np.zeros(data_len)
-        dataset = Dataset(X, y)
-        dataloader = torch.utils.data.DataLoader(dataset, batch_size=data_len, shuffle=False)
-
-        for data in dataloader:
-            rho, energy = data
+        # One batch containing all samples, no need to collate them sample by sample
+        rho = {spec: torch.as_tensor(X[spec]) for spec in X}
+        with torch.no_grad():
             result = self.forward(rho)
-        return [result.detach().numpy()]
+        return [result.numpy()]
 
     def forward(self, input):
         output = 0
@@ -99,7 +99,8 @@ class NXCPipeline(Pipeline):
 
     def to_torch(self):
         for step_idx, _ in enumerate(self.steps):
-            self.steps[step_idx][1].to_torch()
+            if hasattr(self.steps[step_idx][1], 'to_torch'):
+                self.steps[step_idx][1].to_torch()
 
     def forward(self, X):
         for steps in self.steps:
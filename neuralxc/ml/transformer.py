@@ -5,6 +5,8 @@ A typical dataset looks like this:
 [{'spec1': features,'spec2' : features}, {'spec1': features, 'spec3': features}]
 where the outer list runs over independent systems.
 """
+from functools import wraps
+
 import numpy as np
 import torch
 from sklearn.feature_selection import VarianceThreshold
@@ -16,19 +18,22 @@ from ..formatter import atomic_shape, system_shape
 TorchModule = torch.nn.Module
 
 
-def convert_torch_wrapper(func):
-    # print('Wrapped function')
-    def wrapped_func(X, *args, **kwargs):
-        made_tensor = False
-        if isinstance(X, np.ndarray):
-            X = torch.from_numpy(X)
-            made_tensor = True
-        Y = func(X, *args, **kwargs)
-        if made_tensor:
-            return Y.detach().numpy()
-        else:
-            return Y
+def convert_torch_wrapper(func, arg=0):
+    """ Wrap func, which operates on torch tensors, so that it also accepts a
+    np.ndarray as positional argument arg (and returns one in that case).
+    Functions that are already wrapped are returned as they are.
+    """
+    if getattr(func, 'converts_numpy', False):
+        return func
 
+    @wraps(func)
+    def wrapped_func(*args, **kwargs):
+        if not isinstance(args[arg], np.ndarray):
+            return func(*args, **kwargs)
+        args = args[:arg] + (torch.from_numpy(args[arg]), ) + args[arg + 1:]
+        return func(*args, **kwargs).detach().numpy()
+
+    wrapped_func.converts_numpy = True
     return wrapped_func
 
 
@@ -41,20 +46,18 @@ class GroupedTransformer(ABC):
 
         TorchModule.__init__(self)
         self.is_fit = False
-        self.is_wrapped = False
         super().__init__(*args, **kwargs)
 
+    def __init_subclass__(cls, **kwargs):
+        # numpy/torch dispatch of torch_transform is fixed once per class
+        super().__init_subclass__(**kwargs)
+        if 'torch_transform' in cls.__dict__:
+            cls.torch_transform = convert_torch_wrapper(cls.__dict__['torch_transform'], arg=1)
+
     def transform(self, X, y=None, **fit_params):
-        if not hasattr(self, 'is_wrapped'):
-            self.is_wrapped = False
-        if fit_params.get('wrap_torch', True) and hasattr(self, '_spec_dict'):
-            for spec in self._spec_dict:
-                trafo = self._spec_dict[spec]
-                #         if not hasattr(self._spec_dict[spec], 'is_wrapped'):
-                #             self._spec_dict[spec].is_wrapped = False
-                #         if not self._spec_dict[spec].is_wrapped:
-                trafo.torch_transform = convert_torch_wrapper(trafo.torch_transform)
-        #             self._spec_dict[spec].is_wrapped = True
+        """ Transform grouped data. numpy arrays are returned as numpy arrays, torch
+        tensors pass through torch_transform without any conversion (see forward).
+        """
         was_tuple = False
         if isinstance(X, tuple):
             y = X[1]
@@ -88,6 +91,7 @@ class GroupedTransformer(ABC):
             return self
         else:
             self.is_fit = True
+            self._torch_cache = {}
             if isinstance(X, tuple):
                 X = X[0]
 
@@ -121,11 +125,23 @@ class GroupedTransformer(ABC):
         return self.fit(X).transform(X)
 
     def forward(self, X):
-        return self.transform(X, wrap_torch=False)
+        return self.transform(X)
 
     def to_torch(self):
-        # TorchModule.__init__(self)
-        pass
+        """ Build the tensors used by torch_transform ahead of the first forward call
+        """
+        for trafo in getattr(self, '_spec_dict', {}).values():
+            trafo._torch_params()
+
+    def _torch_params(self):
+        """ Fitted attributes as tensors, created once and cached
+        """
+        if not getattr(self, '_torch_cache', None):
+            # Models pickled by earlier versions carry (nested) numpy wrappers
+            # as instance attributes that shadow torch_transform
+            self.__dict__.pop('torch_transform', None)
+            self._torch_cache = self._make_torch_params()
+        return self._torch_cache
 
 
 class GroupedVarianceThreshold(GroupedTransformer, VarianceThreshold, TorchModule):
@@ -152,8 +168,10 @@ class GroupedVarianceThreshold(GroupedTransformer, VarianceThreshold, TorchModul
         X_shape = X.size()
         if not len(X_shape) == 2:
             X = X.view(-1, X_shape[-1])
-        support = torch.from_numpy(self.get_support()).bool()
-        return X[:, support]
+        return X.index_select(-1, self._torch_params()['support'])
+
+    def _make_torch_params(self):
+        return {'support': torch.from_numpy(np.flatnonzero(self.get_support()))}
 
 
 class GroupedStandardScaler(GroupedTransformer, StandardScaler, TorchModule):
@@ -174,9 +192,13 @@ class GroupedStandardScaler(GroupedTransformer, StandardScaler, TorchModule):
         X_shape = X.size()
         if not len(X_shape) == 2:
             X = X.view(-1, X_shape[-1])
-        X = (X - torch.from_numpy(self.mean_)) / torch.sqrt(torch.from_numpy(self.var_))
+        params = self._torch_params()
+        X = (X - params['mean']) / params['std']
         return X
 
+    def _make_torch_params(self):
+        return {'mean': torch.from_numpy(self.mean_), 'std': torch.sqrt(torch.from_numpy(self.var_))}
+
     def transform(self, X, y=None, **fit_params):
         return GroupedTransformer.transform(self, X, y, **fit_params)
 
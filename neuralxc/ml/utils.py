@@ -1,3 +1,5 @@
+import copy
+
 import h5py
 import json
 import numpy as np
@@ -8,6 +10,7 @@ from sklearn.model_selection import GridSearchCV
 from sklearn.neighbors import NearestNeighbors
 from sklearn.pipeline import Pipeline
 
+import neuralxc.datastructures.hdf5
 from neuralxc.datastructures.hdf5 import *
 from neuralxc.formatter import SpeciesGrouper, atomic_shape
 from neuralxc.ml.network import NetworkEstimator as NetworkWrapper
@@ -16,12 +19,13 @@ from neuralxc.ml.transformer import (GroupedStandardScaler, GroupedVarianceThres
 from neuralxc.preprocessor import Preprocessor
 from neuralxc.symmetrizer import symmetrizer_factory
 from neuralxc.utils import ConfigFile
+from neuralxc.utils.executor import config_executor
 
 from ..formatter import atomic_shape, expand
 
 __all__ = [
-    'E_from_atoms', 'find_attr_in_tree', 'load_sets', 'get_default_pipeline', 'get_grid_cv', 'get_basis_grid',
-    'get_preprocessor', 'SampleSelector'
+    'E_from_atoms', 'find_attr_in_tree', 'load_sets', 'LazySets', 'get_default_pipeline', 'get_grid_cv',
+    'get_basis_grid', 'get_preprocessor', 'SampleSelector'
 ]
 
 
@@ -84,7 +88,7 @@ def find_attr_in_tree(file, tree, attr):
             return file[subtree].attrs[attr]
 
 
-def load_sets(datafile, baseline, reference, basis_key='', percentile_cutoff=0):
+def load_sets(datafile, baseline, reference, basis_key='', percentile_cutoff=0, lazy=False):
     """
     Load multiple datasets from hdf5 file
 
@@ -106,66 +110,134 @@ def load_sets(datafile, baseline, reference, basis_key='', percentile_cutoff=0):
     percentile_cutoff: float
         Cutoff this percentage of extreme (in the sense of target value)
         datapoints. Use to remove outliers
-    """
-    if not isinstance(baseline, list):
-        baseline = [baseline]
 
-    if not isinstance(reference, list):
-        reference = [reference]
+    lazy: bool
+        Return a LazySets object that reads descriptors from datafile only
+        when rows are accessed instead of a numpy array
 
-    if not isinstance(percentile_cutoff, list):
-        percentile_cutoff = [percentile_cutoff] * len(baseline)
-
-    Xs = []
-    ys = []
-    max_width = 0
+    Returns
+    -------
+    np.ndarray or LazySets (nsamples, max. nfeatures + 2)
+        Columns: system index, features (zero-padded), target
+    """
+    data = LazySets(datafile, baseline, reference, basis_key, percentile_cutoff)
+    if lazy:
+        return data
+    return data.take()
+
+
+class LazySets():
+    def __init__(self, datafile, baseline, reference, basis_key='', percentile_cutoff=0):
+        """ Out-of-core version of the array returned by load_sets. Only
+        targets and the row layout are kept in memory, descriptors are read from the
+        (chunked) hdf5 datasets when rows are accessed, e.g. in mini-batches with
+        iter_batches. Views on a selection of rows (samples, shuffling) are
+        created with subset without reading any descriptors.
+
+        Parameters
+        ----------
+        see load_sets
+        """
+        if not isinstance(baseline, list):
+            baseline = [baseline]
+
+        if not isinstance(reference, list):
+            reference = [reference]
+
+        if not isinstance(percentile_cutoff, list):
+            percentile_cutoff = [percentile_cutoff] * len(baseline)
+
+        self.densities = []
+        system = []
+        rows = []
+        targets = []
+        for sysidx, (bl, ref, perc) in enumerate(zip(baseline, reference, percentile_cutoff)):
+            density = None
+            if basis_key != '':
+                density = neuralxc.datastructures.hdf5.read_density(datafile, bl + '/density/' + basis_key)
+            tar, filter = load_targets(datafile, bl, ref, perc, n_samples=None if density is None else len(density))
+            self.densities.append(density)
+            rows.append(np.arange(len(filter))[filter])
+            system.append(np.full(len(rows[-1]), sysidx))
+            targets.append(tar)
+
+        # Per row: system index, row inside of hdf5 dataset and target
+        self.system = np.concatenate(system)
+        self.rows = np.concatenate(rows)
+        self.y = np.concatenate(targets)
+        self.width = max([0 if d is None else d.shape[1] for d in self.densities]) + 2
+
+    def __len__(self):
+        return len(self.y)
+
+    @property
+    def shape(self):
+        return (len(self), self.width)
+
+    def subset(self, index):
+        """ View on rows index (slice, boolean mask or integer array), targets are copied
+        """
+        view = copy.copy(self)
+        view.system = self.system[index]
+        view.rows = self.rows[index]
+        view.y = self.y[index].copy()
+        return view
+
+    def take(self, index=slice(None)):
+        """ Read rows index into array with columns system index, features, target
+        """
+        system = self.system[index]
+        rows = self.rows[index]
+        data = np.zeros([len(system), self.width])
+        data[:, 0] = system
+        data[:, -1] = self.y[index]
+        for sysidx, density in enumerate(self.densities):
+            if density is None:
+                continue
+            selection = np.where(system == sysidx)[0]
+            if not len(selection):
+                continue
+            # h5py requires increasing indices, dense selections are read as one slab
+            unique_rows, inverse = np.unique(rows[selection], return_inverse=True)
+            if len(unique_rows) >= (unique_rows[-1] - unique_rows[0] + 1) / 4:
+                block = density[unique_rows[0]:unique_rows[-1] + 1][unique_rows - unique_rows[0]]
+            else:
+                block = density[unique_rows]
+            data[selection, 1:1 + density.shape[1]] = block[inverse]
+        return data
 
-    for sysidx, (bl, ref, perc) in enumerate(zip(baseline, reference, percentile_cutoff)):
-        X, y =\
-            load_data(datafile, bl, ref, basis_key, perc)
-        X = np.concatenate([np.array([sysidx] * len(X)).reshape(-1, 1), X], axis=1)
-        max_width = max(max_width, X.shape[1])
-        Xs.append(X)
-        ys.append(y)
+    def iter_batches(self, batch_size):
+        """ Yield consecutive blocks of at most batch_size rows as arrays (see take)
+        """
+        if batch_size <= 0:
+            batch_size = max(len(self), 1)
+        for start in range(0, len(self), batch_size):
+            yield self.take(slice(start, start + batch_size))
 
-    #pad datasets
-    if len(Xs) > 1:
-        for i, X in enumerate(Xs):
-            if X.shape[1] < max_width:
-                Xs[i] = np.concatenate([X, np.zeros([len(X), max_width - X.shape[1]])], axis=1)
+    def __getitem__(self, index):
+        if isinstance(index, tuple):
+            return self.take(index[0])[(slice(None), ) + index[1:]]
+        return self.take(index)
 
-    X = np.concatenate(Xs, axis=0)
-    y = np.concatenate(ys, axis=0)
-    data = np.concatenate([X, y.reshape(-1, 1)], axis=1)
-    return data
+    def __array__(self, dtype=None, copy=None):
+        data = self.take()
+        return data if dtype is None else data.astype(dtype)
 
 
-def load_data(datafile, baseline, reference, basis_key, percentile_cutoff=0.0, E0=None):
+def load_targets(datafile, baseline, reference, percentile_cutoff=0.0, E0=None, n_samples=None):
     """
-    Load data from hdf5 file
+    Load targets (reference - baseline energy) from hdf5 file and determine which
+    samples remain after applying percentile_cutoff, see load_data.
 
     Parameters
     ----------
+    n_samples: int
+        Number of samples if no energies are stored for baseline (targets are zero)
 
-    datafile: h5py.File
-        File containing data
-
-    baseline: str
-        Group containing baseline datasets including energies and densities
-
-    reference: str
-        Group containing reference dataset (only energy)
-
-    basis_key: str
-        Hash to identify basis
-
-    percentile_cutoff: float
-        Cutoff this percentage of extreme (in the sense of target value)
-        datapoints. Use to remove outliers
-
-    E0 : float (default: None):
-        provide a energy value to subtract from the targets.
-        If None tries to find this value as an attribute inside datafile
+    Returns
+    -------
+    tar, filter: np.ndarray, np.ndarray bool
+        Filtered targets and mask of selected samples
     """
     no_energy = False
     if baseline + '/energy' in datafile:
@@ -193,12 +265,8 @@ def load_data(datafile, baseline, reference, basis_key, percentile_cutoff=0.0, E
     tar = (data_ref[:] - E0_ref) - (data_base[:] - E0_base)
     tar = tar.real
 
-    if basis_key == '':
-        data_base = np.zeros([len(tar), 0])
-    else:
-        data_base = datafile[baseline + '/density/' + basis_key][:, :]
     if no_energy:
-        tar = np.zeros(len(data_base))
+        tar = np.zeros(len(tar) if n_samples is None else n_samples)
 
     if percentile_cutoff > 0:
         lim1 = np.percentile(tar, percentile_cutoff * 100)
@@ -206,10 +274,49 @@ def load_data(datafile, baseline, reference, basis_key, percentile_cutoff=0.0, E
         min_lim, max_lim = min(lim1, lim2), max(lim1, lim2)
         filter = (tar > min_lim) & (tar < max_lim)
     else:
-        filter = [True] * len(tar)
+        filter = np.ones(len(tar), dtype=bool)
+
+    return tar[filter], filter
+
+
+def load_data(datafile, baseline, reference, basis_key, percentile_cutoff=0.0, E0=None):
+    """
+    Load data from hdf5 file
+
+    Parameters
+    ----------
+
+    datafile: h5py.File
+        File containing data
+
+    baseline: str
+        Group containing baseline datasets including energies and densities
+
+    reference: str
+        Group containing reference dataset (only energy)
+
+    basis_key: str
+        Hash to identify basis
+
+    percentile_cutoff: float
+        Cutoff this percentage of extreme (in the sense of target value)
+        datapoints. Use to remove outliers
+
+    E0 : float (default: None):
+        provide a energy value to subtract from the targets.
+        If None tries to find this value as an attribute inside datafile
+    """
+    if basis_key == '':
+        n_samples = None
+    else:
+        density = neuralxc.datastructures.hdf5.read_density(datafile, baseline + '/density/' + basis_key)
+        n_samples = len(density)
+    tar, filter = load_targets(datafile, baseline, reference, percentile_cutoff, E0, n_samples)
 
-    data_base = data_base[filter]
-    tar = tar[filter]
+    if basis_key == '':
+        data_base = np.zeros([len(tar), 0])
+    else:
+        data_base = density[:][filter]
     return data_base, tar
 
 
@@ -364,7 +471,11 @@ def get_preprocessor(pre, atoms, src_path):
 
     basis = {spec: {'n': 1, 'l': 1, 'r_o': 1} for spec in species}
     basis.update(pre['preprocessor'])
-    preprocessor = Preprocessor(basis, src_path, atoms, num_workers=pre.get('n_workers', 1))
+    preprocessor = Preprocessor(basis,
+                                src_path,
+                                atoms,
+                                num_workers=pre.get('n_workers', 1),
+                                executor=config_executor(pre))
     return preprocessor
 
 
@@ -11,9 +11,9 @@ import os
 import numpy as np
 from ase import Atoms
 from ase.io import write
-from dask.distributed import Client, LocalCluster
 
 from neuralxc.engines import Engine
+from neuralxc.utils.executor import get_executor
 
 # def in_private_dir(method):
 #     def wrapper_private_dir(dir, *args, **kwargs):
@@ -28,23 +28,33 @@ from neuralxc.engines import Engine
 
 
 def calculate_system(dir, atoms, app, kwargs):
+    """ Run engine for atoms in dir. The working directory of the (possibly shared
+    and reused) worker is restored afterwards.
+    """
+    cwd = os.getcwd()
     try:
-        os.chdir(dir)
-    except FileNotFoundError:
-        os.mkdir(dir)
-        os.chdir(dir)
-    eng = Engine(app, **kwargs)
-    atoms = eng.compute(atoms)
+        try:
+            os.chdir(dir)
+        except FileNotFoundError:
+            os.mkdir(dir)
+            os.chdir(dir)
+        eng = Engine(app, **kwargs)
+        atoms = eng.compute(atoms)
+    finally:
+        os.chdir(cwd)
     return atoms
 
 
-def mbe_driver(atoms, app, workdir, kwargs, nworkers):
-    """ Many-body expansion"""
+def mbe_driver(atoms, app, workdir, kwargs, nworkers, executor=None):
+    """ Many-body expansion, all subsystem levels are computed with the same executor"""
 
     building_block = kwargs.get('mbe_block', 'OHH')
     n_block = len(building_block)
 
-    results = calculate_distributed(atoms, app, workdir, kwargs, nworkers)
+    if executor is None:
+        executor = get_executor(n_workers=nworkers)
+
+    results = calculate_distributed(atoms, app, workdir, kwargs, nworkers, executor)
     species = [a.get_chemical_symbols() for a in atoms]
     n_mol = int(len(species[0]) / n_block)
     for s in species:
@@ -70,7 +80,8 @@ def mbe_driver(atoms, app, workdir, kwargs, nworkers):
             os.mkdir(mbe_root + '/mbe_{}'.format(n))
         except FileExistsError:
             pass
-        lower_results.append(calculate_distributed(new_atoms, app, mbe_root + '/mbe_{}'.format(n), kwargs, nworkers))
+        lower_results.append(
+            calculate_distributed(new_atoms, app, mbe_root + '/mbe_{}'.format(n), kwargs, nworkers, executor))
 
     etot = np.array([a.get_potential_energy() for a in results])
     for i, lr in enumerate(lower_results[::-1]):
@@ -86,29 +97,29 @@ def mbe_driver(atoms, app, workdir, kwargs, nworkers):
     return results
 
 
-def calculate_distributed(atoms, app, workdir, kwargs, n_workers=-1):
-
+def calculate_distributed(atoms, app, workdir, kwargs, n_workers=-1, executor=None):
+    """ Run engine for every structure in atoms, in workdir/<index>. If no executor
+    is provided, the shared executor for n_workers (see utils.executor) is used.
+    Engines change into their working directory, so executors whose workers
+    share the working directory (threads) can only be used with a single worker.
+    """
     cwd = os.getcwd()
-    if n_workers > 1:
-        print('Calculating {} systems on'.format(len(atoms)))
-        cluster = LocalCluster(n_workers=n_workers, threads_per_worker=1)
-        print(cluster)
-        client = Client(cluster)
-        my_map = client.map
-        get_result = lambda x: x.result()
-    else:
-        my_map = map
-        get_result = lambda x: x
-
-    futures = my_map(calculate_system, [os.path.join(workdir, str(i)) for i, _ in enumerate(atoms)], atoms,
-                     [app] * len(atoms), [kwargs] * len(atoms))
-
-    results = [get_result(f) for f in futures]
+    if executor is None:
+        executor = get_executor(n_workers=n_workers)
+    if executor.n_workers > 1 and executor.shares_cwd:
+        raise ValueError('Executor {} runs engines in a shared working directory, '
+                         'use "process" or "dask" for n_workers > 1'.format(executor._registry_name))
+    if executor.n_workers > 1:
+        print('Calculating {} systems on {} workers'.format(len(atoms), executor.n_workers))
+
+    results = list(
+        executor.map(calculate_system, [os.path.join(workdir, str(i)) for i, _ in enumerate(atoms)], atoms,
+                     [app] * len(atoms), [kwargs] * len(atoms)))
     os.chdir(cwd)
     return results
 
 
-def driver(atoms, app, workdir, nworkers, kwargs):
+def driver(atoms, app, workdir, nworkers, kwargs, executor=None):
     """
     Applies app (Engine) across dataset of structures.
 
@@ -122,6 +133,9 @@ def driver(atoms, app, workdir, nworkers, kwargs):
         Name of work directory
     nworkers, int
         Number of workers for Dask cluster
+    executor, BaseExecutor
+        Executor (see ../utils/executor.py), if None the shared Dask executor
+        for nworkers is used
 
     Returns
     --------
@@ -134,9 +148,9 @@ def driver(atoms, app, workdir, nworkers, kwargs):
     dir = os.path.abspath(workdir)
     # results = calculate_distributed(atoms, app, dir, kwargs, nworkers)
     if kwargs.get('mbe', False):
-        results = mbe_driver(atoms, app, dir, kwargs, nworkers)
+        results = mbe_driver(atoms, app, dir, kwargs, nworkers, executor)
     else:
-        results = calculate_distributed(atoms, app, dir, kwargs, nworkers)
+        results = calculate_distributed(atoms, app, dir, kwargs, nworkers, executor)
     results_path = os.path.join(dir, 'results.traj')
     write(results_path, results)
     return results
@@ -6,29 +6,37 @@ into projected descriptors used to fit NeuralXC models. Part of training pipelin
 relevant for deployed models.
 
 """
+import hashlib
+import json
 import os
+import threading
 from os.path import join as pjoin
 
 import numpy as np
-from dask.distributed import Client
 from sklearn.base import BaseEstimator, TransformerMixin
 
 from neuralxc.constants import Bohr
 from neuralxc.projector import DensityProjector
+from neuralxc.utils.cache import LRUCache
 from neuralxc.utils.density_getter import density_getter_factory
+from neuralxc.utils.executor import get_executor
+
+_worker_pool = threading.local()
 
 
 class Preprocessor(TransformerMixin, BaseEstimator):
-    def __init__(self, basis_instructions, src_path, atoms, target_path='', num_workers=1):
+    def __init__(self, basis_instructions, src_path, atoms, target_path='', num_workers=1, executor=None):
         """
         Following basis_instructions, applies a suitable DensityProjector to electron
-        densities stored to disk
+        densities stored to disk. Systems are projected with executor (see
+        utils/executor.py), if None the shared Dask executor for num_workers is used.
         """
         self.basis_instructions = basis_instructions
         self.src_path = src_path
         self.atoms = atoms
         self.computed_basis = {}
         self.num_workers = num_workers
+        self.executor = executor
 
     def fit(self, X=None, y=None, **kwargs):
         self.client = kwargs.get('client', None)
@@ -38,22 +46,145 @@ class Preprocessor(TransformerMixin, BaseEstimator):
         basis_rep = self.get_basis_rep()
         self.data = basis_rep
         self.computed_basis = self.basis_instructions
+
+        #Find padded width of data
+        width = {}
+        for dat, atoms in zip(self.data, self.atoms):
+            width[''.join(self.get_chemical_symbols(atoms))] = len(dat)
+        paddedwidth, paddedoffset = self.get_padding(width)
+
+        padded_data = np.zeros([len(self.data), paddedwidth])
+
+        for lidx, (dat, atoms) in enumerate(zip(self.data, self.atoms)):
+            syskey = ''.join(self.get_chemical_symbols(atoms))
+            padded_data[lidx, paddedoffset[syskey]:paddedoffset[syskey] + len(dat)] = dat
+
+        data = padded_data
+        if isinstance(X, list) or isinstance(X, np.ndarray):
+            data = data[X]
+        return data
+
+    def transform_ragged(self):
+        """ Same as transform, but descriptors are returned without padding
+        (see datastructures.hdf5.RaggedDescriptors)
+        """
+        from neuralxc.datastructures.hdf5 import RaggedDescriptors
+        self.data = self.get_basis_rep()
+        self.computed_basis = self.basis_instructions
+
+        syskeys = [''.join(self.get_chemical_symbols(atoms)) for atoms in self.atoms]
+        width = {}
+        for dat, syskey in zip(self.data, syskeys):
+            width[syskey] = len(dat)
+        paddedwidth, paddedoffset = self.get_padding(width)
+        return RaggedDescriptors.from_rows(self.data, syskeys, paddedoffset, paddedwidth)
+
+    def transform_to_hdf5(self, file, system, method, key):
+        """ Same as transform, but instead of collecting all projections in memory
+        every system is padded and appended to the resizable dataset
+        file[system/method/density/key] as soon as it has been projected.
+        If the dataset was left incomplete (e.g. after a crash), the calculation
+        is resumed from the last system written. Chunking, compression and dtype
+        of the dataset are set by basis_instructions['storage'] (see
+        datastructures.hdf5.storage_options), with storage['ragged'] descriptors
+        are stored without padding (see datastructures.hdf5.RaggedDescriptors).
+
+        Parameters
+        ----------
+        file: hdf5 file handle
+            File to add data to
+        system: str
+            System label defining first part of group
+        method: str
+            Method label defining second part of group
+        key: str
+            Name of dataset (usually basis_to_hash(basis_instructions))
+
+        Returns
+        -------
+        h5py.Dataset or RaggedDescriptors
+        """
+        from neuralxc.datastructures.hdf5 import (RaggedDescriptors, is_ragged, storage_options)
+        self.set_chemical_symbols()
+        self.computed_basis = self.basis_instructions
+        syskeys = [''.join(self.get_chemical_symbols(atoms)) for atoms in self.atoms]
+
+        first = {}
+        for idx, syskey in enumerate(syskeys):
+            first.setdefault(syskey, idx)
+
+        storage = self.basis_instructions.get('storage', None)
+        ragged = bool(storage and storage.get('ragged', False))
+
+        group = file.require_group('/'.join([system, method, 'density']))
+        n_done = 0
+        first_data = {}
+        if key in group:
+            dataset = group[key]
+            if is_ragged(dataset):
+                dataset = RaggedDescriptors.read(dataset)
+                resumable = ragged
+            else:
+                resumable = not ragged and dataset.maxshape[0] is None
+            # Number of descriptors for every kind of system (defining padded width and offsets)
+            # is stored with the dataset, resuming does not project any finished system again
+            width = json.loads(dataset.attrs.get('widths', '{}'))
+            if resumable and list(width) == list(first) and dataset.attrs.get('n_systems', -1) == len(self.atoms) \
+                    and dataset.attrs['n_done'] < len(self.atoms):
+                paddedwidth, paddedoffset = self.get_padding(width)
+                if dataset.shape[1] == paddedwidth:
+                    n_done = int(dataset.attrs['n_done'])
+            if n_done == 0:
+                del group[key]
+        if n_done == 0:
+            # Padded width is determined by the first system of every kind
+            first_data = dict(zip(first.values(), self.get_basis_rep(list(first.values()))))
+            width = {syskey: len(first_data[idx]) for syskey, idx in first.items()}
+            paddedwidth, paddedoffset = self.get_padding(width)
+            if ragged:
+                dataset = RaggedDescriptors.create(group, key, paddedoffset, paddedwidth, storage)
+            else:
+                options = {'dtype': np.float64, 'chunks': True}
+                options.update(storage_options(storage, paddedwidth))
+                dataset = group.create_dataset(key, shape=(0, paddedwidth), maxshape=(None, paddedwidth), **options)
+            dataset.attrs.update({'n_systems': len(self.atoms), 'n_done': 0, 'widths': json.dumps(width)})
+        if ragged:
+            dataset.resize(n_done)
+        else:
+            dataset.resize(n_done, axis=0)
+
+        todo = [idx for idx in range(n_done, len(self.atoms)) if not idx in first_data]
+        results = self.iter_basis_rep(todo)
+        for idx in range(n_done, len(self.atoms)):
+            dat = first_data[idx] if idx in first_data else next(results)
+            if ragged:
+                dataset.append(dat, syskeys[idx])
+            else:
+                row = np.zeros(paddedwidth)
+                row[paddedoffset[syskeys[idx]]:paddedoffset[syskeys[idx]] + len(dat)] = dat
+                dataset.resize(idx + 1, axis=0)
+                dataset[idx] = row
+            dataset.attrs['n_done'] = idx + 1
+            file.flush()
+        return dataset
+
+    def get_padding(self, width):
+        """ Padded width and column offsets for every kind of system
+
+        Parameters
+        ----------
+        width: dict
+            Number of descriptors for every system (joined chemical symbols)
+            in order of first appearance
+        """
         spec_agn = self.basis_instructions.get('spec_agnostic', False)
 
-        unique_systems = np.array([''.join(self.get_chemical_symbols(a)) for a in self.atoms])
-        unique_systems = np.unique(unique_systems, axis=0)
+        unique_systems = np.unique(np.array([key for key in width]), axis=0)
         if spec_agn:
             self.species_string = unique_systems[0][0] * max([len(s) for s in unique_systems])
         else:
             self.species_string = ''.join([s for s in unique_systems])
-        # === Padding ===
 
-        #Find padded width of data
-        width = {}
-        for dat, atoms in zip(self.data, self.atoms):
-            width[''.join(self.get_chemical_symbols(atoms))] = len(dat)
-        #Sanity check
-        assert len(unique_systems) == len(width)
         if spec_agn:
             paddedwidth = max([width[key] for key in width])
         else:
@@ -67,67 +198,55 @@ class Preprocessor(TransformerMixin, BaseEstimator):
             else:
                 paddedoffset[key] = cnt
                 cnt += width[key]
+        return paddedwidth, paddedoffset
 
-        padded_data = np.zeros([len(self.data), paddedwidth])
-
-        for lidx, (dat, atoms) in enumerate(zip(self.data, self.atoms)):
-            syskey = ''.join(self.get_chemical_symbols(atoms))
-            padded_data[lidx, paddedoffset[syskey]:paddedoffset[syskey] + len(dat)] = dat
-
-        data = padded_data
-        if isinstance(X, list) or isinstance(X, np.ndarray):
-            data = data[X]
-        return data
-
-    def get_basis_rep(self):
-
+    def set_chemical_symbols(self):
         if self.basis_instructions.get('spec_agnostic', False):
             self.get_chemical_symbols = (lambda x: ['X'] * len(x.get_chemical_symbols()))
         else:
             self.get_chemical_symbols = (lambda x: x.get_chemical_symbols())
 
-        if self.num_workers > 1:
-            # cluster = LocalCluster(n_workers=1, threads_per_worker=self.num_workers)
-            # print(cluster)
-            # client = Client(cluster)
-            client = Client()
+    def get_basis_rep(self, indices=None):
+        return list(self.iter_basis_rep(indices))
 
-        class FakeClient():
-            def map(self, *args):
-                return map(*args)
+    def iter_basis_rep(self, indices=None):
+        """ Projections of the systems in indices (default: all systems), yielded
+        in order as soon as they are available
+        """
+        self.set_chemical_symbols()
 
-        if self.num_workers == 1:
-            client = FakeClient()
+        executor = self.executor
+        if executor is None:
+            executor = get_executor(n_workers=self.num_workers)
 
         atoms = self.atoms
+        if indices is None:
+            indices = range(len(atoms))
         extension = self.basis_instructions.get('extension', 'RHOXC')
         if extension[0] != '.':
             extension = '.' + extension
 
+        # Workers of shared executors do not necessarily run in the current directory
+        src_path = os.path.abspath(self.src_path)
         jobs = []
-        for i, system in enumerate(atoms):
+        for i in indices:
+            system = atoms[i]
             filename = ''
-            for file in os.listdir(pjoin(self.src_path, str(i))):
+            for file in os.listdir(pjoin(src_path, str(i))):
                 if file.endswith(extension):
                     filename = file
                     break
             if filename == '':
                 raise Exception('Density file not found in ' +\
-                    pjoin(self.src_path,str(i)))
+                    pjoin(src_path,str(i)))
 
             jobs.append([
-                pjoin(self.src_path, str(i), filename),
+                pjoin(src_path, str(i), filename),
                 system.get_positions() / Bohr,
                 self.get_chemical_symbols(system)
             ])
-        # results = np.array([j.compute(num_workers = self.num_workers) for j in jobs])
-        futures = client.map(transform_one, *[[j[i] for j in jobs] for i in range(3)],
-                             len(jobs) * [self.basis_instructions])
-        if self.num_workers == 1:
-            results = list(futures)
-        else:
-            results = [f.result() for f in futures]
-        return results
+        yield from executor.map(transform_one, *[[j[i] for j in jobs] for i in range(3)],
+                                len(jobs) * [self.basis_instructions])
 
     def score(self, *args, **kwargs):
         return 0
@@ -136,16 +255,62 @@ class Preprocessor(TransformerMixin, BaseEstimator):
         return 1
 
 
+def get_worker_pool():
+    """ Cache of density getters and projectors that is kept for the lifetime
+    of a worker (one per thread, as projectors are not thread-safe)
+    """
+    if not hasattr(_worker_pool, 'cache'):
+        _worker_pool.cache = LRUCache(maxsize=8)
+    return _worker_pool.cache
+
+
+def get_density_getter(basis_instructions):
+    """ Density getter for given basis_instructions, created once per worker
+    """
+    application = basis_instructions.get('application', 'siesta')
+    binary = basis_instructions.get('binary', True)
+    grad = basis_instructions.get('grad', 0)
+
+    pool = get_worker_pool()
+    key = ('density_getter', application, binary, grad)
+    density_getter = pool.get(key)
+    if density_getter is None:
+        # Single precision densities are memory-mapped, the projector converts the points it reads
+        density_getter = density_getter_factory(application, binary=binary, grad=grad, dtype=np.float32)
+        pool[key] = density_getter
+    return density_getter
+
+
+def get_projector(density_dict, basis_instructions):
+    """ Projector for given basis and cell (unit cell and grid or grid coordinates
+    and weights), created once per worker so that basis setup is not repeated
+    for every system. Projectors that depend on the molecule (PySCF) are not cached.
+    """
+    if 'mol' in density_dict:
+        return DensityProjector(**density_dict, basis_instructions=basis_instructions)
+
+    basis_hash = hashlib.md5(json.dumps(basis_instructions, sort_keys=True, default=str).encode()).hexdigest()
+    cell_hash = hashlib.md5()
+    for key in ['unitcell', 'grid', 'grid_coords', 'grid_weights']:
+        if key in density_dict:
+            cell_hash.update(np.ascontiguousarray(density_dict[key]).tobytes())
+
+    pool = get_worker_pool()
+    key = ('projector', basis_hash, cell_hash.hexdigest())
+    projector = pool.get(key)
+    if projector is None:
+        projector = DensityProjector(**density_dict, basis_instructions=basis_instructions)
+        pool[key] = projector
+    return projector
+
+
 def transform_one(path, pos, species, basis_instructions):
 
-    density_getter = density_getter_factory(\
-        basis_instructions.get('application', 'siesta'),
-        binary = basis_instructions.get('binary', True),
-        grad = basis_instructions.get('grad', 0))
+    density_getter = get_density_getter(basis_instructions)
 
     density_dict = density_getter.get_density(path, return_dict=True)
     density_dict.update({'positions': pos, 'species': species})
-    projector = DensityProjector(**density_dict, basis_instructions=basis_instructions)
+    projector = get_projector(density_dict, basis_instructions)
     rho = density_dict.pop('rho')
     basis_rep = projector.get_basis_rep(rho, **density_dict)
     del density_dict
@@ -3,4 +3,4 @@ from .projector import (BaseProjector, DensityProjector, EuclideanProjector, Rad
 from .gaussian import GaussianEuclideanProjector, GaussianRadialProjector
 from .polynomial import OrthoEuclideanProjector, OrthoRadialProjector
 from .pyscf import PySCFProjector
-from . import gaussian, polynomial, projector
+from . import decomposed, gaussian, polynomial, projector
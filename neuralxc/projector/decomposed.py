@@ -0,0 +1,119 @@
+"""
+decomposed.py
+Domain decomposition for projections on euclidean grids. The grid is tiled into
+boxes (my_box), every tile is projected separately, possibly in a separate
+process that only receives its part of the density, and the partial
+coefficients are summed up.
+"""
+import hashlib
+
+import dill as pickle
+import numpy as np
+import torch
+
+from neuralxc.utils.executor import get_executor
+
+_worker_projector = (None, None)
+
+
+def tile_grid(grid, tiles):
+    """ Split grid into boxes
+
+    Parameters
+    ----------
+    grid: np.ndarray int (3)
+        Grid points per unitcell
+    tiles: list of int (3)
+        Number of tiles along every direction
+
+    Returns
+    -------
+    list of np.ndarray int (3, 2)
+        Boxes (lower and upper limit along every direction)
+    """
+    limits = [np.linspace(0, g, n + 1).round().astype(int) for g, n in zip(grid, tiles)]
+    boxes = []
+    for i in range(tiles[0]):
+        for j in range(tiles[1]):
+            for k in range(tiles[2]):
+                box = np.array([limits[0][i:i + 2], limits[1][j:j + 2], limits[2][k:k + 2]])
+                if np.all(box[:, 1] > box[:, 0]):
+                    boxes.append(box)
+    return boxes
+
+
+def project_tile(projector, rho, positions, species, my_box):
+    """ Project density restricted to my_box
+
+    Parameters
+    ----------
+    projector: EuclideanProjector
+    rho: np.ndarray (..., xpoints, ypoints, zpoints)
+        Density on tile
+    positions: np.ndarray (natoms, 3)
+    species: list of str
+    my_box: np.ndarray (3, 2)
+
+    Returns
+    -------
+    dict of np.ndarray
+        Partial basis representation
+    """
+    C = projector.forward(torch.from_numpy(rho), torch.from_numpy(positions), species, projector.unitcell,
+                          projector.grid, torch.from_numpy(my_box).double())
+    return {spec: C[spec].detach().numpy() for spec in C}
+
+
+def _project_tile_worker(projector, rho, positions, species, my_box):
+    """ Project tile in a worker process, projector is a tuple (key, pickled projector)
+    and only unpickled if it differs from the one used for the previous tile
+    """
+    global _worker_projector
+    key, pickled = projector
+    if _worker_projector[0] != key:
+        _worker_projector = (key, pickle.loads(pickled))
+    return project_tile(_worker_projector[1], rho, positions, species, my_box)
+
+
+def decomposed_basis_rep(projector, rho, positions, species, tiles, n_workers=1):
+    """ Basis representation obtained by projecting the density tile by tile
+    and summing up the partial coefficients.
+
+    Parameters
+    ----------
+    projector: EuclideanProjector
+    rho: np.ndarray (..., xpoints, ypoints, zpoints)
+        Electron density on full grid
+    positions: np.ndarray (natoms, 3)
+    species: list of str
+    tiles: list of int (3)
+        Number of tiles along every direction
+    n_workers: int
+        Number of processes (shared process executor, see utils.executor), if 1
+        tiles are projected sequentially
+
+    Returns
+    -------
+    dict of np.ndarray
+        Basis representation, dict keys correspond to atomic species.
+    """
+    boxes = tile_grid(projector.grid.numpy().astype(int), tiles)
+    # Only the slab of a (possibly memory-mapped) density belonging to a tile is read
+    rho_tiles = (np.ascontiguousarray(rho[..., b[0, 0]:b[0, 1], b[1, 0]:b[1, 1], b[2, 0]:b[2, 1]], dtype=np.float64)
+                 for b in boxes)
+
+    if n_workers > 1:
+        pickled = pickle.dumps(projector)
+        projector = (hashlib.sha1(pickled).hexdigest(), pickled)
+        executor = get_executor('process', n_workers)
+        partial = list(
+            executor.map(_project_tile_worker, [projector] * len(boxes), rho_tiles, [positions] * len(boxes),
+                         [species] * len(boxes), boxes))
+    else:
+        partial = [project_tile(projector, r, positions, species, b) for r, b in zip(rho_tiles, boxes)]
+
+    basis_rep = partial[0]
+    for p in partial[1:]:
+        for spec in p:
+            basis_rep[spec] = basis_rep[spec] + p[spec]
+    return basis_rep
@@ -110,46 +110,145 @@ class GaussianProjectorMixin():
         rad, ang = self.get_basis_on_mesh(box, basis)
         return rad, ang, torch.cat([mesh.double(), box['radial']])
 
+    def forward_basis_batched(self, positions, unitcell, grid, my_box):
+        """Creates basis set (for projection) for several atoms of the same
+        species at once, see forward_basis.
+
+        Returns
+        --------
+        rad, ang, box
+            Radial functions (n, natoms, npoints), angular functions
+            (m, natoms, npoints) and box as returned by box_around_batched
+        """
+        self.set_cell_parameters(unitcell, grid)
+        box = self.box_around_batched(positions, self.cutoff_radius(), my_box)
+        rad, ang = self.get_basis_on_stencil(box)
+        return rad, ang, box
+
+    def cutoff_radius(self):
+        return np.max([np.max(b['r_o']) for b in self.basis[self.species]])
+
+    def get_basis_on_stencil(self, box):
+        """ Evaluate basis functions on stacked boxes (natoms, npoints) as created by
+        box_around_batched or stencil_around
+        """
+        basis = self.basis[self.species]
+        shape = box['radial'][0].size()
+        flat_box = {'radial': [r.reshape(-1) for r in box['radial']]}
+        rad, ang = self.get_basis_on_mesh(flat_box, basis)
+        return rad.view(-1, *shape), ang.view(-1, *shape)
+
+    def project_batched(self, rho, rads, angs):
+        """ Project weighted density rho (..., natoms, npoints) onto stacked basis
+        functions, returns coefficients (natoms, -1)
+        """
+        rad_cnt = 0
+        ang_cnt = 0
+        coeff = []
+        for basis in self.basis[self.species]:
+            l = basis['l']
+            len_rad = len(basis['r_o'])
+            rad = rads[rad_cnt:rad_cnt + len_rad]
+            ang = angs[ang_cnt:ang_cnt + (2 * l + 1)]
+            rad_cnt += len_rad
+            ang_cnt += 2 * l + 1
+            c = contract('...ki,mki,nki -> knm...', rho, ang, rad)
+            coeff.append(c.reshape(len(c), -1, *c.size()[3:]))
+
+        coeff = torch.cat(coeff, dim=1)
+        coeff_out = contract('ij,kj...->k...i', self.M[self.species], coeff)
+        return coeff_out.reshape(len(coeff_out), -1)
+
     def get_basis_on_mesh(self, box, basis_instructions):
 
         angs = []
         rads = []
 
         box['radial'] = torch.stack(box['radial'])
+        filt = (box['radial'][0] <= 1000000)
+        box_rad = box['radial'][:, filt]
+        all_angs = self.angulars_real_all(max([basis['l'] for basis in basis_instructions]), *box_rad[1:])
         for ib, basis in enumerate(basis_instructions):
             l = basis['l']
-            filt = (box['radial'][0] <= 1000000)
-            box_rad = box['radial'][:, filt]
-            angs.append(torch.stack(self.angulars_real(l, box_rad[1], box_rad[2])))  # shape (m, x, y, z)
-            rads.append(torch.stack(self.radials(box_rad[0], [basis])[0]))  # shape (n, x, y, z)
+            angs.append(all_angs[l**2:(l + 1)**2])  # shape (m, x, y, z)
 
-        return torch.cat(rads), torch.cat(angs)
+        if self.radial_table:
+            rads = self.tabulated_radials(box_rad[0], lambda r: self.stacked_radials(r, basis_instructions),
+                                          self.cutoff_radius())
+        else:
+            rads = self.stacked_radials(box_rad[0], basis_instructions)
 
-    def project_onto(self, rho, rads, angs, basis_instructions, basis_string, box):
+        return rads, torch.cat(angs)
+
+    def stacked_radials(self, r, basis_instructions):
+        rads = []
+        for basis in basis_instructions:
+            rads.append(torch.stack(self.radials(r, [basis])[0]))  # shape (n, x, y, z)
+        return torch.cat(rads)
+
+    def basis_matrix(self, rads, angs, basis_instructions):
+        """ Stacked basis functions (nbasis, npoints), for every shell rows are
+        ordered (n, m)
+        """
+        npoints = rads.size()[-1]
+        blocks = self.shell_blocks(basis_instructions)
+        basis_matrix = torch.empty(sum([n * m for _, n, _, m in blocks]), npoints, dtype=rads.dtype)
+        cnt = 0
+        for rad_cnt, n, ang_cnt, m in blocks:
+            torch.mul(rads[rad_cnt:rad_cnt + n].unsqueeze(1),
+                      angs[ang_cnt:ang_cnt + m].unsqueeze(0),
+                      out=basis_matrix[cnt:cnt + n * m].view(n, m, npoints))
+            cnt += n * m
+        return basis_matrix
+
+    def projection_rows(self, rads, angs):
+        """ Basis functions (ncoeffs, npoints) in the order of the coefficients
+        returned by project_onto (includes padding matrix M)
+        """
+        return torch.mm(self.M[self.species], self.basis_matrix(rads, angs, self.basis[self.species]))
 
+    def shell_blocks(self, basis_instructions):
+        """ (first radial, number of radials, first angular, number of angulars)
+        for every shell
+        """
+        blocks = []
         rad_cnt = 0
         ang_cnt = 0
-        coeff = []
         for basis in basis_instructions:
             l = basis['l']
             len_rad = len(basis['r_o'])
-            rad = rads[rad_cnt:rad_cnt + len_rad]
-            ang = angs[ang_cnt:ang_cnt + (2 * l + 1)]
+            blocks.append((rad_cnt, len_rad, ang_cnt, 2 * l + 1))
             rad_cnt += len_rad
             ang_cnt += 2 * l + 1
-            c = contract('...i,mi,ni -> nm...', rho, ang, rad * self.V_cell)
-            if c.dim() == 2:
-                coeff.append(c.reshape(-1))
-            else:
-                coeff.append(c.reshape(-1, c.size()[-1]))
+        return blocks
 
-        coeff = torch.cat(coeff)
-        if coeff.dim() == 2:
-            coeff_out = torch.mm(self.M[self.species], coeff)
-            return coeff_out.permute(1, 0).reshape(-1)
+    def shell_index(self, basis_instructions, n_ang):
+        """ Flat indices of (radial, angular) pairs that belong to the same shell
+        in a (nrad, nang) matrix
+        """
+        index = []
+        for rad_cnt, n, ang_cnt, m in self.shell_blocks(basis_instructions):
+            for i in range(n):
+                index += [(rad_cnt + i) * n_ang + ang_cnt + j for j in range(m)]
+        return torch.LongTensor(index)
+
+    def project_onto(self, rho, rads, angs, basis_instructions, basis_string, box):
+        """ Project density rho (npoints) or (nchannels, npoints) onto basis.
+        All channels are contracted in a single matrix product: For few channels
+        the channels are weighted with all radial functions and contracted with all
+        angular functions (shell diagonal is kept), otherwise the basis matrix is
+        built once and contracted with all channels.
+        """
+        rho_2d = (rho * self.V_cell).reshape(rho.size()[:-1].numel(), rho.size()[-1])
+        n_channels, npoints = rho_2d.size()
+        shell_index = self.shell_index(basis_instructions, len(angs))
+        if n_channels * len(rads) <= len(shell_index):
+            rho_rad = (rho_2d.unsqueeze(1) * rads.unsqueeze(0)).flatten(0, 1)
+            coeff = torch.mm(rho_rad, angs.T).view(n_channels, -1)[:, shell_index]
         else:
-            coeff_out = torch.mv(self.M[self.species], coeff)
-            return coeff_out
+            coeff = torch.mm(rho_2d, self.basis_matrix(rads, angs, basis_instructions).T)
+        coeff_out = torch.mm(coeff, self.M[self.species].T)
+        return coeff_out.reshape(-1)
 
     def init_padder(self, basis_instructions):
         basis_strings = self.basis_strings
@@ -260,7 +359,8 @@ class GaussianEuclideanProjector(EuclideanProjector, GaussianProjectorMixin):
         box['mesh'] = my_box[:3]
         box['radial'] = my_box[3:]
         Xm, Ym, Zm = box['mesh'].long()
-        return self.project_onto(rho[..., Xm, Ym, Zm], radials, angulars, basis, self.basis_strings[self.species], box)
+        return self.project_onto(rho[..., Xm, Ym, Zm].double(), radials, angulars, basis,
+                                 self.basis_strings[self.species], box)
 
 
 class GaussianRadialProjector(RadialProjector, GaussianProjectorMixin):
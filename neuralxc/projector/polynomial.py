@@ -45,28 +45,74 @@ class OrthoProjectorMixin():
         rad, ang = self.get_basis_on_mesh(box, basis, self.W[self.species])
         return rad, ang, mesh
 
+    def forward_basis_batched(self, positions, unitcell, grid, my_box):
+        """Creates basis set (for projection) for several atoms of the same
+        species at once, see forward_basis.
+
+        Returns
+        --------
+        rad, ang, box
+            Radial functions (n, natoms, npoints), angular functions
+            (l, natoms, npoints) and box as returned by box_around_batched
+        """
+        self.set_cell_parameters(unitcell, grid)
+        box = self.box_around_batched(positions, self.cutoff_radius(), my_box)
+        rad, ang = self.get_basis_on_stencil(box)
+        return rad, ang, box
+
+    def cutoff_radius(self):
+        return self.basis[self.species]['r_o']
+
+    def get_basis_on_stencil(self, box):
+        """ Evaluate basis functions on stacked boxes (natoms, npoints) as created by
+        box_around_batched or stencil_around
+        """
+        basis = self.basis[self.species]
+        shape = box['radial'][0].size()
+        flat_box = {'radial': [r.reshape(-1) for r in box['radial']]}
+        rad, ang = self.get_basis_on_mesh(flat_box, basis, self.W[self.species])
+        return rad.view(-1, *shape), ang.view(-1, *shape)
+
+    def project_batched(self, rho, rads, angs):
+        """ Project weighted density rho (..., natoms, npoints) onto stacked basis
+        functions, returns coefficients (natoms, -1)
+        """
+        coeff_array = contract('lki,nki,...ki -> k...nl', angs, rads, rho)
+        return coeff_array.reshape(len(coeff_array), -1)
+
     def project_onto(self, rho, rads, angs, n_l):
+        """ Project density rho (npoints) or (nchannels, npoints) onto basis.
+        All channels are weighted with the radial functions and contracted
+        with the angular functions in a single matrix product.
+        """
         rho = rho.squeeze()
         rho = rho * self.V_cell.squeeze()
         if rho.ndim < 3:
-            coeff_array = contract('li,ni,...i -> ...nl', angs, rads, rho)
+            rho_rad = (rho.unsqueeze(-2) * rads).flatten(0, -2)
+            coeff_array = torch.mm(rho_rad, angs.T)
         else:
             coeff_array = contract('lmijk,nijk,...ijk -> ...nlm', angs, rads, rho)
 
-        return coeff_array.view(-1)
+        # reshape: coefficients of empty boxes (my_box) are not guaranteed to be contiguous
+        return coeff_array.reshape(-1)
+
+    def projection_rows(self, rads, angs):
+        """ Basis functions (ncoeffs, npoints) in the order of the coefficients
+        returned by project_onto (n, l)
+        """
+        return (rads.unsqueeze(1) * angs.unsqueeze(0)).reshape(-1, rads.size()[-1])
 
     def get_basis_on_mesh(self, box, basis, W):
 
         n_l = basis['l']
-        R, Theta, Phi = box['radial']
+        R = box['radial'][0]
 
         #Build angular part of basis functions
-        angs = []
-        for l in range(n_l):
-            angs += self.angulars_real(l, Theta, Phi)
-
-        angs = torch.stack(angs)
-        rads = self.radials(R, basis, W)
+        angs = self.angulars_real_all(n_l - 1, *box['radial'][1:])
+        if self.radial_table:
+            rads = self.tabulated_radials(R, lambda r: self.radials(r, basis, W), basis['r_o'])
+        else:
+            rads = self.radials(R, basis, W)
 
         return rads, angs
 
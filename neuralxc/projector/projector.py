@@ -10,10 +10,15 @@ from abc import abstractmethod
 import numpy as np
 import torch
 from opt_einsum import contract
+from scipy.sparse import csr_matrix
+from scipy.spatial import cKDTree
 from torch.nn import Module as TorchModule
 
 from neuralxc.base import ABCRegistry
+from neuralxc.projector.decomposed import decomposed_basis_rep
 from neuralxc.utils import geom
+from neuralxc.utils.cache import LRUCache
+from neuralxc.utils.spline import SplineTable
 
 
 class ProjectorRegistry(ABCRegistry):
@@ -38,6 +43,8 @@ def DensityProjector(**kwargs):
 class BaseProjector(TorchModule, metaclass=ProjectorRegistry):
     _registry_name = 'base'
     _unit_test = False
+    angular = 'spherical'
+    radial_table = False
 
     def __init__(self):
         TorchModule.__init__(self)
@@ -63,7 +70,9 @@ class BaseProjector(TorchModule, metaclass=ProjectorRegistry):
         c: dict of np.ndarrays
         	Basis representation, dict keys correspond to atomic species.
         """
-        rho = torch.from_numpy(rho)
+        # Densities may be memory-mapped single precision views (see SiestaDensityGetter),
+        # only the grid points gathered around atoms are converted to double precision
+        rho = torch.from_numpy(np.asarray(rho))
         positions = torch.from_numpy(positions)
         my_box = torch.Tensor([[0, self.grid[i]] for i in range(3)])
         C = self.forward(rho, positions, species, self.unitcell, self.grid, my_box)
@@ -97,6 +106,11 @@ class BaseProjector(TorchModule, metaclass=ProjectorRegistry):
         rad, ang, mesh
             Stacked radial and angular functions as well as meshgrid
         """
+        if getattr(self, 'stencils', None) is not None and self.stencils_applicable(positions, unitcell):
+            return self.forward_stencils(rho, positions, species, unitcell, grid, my_box)
+        if getattr(self, 'batched', False):
+            return self.forward_batched(rho, positions, species, unitcell, grid, my_box)
+
         self.set_cell_parameters(unitcell, grid)
         basis_rep = {}
         # species = [str(element_dict[int(s.detach().numpy())]) for s in species]
@@ -119,6 +133,41 @@ class BaseProjector(TorchModule, metaclass=ProjectorRegistry):
 
         return basis_rep
 
+    def forward_batched(self, rho, positions, species, unitcell, grid, my_box):
+        """ Same as forward but projects all atoms of a given species at once.
+        Atoms are grouped by species and their boxes are stacked (padded to
+        a common size), so that basis functions and projections are evaluated
+        in a single tensor operation per species (or per chunk of batch_size atoms).
+
+        Parameters
+        ----------
+        see forward
+
+        Returns
+        --------
+        basis_rep, dict of Tensor
+            Basis representation, dict keys correspond to atomic species.
+        """
+        self.set_cell_parameters(unitcell, grid)
+        positions = positions.view(-1, 3)
+        atom_idx = {}
+        for idx, spec in enumerate(species):
+            atom_idx.setdefault(spec, []).append(idx)
+
+        basis_rep = {}
+        for spec in atom_idx:
+            self.species = spec
+            idx = torch.LongTensor(atom_idx[spec])
+            batch_size = self.batch_size if self.batch_size > 0 else len(idx)
+            projections = []
+            for start in range(0, len(idx), batch_size):
+                pos = positions[idx[start:start + batch_size]]
+                rad, ang, box = self.forward_basis_batched(pos, unitcell, grid, my_box)
+                projections.append(self.project_batched(self.gather_batched(rho, box), rad, ang))
+            basis_rep[spec] = torch.cat(projections, dim=0)
+
+        return basis_rep
+
     @staticmethod
     def angulars_real(l, theta, phi):
         """ Spherical harmonics (uses physics convention for angles)
@@ -138,10 +187,82 @@ class BaseProjector(TorchModule, metaclass=ProjectorRegistry):
         float or np.ndarray
             Value of angular function at provided point(s)
         """
-        res = []
-        for m in range(-l, l + 1):
-            res.append(geom.SH(l, m, theta, phi))
-        return res
+        return list(geom.SH_all(l, theta, phi)[l**2:])
+
+    def angulars_real_all(self, l_max, *angles):
+        """ All real spherical harmonics up to l_max, stacked in the order
+        l = 0, ..., l_max and m = -l, ..., l (see geom.SH_all)
+
+        Parameters
+        ----------
+        l_max: int
+            maximum angular momentum quantum number
+        angles: Tensors
+            angular coordinates as returned by angular_coords
+
+        Returns
+        -------
+        Tensor ((l_max + 1)**2, npoints)
+        """
+        if self.angular == 'cartesian':
+            return geom.SH_all_cartesian(l_max, *angles)
+        return geom.SH_all(l_max, *angles)
+
+    def set_radial_table(self, radial_table, tol=1e-8):
+        self.radial_table = radial_table
+        self.radial_table_tol = tol
+        self.radial_tables = {}
+
+    def tabulated_radials(self, r, func, r_max):
+        """ Evaluate radial functions of current species from a spline table
+        that is built on first use.
+
+        Parameters
+        ----------
+        r: Tensor
+            radius
+        func: callable
+            maps r to stacked radial functions (nrad, npoints)
+        r_max: float
+            cutoff radius
+
+        Returns
+        -------
+        Tensor (nrad, npoints)
+        """
+        if self.species not in self.radial_tables:
+            # Table construction should not be recorded if called during tracing
+            tracing_state = torch._C._get_tracing_state()
+            torch._C._set_tracing_state(None)
+            try:
+                self.radial_tables[self.species] = SplineTable(func, r_max, tol=self.radial_table_tol)
+            finally:
+                torch._C._set_tracing_state(tracing_state)
+        return self.radial_tables[self.species](r)
+
+    def set_angular(self, angular):
+        if angular not in ['spherical', 'cartesian']:
+            raise Exception('Angular coordinates {} not supported, use spherical or cartesian'.format(angular))
+        self.angular = angular
+
+    def angular_coords(self, x, y, z, R):
+        """ Angular coordinates of displacements (x, y, z) with norm R that serve as
+        input to angulars_real_all: (Theta, Phi) in spherical mode and the
+        components of the unit vector in cartesian mode. Points at the origin
+        are assigned Theta = 0 and Phi = 0 in both modes.
+
+        Returns
+        -------
+        list of Tensor
+        """
+        if self.angular == 'cartesian':
+            at_origin = R < 1e-15
+            R_inv = 1 / torch.where(at_origin, torch.ones_like(R), R)
+            return [x * R_inv, y * R_inv, torch.where(at_origin, torch.ones_like(z), z * R_inv)]
+        Phi = torch.atan2(y, x)
+        Theta = torch.acos(z / R)
+        Theta[R < 1e-15] = 0
+        return [Theta, Phi]
 
 
 class EuclideanProjector(BaseProjector):
@@ -175,11 +296,45 @@ class EuclideanProjector(BaseProjector):
         self.grid = torch.from_numpy(grid).double()
         self.a = torch.from_numpy(a).double()
         self.W = {w: torch.from_numpy(W[w]) for w in W}
+        self.batched = basis_instructions.get('batched', False)
+        self.batch_size = basis_instructions.get('batch_size', 0)
+        stencil_cache = basis_instructions.get('stencil_cache', 0)
+        self.stencils = LRUCache(stencil_cache) if stencil_cache else None
+        self.stencil_exact = basis_instructions.get('stencil_exact', False)
+        self.stencil_resolution = basis_instructions.get('stencil_resolution', 100)
+        self.set_angular(basis_instructions.get('angular', 'spherical'))
+        self.set_radial_table(basis_instructions.get('radial_table', False),
+                              basis_instructions.get('radial_table_tol', 1e-8))
+        self.tiles = basis_instructions.get('tiles', None)
+        self.tile_workers = basis_instructions.get('tile_workers', 1)
 
         for species in basis_instructions:
             if len(species) < 3:
                 W[species] = self.get_W(basis_instructions[species])
 
+    def get_basis_rep(self, rho, positions, species, **kwargs):
+        """Calculates the basis representation for a given real space density.
+        If tiles are set in basis_instructions, the grid is decomposed into
+        tiles that are projected separately (in tile_workers processes).
+
+        Parameters
+        ------------------
+        rho: np.ndarray float (xpoints, ypoints, zpoints)
+        	Electron density in real space
+        positions: np.ndarray float (natoms, 3)
+        	atomic positions
+        species: list string
+        	atomic species (chem. symbols)
+
+        Returns
+        ------------
+        c: dict of np.ndarrays
+        	Basis representation, dict keys correspond to atomic species.
+        """
+        if self.tiles:
+            return decomposed_basis_rep(self, rho, positions, species, self.tiles, self.tile_workers)
+        return super().get_basis_rep(rho, positions, species, **kwargs)
+
     def set_cell_parameters(self, unitcell, grid):
         a = torch.norm(unitcell, dim=1).double() / grid
         U = contract('ij,i->ij', unitcell, 1 / grid)
@@ -189,6 +344,81 @@ class EuclideanProjector(BaseProjector):
         self.U_inv = torch.inverse(self.U)
         self.a = a
 
+    def stencils_applicable(self, positions, unitcell):
+        """ Cached stencils are neither traceable nor differentiable w.r.t.
+        positions and unitcell, fall back to regular forward in these cases
+        """
+        return not (torch.jit.is_tracing() or positions.requires_grad or unitcell.requires_grad)
+
+    def get_stencil(self, dr, cell_key):
+        """ Return basis functions around a grid point for an atom displaced by
+        dr from that point. Stencils are cached by (species, unitcell, grid,
+        fractional offset). Unless stencil_exact is set, the fractional offset is
+        quantized to 1/stencil_resolution of the grid spacing and the basis is
+        evaluated at the quantized offset.
+
+        Parameters
+        ----------
+        dr, Tensor (3)
+            offset of atom from closest grid point
+        cell_key, tuple
+            hashable representation of unitcell and grid
+
+        Returns
+        --------
+        dict
+            {'rad', 'ang', 'offsets', 'within'}
+        """
+        frac = self.U_inv.mv(dr)
+        if self.stencil_exact:
+            key = (self.species, cell_key, frac.numpy().tobytes())
+        else:
+            q = torch.round(frac * self.stencil_resolution)
+            key = (self.species, cell_key, tuple(q.long().tolist()))
+            dr = self.U.mv(q / self.stencil_resolution)
+
+        stencil = self.stencils.get(key)
+        if stencil is None:
+            radius = self.cutoff_radius()
+            box = self.stencil_around(dr.view(1, 3), radius)
+            rad, ang = self.get_basis_on_stencil(box)
+            stencil = {'rad': rad, 'ang': ang, 'offsets': box['offsets'], 'within': box['radial'][0] <= radius}
+            self.stencils[key] = stencil
+        return stencil
+
+    def forward_stencils(self, rho, positions, species, unitcell, grid, my_box):
+        """ Same as forward but basis functions are retrieved from the stencil
+        cache, so that repeated calls (e.g. during SCF) skip basis construction.
+
+        Parameters
+        ----------
+        see forward
+
+        Returns
+        --------
+        basis_rep, dict of Tensor
+            Basis representation, dict keys correspond to atomic species.
+        """
+        self.set_cell_parameters(unitcell, grid)
+        cell_key = (unitcell.detach().numpy().tobytes(), grid.detach().numpy().tobytes())
+        positions = positions.view(-1, 3)
+        cm = torch.round(contract('ij,kj->ki', self.U_inv, positions))
+        dr = positions - contract('ij,kj->ki', self.U, cm)
+
+        basis_rep = {}
+        for idx, spec in enumerate(species):
+            self.species = spec
+            stencil = self.get_stencil(dr[idx], cell_key)
+            mask, index = self.stencil_index(cm[idx:idx + 1], stencil['offsets'], stencil['within'], my_box)
+            projection = self.project_batched(self.gather_batched(rho, {'mask': mask, 'index': index}), stencil['rad'],
+                                              stencil['ang'])
+            basis_rep.setdefault(spec, []).append(projection)
+
+        for spec in basis_rep:
+            basis_rep[spec] = torch.cat(basis_rep[spec], dim=0)
+
+        return basis_rep
+
     def forward_fast(self, rho, positions, unitcell, grid, radials, angulars, mesh):
         """Creates basis set (for projection) for a single atom, on grid points
 
@@ -217,7 +447,7 @@ class EuclideanProjector(BaseProjector):
         self.set_cell_parameters(unitcell, grid)
         basis = self.basis[self.species]
         Xm, Ym, Zm = mesh.long()
-        return self.project_onto(rho[..., Xm, Ym, Zm], radials, angulars, int(basis['l']))
+        return self.project_onto(rho[..., Xm, Ym, Zm].double(), radials, angulars, int(basis['l']))
 
     def box_around(self, pos, radius, my_box):
         '''
@@ -249,15 +479,17 @@ class EuclideanProjector(BaseProjector):
         rmax = torch.ceil(radius / self.a) + 2
         # my_box = my_box - cm.view(3,1)
 
-        Xm = self.mesh_3d(self.U, self.a, my_box=my_box, cm=cm, scaled=False, rmax=rmax, indexing='ij')
-        X = self.mesh_3d(self.U, self.a, my_box=my_box, cm=cm, scaled=True, rmax=rmax, indexing='ij')
+        if torch.jit.is_tracing():
+            Xm = self.mesh_3d_traceable(self.U, self.a, my_box=my_box, cm=cm, scaled=False, rmax=rmax, indexing='ij')
+            X = self.mesh_3d_traceable(self.U, self.a, my_box=my_box, cm=cm, scaled=True, rmax=rmax, indexing='ij')
+            cms = shift(cm, self.grid)
+            cms -= my_box[:, 0]
+            Xm = torch.fmod((Xm + cms.view(-1, 1, 1, 1)), self.grid.view(-1, 1, 1, 1))
+        else:
+            Xm, X = self.mesh_3d(self.U, self.a, my_box=my_box, cm=cm, rmax=rmax, both=True)
 
         Xs = X - dr.view(-1, 1, 1, 1)
 
-        cms = shift(cm, self.grid)
-        cms -= my_box[:, 0]
-        Xm = torch.fmod((Xm + cms.view(-1, 1, 1, 1)), self.grid.view(-1, 1, 1, 1))
-
         R = torch.norm(Xs, dim=0)
 
         co = (R <= radius)
@@ -265,13 +497,177 @@ class EuclideanProjector(BaseProjector):
         Xs = Xs[:, co]
         Xm = Xm[:, co]
 
-        Phi = torch.atan2(Xs[1], Xs[0])
-        Theta = torch.acos(Xs[2] / R)
-        Theta[R < 1e-15] = 0
-        return {'radial': [R, Theta, Phi], 'co': co}, Xm
+        return {'radial': [R] + self.angular_coords(Xs[0], Xs[1], Xs[2], R), 'co': co}, Xm
+
+    def box_around_batched(self, positions, radius, my_box):
+        '''
+        Batched version of box_around. Creates boxes around several atoms at
+        once. All boxes share the same integer offsets relative to the grid point
+        closest to each atom, points outside of radius or my_box are masked.
+
+        Parameters
+        ---
+            positions, Tensor (natoms, 3)
+            	atomic positions
+            radius, float
+                cutoff radius in Bohr
+            my_box, Tensor (3: euclid. directions, 2: upper and lower limits)
+                Limiting box local gridpoints. Relevant if global grid is decomposed
+                with MPI or similar.
+        Returns
+        ---
+            dict
+                {'radial','mask','index'}
+                'radial': spherical coordinates, each Tensor (natoms, npoints)
+                'mask': Tensor (natoms, npoints), True if point contributes
+                'index': Tensor (natoms, npoints), flattened index into local rho
+        '''
+        cm = torch.round(contract('ij,kj->ki', self.U_inv, positions))
+        dr = positions - contract('ij,kj->ki', self.U, cm)
+        box = self.stencil_around(dr, radius)
+        R = box['radial'][0]
+        mask, index = self.stencil_index(cm, box['offsets'], R <= radius, my_box)
+        return {'radial': box['radial'], 'mask': mask, 'index': index}
+
+    def stencil_around(self, dr, radius):
+        """ Grid points around (several) atoms relative to the closest grid
+        point. Only depends on the sub-grid offsets dr, not on the position of
+        the atom in the unit cell.
+
+        Parameters
+        ----------
+        dr, Tensor (natoms, 3)
+            offset of atoms from their closest grid point
+        radius, float
+            cutoff radius in Bohr
+
+        Returns
+        --------
+        dict
+            {'radial', 'offsets'}
+            'radial': spherical coordinates, each Tensor (natoms, npoints)
+            'offsets': Tensor (3, npoints), integer offsets from closest grid point
+        """
+        rmax = (torch.ceil(radius / self.a) + 2).long()
+
+        # Integer offsets shared by all atoms, discard those that are out of reach
+        # for any possible sub-grid offset dr
+        offsets = torch.stack(
+            torch.meshgrid([torch.arange(-int(r), int(r) + 1) for r in rmax])).view(3, -1)
+        X = self.U.mm(offsets.double())
+        reach = radius + torch.max(torch.norm(dr, dim=1))
+        select = torch.norm(X, dim=0) <= reach
+        offsets = offsets[:, select]
+        X = X[:, select]
+
+        Xs = X.unsqueeze(0) - dr.unsqueeze(-1)
+        R = torch.norm(Xs, dim=1)
+
+        return {'radial': [R] + self.angular_coords(Xs[:, 0], Xs[:, 1], Xs[:, 2], R), 'offsets': offsets}
+
+    def stencil_index(self, cm, offsets, within, my_box):
+        """ Resolve periodic boundary conditions for stencil offsets around grid
+        points cm and restrict them to my_box.
+
+        Parameters
+        ----------
+        cm, Tensor (natoms, 3)
+            closest grid point for every atom
+        offsets, Tensor (3, npoints)
+            integer offsets as returned by stencil_around
+        within, Tensor (natoms, npoints) or (npoints)
+            True for points inside the cutoff radius
+        my_box, Tensor (3: euclid. directions, 2: upper and lower limits)
+            Limiting box local gridpoints.
+
+        Returns
+        --------
+        mask, index
+            mask: Tensor (natoms, npoints), True if point contributes
+            index: Tensor (natoms, npoints), flattened index into local rho
+        """
+        grid = self.grid.long().view(1, 3, 1)
+        lower = my_box[:, 0].long().view(1, 3, 1)
+        upper = my_box[:, 1].long().view(1, 3, 1)
+        Xm = torch.remainder(cm.long().unsqueeze(-1) + offsets.unsqueeze(0), grid)
+        mask = within & torch.all((Xm >= lower) & (Xm < upper), dim=1)
+        Xm = Xm - lower
+        box_shape = (upper - lower).view(-1)
+        index = (Xm[:, 0] * box_shape[1] + Xm[:, 1]) * box_shape[2] + Xm[:, 2]
+        index[~mask] = 0
+        return mask, index
+
+    def gather_batched(self, rho, box):
+        """ Gather density from (local) grid onto stacked boxes created by
+        box_around_batched and apply integration weights.
+
+        Parameters
+        ----------
+        rho, Tensor (xpoints, ypoints, zpoints) or (nchannels, xpoints, ypoints, zpoints)
+            electron density on grid
+        box, dict
+            as returned by box_around_batched
+
+        Returns
+        --------
+        Tensor (natoms, npoints) or (nchannels, natoms, npoints)
+        """
+        index = box['index']
+        if rho.is_contiguous():
+            rho = rho.reshape(*rho.size()[:-3], -1)[..., index]
+        else:
+            # Flattening a strided (e.g. memory-mapped) density would copy the whole grid
+            ny, nz = rho.size()[-2:]
+            rho = rho[..., index // (ny * nz), (index // nz) % ny, index % nz]
+        return rho.double() * box['mask'] * self.V_cell
 
     def mesh_3d(self, U, a, rmax, my_box, cm, scaled=False, indexing='xy', both=False):
-        # Does the same as above but does not complain if unitcell.requires_gradient
+        """ Meshgrid of all grid points within rmax grid spacings around grid
+        point cm that lie inside my_box (periodic boundary conditions apply).
+
+        Parameters
+        ----------
+        U, Tensor (3,3)
+            grid vectors (columns)
+        a, Tensor (3)
+            grid spacing
+        rmax, Tensor (3)
+            number of grid points to include in every direction
+        my_box, Tensor (3: euclid. directions, 2: upper and lower limits)
+            Limiting box local gridpoints.
+        cm, Tensor (3)
+            central grid point
+        scaled, bool
+            if True return euclidean coordinates relative to cm, otherwise
+            int64 indices into local grid (my_box)
+        both, bool
+            return both (indices, coordinates), ranges are only computed once
+
+        Returns
+        --------
+        Tensor (3, xpoints, ypoints, zpoints) or tuple thereof
+        """
+        offsets = [
+            _periodic_range(int(rmax[i]), int(cm[i]), int(my_box[i, 0]), int(my_box[i, 1]), int(self.grid[i]))
+            for i in range(3)
+        ]
+        lower = my_box[:, 0].long()
+        index = [torch.remainder(o + int(cm[i]), int(self.grid[i])) - lower[i] for i, o in enumerate(offsets)]
+
+        Xm = torch.stack(torch.meshgrid(index))
+        if not (scaled or both):
+            return Xm
+        # Broadcast instead of contracting with a stacked meshgrid of offsets
+        ox, oy, oz = [o.double() for o in offsets]
+        X = U[:, 0].view(3, -1, 1, 1) * ox.view(1, -1, 1, 1) + U[:, 1].view(3, 1, -1, 1) * oy.view(1, 1, -1, 1) +\
+            U[:, 2].view(3, 1, 1, -1) * oz.view(1, 1, 1, -1)
+        if both:
+            return Xm, X
+        return X
+
+    def mesh_3d_traceable(self, U, a, rmax, my_box, cm, scaled=False, indexing='xy', both=False):
+        # Does the same as mesh_3d but does not complain if unitcell.requires_gradient
+        # and produces a trace that is valid for arbitrary positions
         x_pbc = torch.arange(-1000, 1000, dtype=torch.float64)
         x_pbc = x_pbc[(x_pbc >= -rmax[0]) & (x_pbc <= rmax[0])]
         y_pbc = torch.arange(-1000, 1000, dtype=torch.float64)
@@ -344,9 +740,83 @@ class RadialProjector(BaseProjector):
             if len(species) < 3:
                 W[species] = self.get_W(basis_instructions[species])
 
+        self.set_angular(basis_instructions.get('angular', 'spherical'))
+        self.set_radial_table(basis_instructions.get('radial_table', False),
+                              basis_instructions.get('radial_table_tol', 1e-8))
         self.my_box = torch.Tensor([[0, 1] for i in range(3)])
         self.unitcell = self.grid_coords
         self.grid = self.grid_weights
+        self.projection_matrix = basis_instructions.get('projection_matrix', False)
+        self._projection = None
+
+    def get_basis_rep(self, rho, positions, species, **kwargs):
+        """Calculates the basis representation for a given real space density.
+        If projection_matrix is set in basis_instructions, the projection is done
+        as a single sparse matrix-vector product (see get_projection_matrix).
+
+        Parameters
+        ------------------
+        rho: np.ndarray float (npoints) or (nchannels, npoints)
+        	Electron density in real space
+        positions: np.ndarray float (natoms, 3)
+        	atomic positions
+        species: list string
+        	atomic species (chem. symbols)
+
+        Returns
+        ------------
+        c: dict of np.ndarrays
+        	Basis representation, dict keys correspond to atomic species.
+        """
+        if not self.projection_matrix:
+            return BaseProjector.get_basis_rep(self, np.asarray(rho, dtype=np.float64), positions, species, **kwargs)
+
+        A, layout = self.get_projection_matrix(positions, species)
+        coeff = A.dot(rho.reshape(-1, A.shape[1]).T).T
+        basis_rep = {}
+        for spec, start, stop in layout:
+            basis_rep.setdefault(spec, []).append(coeff[:, start:stop].reshape(1, -1))
+        return {spec: np.concatenate(basis_rep[spec]) for spec in basis_rep}
+
+    def get_projection_matrix(self, positions, species):
+        """Sparse projection matrix (ncoeffs, npoints) for the given geometry,
+        containing basis functions multiplied with the integration weights
+        (and the padding matrix for GTO bases). Rows are ordered atom by atom,
+        the matrix is only rebuilt if positions, species or the grid change.
+
+        Returns
+        ------------
+        A: scipy.sparse.csr_matrix (ncoeffs, npoints)
+        layout: list of (str, int, int)
+            species, first and last row for every atom
+        """
+        positions = np.asarray(positions, dtype=np.float64)
+        key = (positions.tobytes(), tuple(species))
+        if self._projection is not None:
+            cached_key, grid_coords, grid_weights, A, layout = self._projection
+            if cached_key == key and grid_coords is self.unitcell and grid_weights is self.grid:
+                return A, layout
+
+        grid_coords, grid_weights = self.unitcell, self.grid
+        rows, cols, values, layout = [], [], [], []
+        n_coeffs = 0
+        with torch.no_grad():
+            for pos, spec in zip(torch.from_numpy(positions), species):
+                self.species = spec
+                rad, ang, mesh = self.forward_basis(pos, grid_coords, grid_weights, self.my_box)
+                Xm = mesh[0].long()
+                block = self.projection_rows(rad, ang) * grid_weights[Xm]
+                n_rows = len(block)
+                rows.append(np.repeat(np.arange(n_coeffs, n_coeffs + n_rows), len(Xm)))
+                cols.append(np.tile(Xm.numpy(), n_rows))
+                values.append(block.numpy().reshape(-1))
+                layout.append((spec, n_coeffs, n_coeffs + n_rows))
+                n_coeffs += n_rows
+
+        A = csr_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+                       shape=(n_coeffs, len(grid_weights)))
+        self._projection = (key, grid_coords, grid_weights, A, layout)
+        return A, layout
 
     def set_cell_parameters(self, grid_coords, grid_weights):
         self.grid_coords = grid_coords
@@ -360,11 +830,24 @@ class RadialProjector(BaseProjector):
         basis = self.basis[self.species]
         return self.project_onto(rho[..., Xm], radials, angulars, int(basis['l']))
 
+    def grid_tree(self):
+        """ KD-tree over grid_coords, only rebuilt if the grid changes
+        """
+        tree_coords = getattr(self, '_tree_coords', None)
+        if tree_coords is not self.grid_coords:
+            if tree_coords is None or tree_coords.size() != self.grid_coords.size() or \
+                    not torch.equal(tree_coords, self.grid_coords):
+                self._tree = cKDTree(self.grid_coords.detach().numpy())
+            self._tree_coords = self.grid_coords
+        return self._tree
+
     def box_around(self, pos, radius, my_box=None):
         '''
         Return dictionary containing box around an atom at position pos with
         given radius. Dictionary contains box in mesh, euclidean and spherical
-        coordinates
+        coordinates. Grid points within radius are looked up in a KD-tree
+        that is built once per grid, so that the cost per atom does not grow
+        with the total number of grid points.
 
         Parameters
         ---
@@ -377,22 +860,49 @@ class RadialProjector(BaseProjector):
         '''
         pos = pos.view(-1)
 
-        # Create box with max. distance = radius
-        Xm = torch.arange(self.grid_weights.shape[0])
-        X = (self.grid_coords - pos.view(-1, 3)).T
-
-        R = torch.norm(X, dim=0)
+        if torch.jit.is_tracing():
+            # Create box with max. distance = radius
+            Xm = torch.arange(self.grid_weights.shape[0])
+            X = (self.grid_coords - pos.view(-1, 3)).T
 
-        co = (R <= radius)
-        R = R[co]
-        X = X[:, co]
-        Xm = Xm[co]
-
-        Phi = torch.atan2(X[1], X[0])
+            R = torch.norm(X, dim=0)
 
-        Theta = torch.acos(X[2] / R)
-        Theta[R < 1e-15] = 0
-        return {'radial': [R, Theta, Phi], 'co': co}, Xm.view(1, -1)
+            co = (R <= radius)
+            R = R[co]
+            X = X[:, co]
+            Xm = Xm[co]
+        else:
+            # Only visit grid points in the vicinity of pos
+            candidates = self.grid_tree().query_ball_point(pos.detach().numpy(), radius * (1 + 1e-8))
+            Xm = torch.from_numpy(np.sort(np.asarray(candidates, dtype=np.int64)))
+            X = (self.grid_coords[Xm] - pos.view(-1, 3)).T
+
+            R = torch.norm(X, dim=0)
+
+            co = (R <= radius)
+            R = R[co]
+            X = X[:, co]
+            Xm = Xm[co]
+
+        return {'radial': [R] + self.angular_coords(X[0], X[1], X[2], R), 'co': co}, Xm.view(1, -1)
+
+
+def _periodic_range(rmax, cm, lower, upper, g):
+    """ All integer offsets r in [-rmax, rmax] (ascending) with
+    lower <= (cm + r) mod g < upper, obtained from the periodic images of
+    [lower, upper) without masking
+    """
+    ranges = []
+    k = (cm - rmax - lower) // g
+    while k * g + lower - cm <= rmax:
+        start = max(-rmax, k * g + lower - cm)
+        stop = min(rmax + 1, k * g + upper - cm)
+        if stop > start:
+            ranges.append(torch.arange(start, stop))
+        k += 1
+    if not ranges:
+        return torch.zeros(0, dtype=torch.int64)
+    return torch.cat(ranges)
 
 
 def shift(c, g):
@@ -5,6 +5,9 @@ Implements different symmetrizers. Symmetrizers ensure that descriptors are
 invariant with respect to global rotations.
 """
 from abc import abstractmethod
+from functools import lru_cache, wraps
+from itertools import groupby
+from math import factorial
 
 import numpy as np
 import torch
@@ -17,6 +20,14 @@ TorchModule = torch.nn.Module
 
 
 def convert_torch_wrapper(func):
+    """ Wrap func, which operates on torch tensors, so that it also accepts a
+    np.ndarray as first argument (and returns one in that case). Functions that
+    are already wrapped are returned as they are.
+    """
+    if getattr(func, 'converts_numpy', False):
+        return func
+
+    @wraps(func)
     def wrapped_func(X, *args, **kwargs):
         made_tensor = False
         if isinstance(X, np.ndarray):
@@ -28,9 +39,136 @@ def convert_torch_wrapper(func):
         else:
             return Y
 
+    wrapped_func.converts_numpy = True
+    return wrapped_func
+
+
+def not_traced(func):
+    """ Table construction in func should not be recorded if called during tracing
+    (cached tables become constants of the traced graph)
+    """
+    @wraps(func)
+    def wrapped_func(*args, **kwargs):
+        tracing_state = torch._C._get_tracing_state()
+        torch._C._set_tracing_state(None)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            torch._C._set_tracing_state(tracing_state)
+
     return wrapped_func
 
 
+@lru_cache()
+@not_traced
+def l_mask(n_l):
+    """ (n_l**2, n_l) matrix that sums the 2l+1 m-components of every l when
+    multiplied with descriptors in (l, m) order
+    """
+    l = torch.repeat_interleave(torch.arange(n_l), 2 * torch.arange(n_l) + 1)
+    return torch.nn.functional.one_hot(l, n_l).to(torch.get_default_dtype())
+
+
+def clebsch_gordan(l1, m1, l2, m2, l, m):
+    """ Clebsch-Gordan coefficient <l1 m1 l2 m2|l m> (Racah formula, Condon-Shortley
+    phase convention)
+    """
+    if m1 + m2 != m or not abs(l1 - l2) <= l <= l1 + l2 or abs(m1) > l1 or abs(m2) > l2 or abs(m) > l:
+        return 0.0
+    f = factorial
+    prefactor = (2 * l + 1) * f(l + l1 - l2) * f(l - l1 + l2) * f(l1 + l2 - l) / f(l1 + l2 + l + 1)
+    prefactor *= f(l + m) * f(l - m) * f(l1 - m1) * f(l1 + m1) * f(l2 - m2) * f(l2 + m2)
+    total = 0
+    for k in range(max(0, l2 - l - m1, l1 - l + m2), min(l1 + l2 - l, l1 - m1, l2 + m2) + 1):
+        total += (-1)**k / (f(k) * f(l1 + l2 - l - k) * f(l1 - m1 - k) * f(l2 + m2 - k) * f(l - l2 + m1 + k) *
+                            f(l - l1 - m2 + k))
+    return np.sqrt(prefactor) * total
+
+
+def complex_to_real(l):
+    """ Unitary (2l+1, 2l+1) matrix U with Y_real = U Y_complex for the real spherical
+    harmonics used by the projectors (see utils.geom.SH_all), rows and columns
+    ordered by m = -l, ..., l
+    """
+    U = np.zeros([2 * l + 1, 2 * l + 1], dtype=complex)
+    U[l, l] = 1
+    for m in range(1, l + 1):
+        U[l + m, l + m] = 1 / np.sqrt(2)
+        U[l + m, l - m] = (-1)**m / np.sqrt(2)
+        U[l - m, l + m] = -1j / np.sqrt(2)
+        U[l - m, l - m] = 1j * (-1)**m / np.sqrt(2)
+    return U
+
+
+def real_coupling(l1, l2, l):
+    """ Coupling coefficients T[m1, m2, m] of real descriptors, such that
+    sum T c_l1m1 c_l2m2 c_lm is invariant under rotations. Obtained by transforming
+    the Clebsch-Gordan coefficients to the real basis. These are either purely real
+    or (l1 + l2 + l odd) purely imaginary, in which case the imaginary part is used.
+    """
+    cg = np.zeros([2 * l1 + 1, 2 * l2 + 1, 2 * l + 1])
+    for m1 in range(-l1, l1 + 1):
+        for m2 in range(-l2, l2 + 1):
+            if abs(m1 + m2) <= l:
+                cg[l1 + m1, l2 + m2, l + m1 + m2] = clebsch_gordan(l1, m1, l2, m2, l, m1 + m2)
+    coupling = np.einsum('ijk,ai,bj,ck->abc', cg, complex_to_real(l1).conj(), complex_to_real(l2).conj(),
+                         complex_to_real(l))
+    return coupling.real if (l1 + l2 + l) % 2 == 0 else coupling.imag
+
+
+def bispectrum_triples(n_l):
+    """ Angular momenta (l1, l2, l) with l1 <= l2 <= l < n_l that satisfy the
+    triangle condition (other orderings give the same invariants). Triples with
+    two equal angular momenta and odd l1 + l2 + l are excluded, their coupling
+    is antisymmetric in the equal ones and the invariant vanishes identically.
+    """
+    return [(l1, l2, l) for l1 in range(n_l) for l2 in range(l1, n_l) for l in range(l2, min(l1 + l2, n_l - 1) + 1)
+            if not ((l1 == l2 or l2 == l) and (l1 + l2 + l) % 2 == 1)]
+
+
+@lru_cache()
+def bispectrum_coupling(n_l):
+    """ Coupling coefficients of all bispectrum_triples(n_l) as sparse tensor
+    with shape (n_triples, n_l**2, n_l**2, n_l**2), indices refer to descriptors
+    in (l, m) order. Computed once per n_l.
+    """
+    indices = []
+    values = []
+    for t, (l1, l2, l) in enumerate(bispectrum_triples(n_l)):
+        coupling = real_coupling(l1, l2, l)
+        m1, m2, m = np.nonzero(np.abs(coupling) > 1e-12)
+        indices.append(np.stack([np.full(len(m), t), l1**2 + m1, l2**2 + m2, l**2 + m]))
+        values.append(coupling[m1, m2, m])
+    shape = (len(values), n_l**2, n_l**2, n_l**2)
+    return torch.sparse_coo_tensor(np.concatenate(indices, axis=1), np.concatenate(values), shape).coalesce()
+
+
+@lru_cache()
+@not_traced
+def _coupling_blocks(n_l):
+    """ bispectrum_coupling(n_l) as dense blocks, one for every pair (l1, l2), with
+    rows (m1, m2) and columns (l, m) for all triples starting with (l1, l2).
+    Also returns the descriptor column c_lm and the (one-hot) triple for every
+    column of the concatenated blocks.
+    """
+    coupling = bispectrum_coupling(n_l)
+    triple, k1, k2, k = coupling.indices()
+    values = coupling.values()
+    blocks = []
+    columns = []
+    for (l1, l2), group in groupby(enumerate(bispectrum_triples(n_l)), key=lambda t: t[1][:2]):
+        group = list(group)
+        start = len(columns)
+        block = torch.zeros(2 * l1 + 1, 2 * l2 + 1, sum([2 * l + 1 for _, (_, _, l) in group]), dtype=values.dtype)
+        for t, (_, _, l) in group:
+            entries = triple == t
+            block[k1[entries] - l1**2, k2[entries] - l2**2, len(columns) - start + k[entries] - l**2] = values[entries]
+            columns += [(t, l**2 + m) for m in range(2 * l + 1)]
+        blocks.append((l1, l2, block.reshape(-1, block.shape[-1])))
+    columns = torch.tensor(columns)
+    return blocks, columns[:, 1], torch.nn.functional.one_hot(columns[:, 0]).to(values.dtype)
+
+
 class SymmetrizerRegistry(ABCRegistry):
     REGISTRY = {}
 
@@ -73,8 +211,18 @@ class BaseSymmetrizer(TorchModule, BaseEstimator, TransformerMixin, metaclass=Sy
         self._attrs = symmetrize_instructions
         self._cgs = 0
 
+    def __init_subclass__(cls, **kwargs):
+        # numpy/torch dispatch is fixed once per symmetrizer class, get_symmetrized
+        # calls _symmetrize_function without any further wrapping
+        super().__init_subclass__(**kwargs)
+        function = cls.__dict__.get('_symmetrize_function')
+        if isinstance(function, staticmethod):
+            cls._symmetrize_function = staticmethod(convert_torch_wrapper(function.__func__))
+
     def forward(self, C):
-        return BaseSymmetrizer.get_symmetrized(self, C)
+        if isinstance(C, tuple):
+            return self.get_symmetrized(C[0]), C[1]
+        return self.get_symmetrized(C)
 
     @abstractmethod
     def _symmetrize_function(c, n_l, n, *args):
@@ -116,11 +264,14 @@ class BaseSymmetrizer(TorchModule, BaseEstimator, TransformerMixin, metaclass=Sy
         basis = self._attrs['basis']
         results = []
         grad_mult = {0: 1, 1: 2, 2: 4}[basis.get('grad', 0)]
+        # Looked up on the class: symmetrizers pickled by earlier versions store
+        # (nested) numpy wrappers as instance attribute
+        symmetrize = type(self)._symmetrize_function
 
         for idx, key, data in expand(C):
-            results.append({})
-            results[idx][key] = self._symmetrize_function(*data, basis[key]['l'], basis[key]['n'] * grad_mult,
-                                                          self._cgs)
+            if idx == len(results):
+                results.append({})
+            results[idx][key] = symmetrize(*data, basis[key]['l'], basis[key]['n'] * grad_mult, self._cgs)
 
         if not isinstance(C, list):
             return results[0]
@@ -139,10 +290,6 @@ class TraceSymmetrizer(BaseSymmetrizer):
 
         BaseSymmetrizer.__init__(self, *args, **kwargs)
 
-    def get_symmetrized(self, C):
-        self._symmetrize_function = convert_torch_wrapper(self._symmetrize_function)
-        return BaseSymmetrizer.get_symmetrized(self, C)
-
     @staticmethod
     def _symmetrize_function(c, n_l, n, *args):
         """ Returns the symmetrized version of c
@@ -163,15 +310,8 @@ class TraceSymmetrizer(BaseSymmetrizer):
         """
         c_shape = c.size()
 
-        c = c.view(-1, c_shape[-1])
-        traces = []
-        idx = 0
-
-        for n_ in range(0, n):
-            for l in range(n_l):
-                traces.append(torch.norm(c[:, idx:idx + (2 * l + 1)], dim=1)**2)
-                idx += 2 * l + 1
-        traces = torch.stack(traces).T
+        c = c.reshape(-1, n, n_l**2)
+        traces = (c * c) @ l_mask(n_l).to(c.dtype)
 
         return traces.view(*c_shape[:-1], -1)
 
@@ -186,10 +326,6 @@ class MixedTraceSymmetrizer(BaseSymmetrizer):
     def __init__(self, *args, **kwargs):
         BaseSymmetrizer.__init__(self, *args, **kwargs)
 
-    def get_symmetrized(self, C):
-        self._symmetrize_function = convert_torch_wrapper(self._symmetrize_function)
-        return BaseSymmetrizer.get_symmetrized(self, C)
-
     @staticmethod
     def _symmetrize_function(c, n_l, n, *args):
         """ Return trace of c_m c_m' with mixed radial channels
@@ -211,22 +347,61 @@ class MixedTraceSymmetrizer(BaseSymmetrizer):
         """
         c_shape = c.size()
 
-        c = c.view(-1, c_shape[-1])
-        c = c.view(len(c), n, -1)
-        traces = []
+        c = c.reshape(-1, n, n_l**2)
+        mask = l_mask(n_l).to(c.dtype)
+        # One product and segment sum over m (all l at once) per pair of radial channels
+        traces = [(c[:, n1] * c[:, n2]) @ mask for n1 in range(n) for n2 in range(n1, n)]
+        traces = torch.stack(traces, dim=1)
+
+        return traces.view(*c_shape[:-1], -1)
 
-        for n1 in range(0, n):
-            for n2 in range(n1, n):
-                idx = 0
-                for l in range(n_l):
-                    traces.append(torch.sum(c[:,n1,idx:idx+(2*l+1)]*\
-                                           c[:,n2,idx:idx+(2*l+1)],
-                                            dim = -1))
-                    idx += 2 * l + 1
 
-        traces = torch.stack(traces).T
+class BispectrumSymmetrizer(BaseSymmetrizer):
+    """ Bispectrum invariants of every radial channel in addition to the traces
+    of TraceSymmetrizer.
 
-        return traces.view(*c_shape[:-1], -1)
+    :_registry_name: 'bispectrum'
+    """
+
+    _registry_name = 'bispectrum'
+
+    def __init__(self, *args, **kwargs):
+        BaseSymmetrizer.__init__(self, *args, **kwargs)
+
+    @staticmethod
+    def _symmetrize_function(c, n_l, n, *args):
+        """ Returns traces followed by the bispectrum
+        sum_{m1,m2,m} T^{l1 l2 l}_{m1 m2 m} c_{n l1 m1} c_{n l2 m2} c_{n l m}
+        for all (l1, l2, l) in bispectrum_triples(n_l). Coupling coefficients
+        T (see bispectrum_coupling) are precomputed once per n_l. Products
+        c_{l1} x c_{l2} of all atoms and radial channels are coupled with one
+        matrix multiplication per pair (l1, l2).
+
+        Parameters
+        -----------
+        c: np.ndarray of floats
+            Stores the tensor elements in the order (n,l,m)
+        n_l: int
+            number of angular momenta (not equal to maximum ang. momentum! example: if only s-orbitals n_l would be 1)
+        n: int
+            number of radial functions
+
+        Returns
+        -------
+        np.ndarray
+            Traces (n * n_l) and bispectrum (n * len(bispectrum_triples(n_l)))
+        """
+        c_shape = c.size()
+
+        traces = TraceSymmetrizer._symmetrize_function(c, n_l, n).reshape(-1, n * n_l)
+        c = c.reshape(-1, n_l**2)
+        blocks, columns, triples = _coupling_blocks(n_l)
+        coupled = [(c[:, l1**2:(l1 + 1)**2, None] * c[:, None, l2**2:(l2 + 1)**2]).reshape(len(c), -1)
+                   @ block.to(c.dtype) for l1, l2, block in blocks]
+        bispectrum = (torch.cat(coupled, dim=-1) * c.index_select(1, columns)) @ triples.to(c.dtype)
+        bispectrum = bispectrum.reshape(len(traces), -1)
+
+        return torch.cat([traces, bispectrum], dim=-1).view(*c_shape[:-1], -1)
 
 
 class CasimirSymmetrizer(TraceSymmetrizer):  #Alias for backwards compatibility
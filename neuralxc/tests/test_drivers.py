@@ -43,6 +43,29 @@ def test_fit():
     shutil.rmtree(test_dir + '/driver_data_tmp')
 
 
+@pytest.mark.driver
+@pytest.mark.driver_fit
+def test_fit_sets():
+    os.chdir(test_dir)
+    shcopytree(test_dir + '/driver_data', test_dir + '/driver_data_tmp')
+    cwd = os.getcwd()
+    os.chdir(test_dir + '/driver_data_tmp')
+    # Mini-batches smaller than the data set contain samples of only one of the sets
+    open('sets_two.inp', 'w').write('data.hdf5\nsystem/it0 system/ref\nsystem/it1 system/ref\n')
+    fit_driver(preprocessor='pre.json', hyper='hyper.json', sets='sets_two.inp', batch_size=3)
+    # Subtract model predictions from second set only
+    open('sets_two.inp', 'w').write('data.hdf5\nsystem/it0 system/ref\n*system/it1 system/ref\n')
+    results = fit_driver(preprocessor='pre.json',
+                         hyper='hyper.json',
+                         model='best_model',
+                         sets='sets_two.inp',
+                         batch_size=3)
+    assert np.isfinite(results['rmse'])
+
+    os.chdir(cwd)
+    shutil.rmtree(test_dir + '/driver_data_tmp')
+
+
 @pytest.mark.driver
 @pytest.mark.driver_fit
 def test_eval():
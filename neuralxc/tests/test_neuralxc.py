@@ -57,6 +57,345 @@ def test_siesta_density_getter():
             assert np.allclose(results_ref[key], results[key])
 
 
+@pytest.mark.fast
+@pytest.mark.parametrize('chunk_size', [7, 2**24])
+def test_formatted_density_getters(tmpdir, chunk_size, monkeypatch):
+    from neuralxc.utils import density_getter
+    read_values = density_getter.read_values
+    monkeypatch.setattr(density_getter, 'read_values', lambda *args: read_values(*args, chunk_size=chunk_size))
+    np.random.seed(42)
+    unitcell = np.diag(np.random.rand(3) * 10)
+    grid = np.array([5, 7, 3])
+    rho_ref = np.random.rand(2, *grid)
+
+    path = os.path.join(str(tmpdir), 'test.RHO')
+    with open(path, 'w') as rhofile:
+        for vec in unitcell:
+            rhofile.write('{:16.8f}{:16.8f}{:16.8f}\n'.format(*vec))
+        rhofile.write('{} {} {} 2\n'.format(*grid))
+        for value in rho_ref.transpose(0, 3, 2, 1).flatten():
+            rhofile.write('{:.10e}\n'.format(value))
+    rho, unitcell_read, grid_read = xc.utils.SiestaDensityGetter(binary=False).get_density(path)
+    assert np.allclose(unitcell_read, unitcell)
+    assert np.all(grid_read == grid)
+    assert np.allclose(rho, rho_ref)
+
+    path = os.path.join(str(tmpdir), 'test.cube')
+    with open(path, 'w') as cubefile:
+        cubefile.write('comment\ncomment\n')
+        cubefile.write('    2    0.000000    0.000000    0.000000\n')
+        for g, vec in zip(grid, unitcell):
+            cubefile.write('{:5d}{:12.6f}{:12.6f}{:12.6f}\n'.format(g, *(vec / g)))
+        cubefile.write('    8    0.000000    0.000000    0.000000    0.000000\n' * 2)
+        for row in rho_ref[0].reshape(-1, grid[2]):
+            for i in range(0, len(row), 6):
+                cubefile.write(' '.join(['{:13.5e}'.format(v) for v in row[i:i + 6]]) + '\n')
+    rho, unitcell_read, grid_read = xc.utils.density_getter.density_getter_factory('cube').get_density(path)
+    assert np.allclose(unitcell_read, unitcell)
+    assert np.all(grid_read == grid)
+    assert np.allclose(rho, rho_ref[0], atol=1e-5)
+
+
+@pytest.mark.fast
+@pytest.mark.parametrize('mmap', [True, False])
+def test_siesta_density_getter_bin(tmpdir, mmap):
+    from scipy.io import FortranFile
+    np.random.seed(42)
+    unitcell = np.random.rand(3, 3)
+    grid = np.array([5, 7, 3])
+    rho_ref = np.random.rand(2, *grid).astype(np.float32)
+
+    path = os.path.join(str(tmpdir), 'test.RHOXC')
+    with FortranFile(path, 'w') as rhofile:
+        rhofile.write_record(unitcell)
+        rhofile.write_record(np.array([*grid, 2], dtype=np.int32))
+        for spin in range(2):
+            for z in range(grid[2]):
+                for y in range(grid[1]):
+                    rhofile.write_record(rho_ref[spin, :, y, z])
+
+    density_getter = xc.utils.SiestaDensityGetter(binary=True, mmap=mmap, dtype=np.float32)
+    rho, unitcell_read, grid_read = density_getter.get_density(path)
+    assert np.allclose(unitcell_read, unitcell)
+    assert np.all(grid_read == grid)
+    assert np.array_equal(rho, rho_ref)
+    if mmap:
+        assert not rho.flags['OWNDATA']
+
+    rho = xc.utils.SiestaDensityGetter(binary=True, mmap=mmap).get_density(path)[0]
+    assert rho.dtype == np.float64
+    assert np.array_equal(rho, rho_ref)
+
+    with open(path, 'ab') as rhofile:
+        rhofile.write(b'0000')
+    with pytest.raises(Exception):
+        density_getter.get_density(path)
+
+
+def write_densities(path, symbols):
+    """ Random densities for systems with given symbols in path/<index>/test.RHOXC
+    """
+    from ase import Atoms
+    from scipy.io import FortranFile
+    np.random.seed(42)
+    unitcell = np.eye(3) * 6 / Bohr
+    grid = np.array([12, 12, 12])
+    atoms = []
+    for i, sym in enumerate(symbols):
+        atoms.append(Atoms(sym, positions=np.random.rand(len(sym), 3) * 6, cell=np.eye(3) * 6, pbc=True))
+        os.mkdir(os.path.join(path, str(i)))
+        with FortranFile(os.path.join(path, str(i), 'test.RHOXC'), 'w') as rhofile:
+            rhofile.write_record(unitcell)
+            rhofile.write_record(np.array([*grid, 1], dtype=np.int32))
+            for _ in range(grid[1] * grid[2]):
+                rhofile.write_record(np.random.rand(grid[0]).astype(np.float32))
+    return atoms
+
+
+@pytest.mark.fast
+@pytest.mark.skipif(not ase_found, reason='requires ase')
+def test_preprocessor_stream(tmpdir, monkeypatch):
+    import h5py
+    from neuralxc.preprocessor import preprocessor as pre_module
+
+    atoms = write_densities(str(tmpdir), ['OHH', 'HH', 'OHH', 'HH', 'OHH'])
+    basis = {'O': {'n': 2, 'l': 2, 'r_o': 1.5}, 'H': {'n': 1, 'l': 2, 'r_o': 1.0}, 'projector': 'ortho'}
+    preprocessor = xc.preprocessor.Preprocessor(basis, str(tmpdir), atoms)
+    data = preprocessor.fit_transform(None)
+
+    calls = []
+    transform_one = pre_module.transform_one
+
+    def counting_transform_one(path, *args):
+        calls.append(path)
+        return transform_one(path, *args)
+
+    monkeypatch.setattr(pre_module, 'transform_one', counting_transform_one)
+    with h5py.File(os.path.join(str(tmpdir), 'data.hdf5'), 'a') as file:
+        dataset = preprocessor.transform_to_hdf5(file, 'system', 'method', 'basis')
+        assert dataset.dtype == np.float64
+        assert np.array_equal(dataset[:], data)
+        assert len(calls) == len(atoms)
+
+        # Resume after interruption: only missing systems are projected
+        dataset.attrs['n_done'] = 3
+        dataset[3:] = 0
+        calls.clear()
+        dataset = preprocessor.transform_to_hdf5(file, 'system', 'method', 'basis')
+        assert np.allclose(file['system/method/density/basis'][:], data)
+        assert len(calls) == 2
+
+
+@pytest.mark.fast
+@pytest.mark.skipif(not ase_found, reason='requires ase')
+def test_projector_pool(tmpdir):
+    from neuralxc.preprocessor import preprocessor as pre_module
+
+    atoms = write_densities(str(tmpdir), ['OHH', 'HH', 'OHH'])
+    basis = {'O': {'n': 2, 'l': 2, 'r_o': 1.5}, 'H': {'n': 1, 'l': 2, 'r_o': 1.0}, 'projector': 'ortho'}
+    pool = pre_module.get_worker_pool()
+    pool.clear()
+    results = []
+    for i, a in enumerate(atoms):
+        path = os.path.join(str(tmpdir), str(i), 'test.RHOXC')
+        results.append(pre_module.transform_one(path, a.get_positions() / Bohr, a.get_chemical_symbols(), basis))
+    # one density getter and one projector for all systems
+    assert len(pool) == 2
+    assert pool.hits == 2 * (len(atoms) - 1)
+
+    for i, a in enumerate(atoms):
+        pool.clear()
+        path = os.path.join(str(tmpdir), str(i), 'test.RHOXC')
+        assert np.array_equal(
+            results[i], pre_module.transform_one(path, a.get_positions() / Bohr, a.get_chemical_symbols(), basis))
+
+
+@pytest.mark.fast
+@pytest.mark.parametrize('backend', ['serial', 'thread', 'process'])
+def test_executor(backend):
+    from neuralxc.utils import executor
+
+    pool = executor.get_executor(backend, 2)
+    assert executor.get_executor(backend, 2) is pool
+    assert list(pool.map(pow, range(10), [2] * 10)) == [i**2 for i in range(10)]
+    assert executor.get_executor(backend, 1)._registry_name == 'serial'
+    executor.shutdown_executors()
+    assert executor.get_executor(backend, 2) is not pool
+    executor.shutdown_executors()
+
+
+@pytest.mark.fast
+@pytest.mark.skipif(not ase_found, reason='requires ase')
+def test_preprocessor_executor(tmpdir):
+    from neuralxc.preprocessor.driver import calculate_distributed
+    from neuralxc.utils.executor import get_executor
+
+    atoms = write_densities(str(tmpdir), ['OHH', 'HH', 'OHH'])
+    basis = {'O': {'n': 2, 'l': 2, 'r_o': 1.5}, 'H': {'n': 1, 'l': 2, 'r_o': 1.0}, 'projector': 'ortho'}
+    data = xc.preprocessor.Preprocessor(basis, str(tmpdir), atoms).fit_transform(None)
+    preprocessor = xc.preprocessor.Preprocessor(basis, str(tmpdir), atoms, executor=get_executor('thread', 2))
+    assert np.allclose(preprocessor.fit_transform(None), data)
+
+    # Engines change directories, threads would share them
+    with pytest.raises(ValueError):
+        calculate_distributed(atoms, 'siesta', str(tmpdir), {}, executor=get_executor('thread', 2))
+
+
+@pytest.mark.fast
+@pytest.mark.skipif(not ase_found, reason='requires ase')
+def test_executor_working_directory(tmpdir, monkeypatch):
+    from neuralxc.preprocessor.driver import calculate_system
+    from neuralxc.utils.executor import get_executor
+
+    atoms = write_densities(str(tmpdir), ['OHH', 'HH', 'OHH'])
+    basis = {'O': {'n': 2, 'l': 2, 'r_o': 1.5}, 'H': {'n': 1, 'l': 2, 'r_o': 1.0}, 'projector': 'ortho'}
+    data = xc.preprocessor.Preprocessor(basis, str(tmpdir), atoms).fit_transform(None)
+
+    # Workers are started outside of the directory preprocessing is called from
+    executor = get_executor('process', 2)
+    list(executor.map(abs, range(4)))
+    monkeypatch.chdir(str(tmpdir))
+
+    # Engine runs change into their directory (the engine without calculator fails once it is there)
+    dirs = [os.path.join(str(tmpdir), 'engine', str(i)) for i in range(4)]
+    os.makedirs(os.path.join(str(tmpdir), 'engine'))
+    with pytest.raises(AttributeError):
+        list(executor.map(calculate_system, dirs, atoms + atoms[:1], ['ase'] * 4, [{}] * 4))
+    # Workers are back in the directory they were started in
+    for cwd in executor.map(os.path.abspath, ['.'] * 8):
+        assert not cwd.startswith(os.path.join(str(tmpdir), 'engine'))
+
+    # Relative source paths are resolved in the calling process
+    preprocessor = xc.preprocessor.Preprocessor(basis, '.', atoms, executor=executor)
+    assert np.allclose(preprocessor.fit_transform(None), data)
+
+
+@pytest.mark.fast
+def test_lazy_sets(tmpdir):
+    import h5py
+    from neuralxc.ml.utils import load_sets
+
+    np.random.seed(42)
+    sets = {'a': (50, 12), 'b': (30, 20)}
+    with h5py.File(os.path.join(str(tmpdir), 'data.hdf5'), 'w') as file:
+        for name, (n, width) in sets.items():
+            for method in ['base', 'ref']:
+                file.create_dataset(name + '/' + method + '/energy', data=np.random.rand(n))
+                file[name + '/' + method].attrs['E0'] = 0.1
+            file.create_dataset(name + '/base/density/key', data=np.random.rand(n, width), chunks=(8, width))
+
+        # Reference: padded concatenation of sets, see load_sets
+        data_ref = np.zeros([80, 22])
+        data_ref[50:, 0] = 1
+        data_ref[:50, 1:13] = file['a/base/density/key'][:]
+        data_ref[50:, 1:21] = file['b/base/density/key'][:]
+        data_ref[:50, -1] = file['a/ref/energy'][:] - file['a/base/energy'][:]
+        data_ref[50:, -1] = file['b/ref/energy'][:] - file['b/base/energy'][:]
+
+        baseline, reference = ['a/base', 'b/base'], ['a/ref', 'b/ref']
+        assert np.allclose(load_sets(file, baseline, reference, 'key'), data_ref)
+        data = load_sets(file, baseline, reference, 'key', lazy=True)
+        assert data.shape == data_ref.shape
+        assert np.allclose(np.array(data), data_ref)
+        assert np.allclose(np.concatenate(list(data.iter_batches(7))), data_ref)
+
+        sample = np.random.permutation(80)[:33]
+        assert np.allclose(data.subset(sample).take(), data_ref[sample])
+        assert np.allclose(data[sample[:5], -1], data_ref[sample[:5], -1])
+        assert np.allclose(data.subset(data.system == 1)[::2], data_ref[50::2])
+
+        data_cut = load_sets(file, baseline, reference, 'key', 0.1, lazy=True)
+        assert np.allclose(np.array(data_cut), load_sets(file, baseline, reference, 'key', 0.1))
+        assert len(data_cut) < len(data)
+
+
+@pytest.mark.fast
+@pytest.mark.parametrize('storage', [{}, {
+    'compression': 'lzf',
+    'chunk_rows': 16
+}, {
+    'compression': 'gzip',
+    'dtype': 'float32'
+}])
+def test_storage_options(tmpdir, storage):
+    import h5py
+    from neuralxc.datastructures.hdf5 import add_data, storage_options
+    from neuralxc.ml.utils import load_sets
+
+    np.random.seed(42)
+    density = np.random.rand(40, 25)
+    with h5py.File(os.path.join(str(tmpdir), 'data.hdf5'), 'w') as file:
+        add_data('energy', file, np.random.rand(40), 'system', 'base', storage=storage)
+        add_data('energy', file, np.random.rand(40), 'system', 'ref', storage=storage)
+        add_data('key', file, density, 'system', 'base', storage=storage)
+        dataset = file['system/base/density/key']
+        assert dataset.dtype == np.dtype(storage.get('dtype', 'float64'))
+        assert dataset.compression == storage.get('compression', None)
+        assert file['system/base/energy'].dtype == np.float64
+        if storage:
+            assert dataset.chunks == (storage.get('chunk_rows', 40), 25)
+        data = load_sets(file, 'system/base', 'system/ref', 'key')
+        assert data.dtype == np.float64
+        assert np.allclose(data[:, 1:-1], density, atol=1e-6 if storage.get('dtype') == 'float32' else 0)
+
+    # Chunks span full rows and hold about chunk_bytes
+    assert storage_options({'dtype': 'float32'}, 1000, chunk_bytes=40000)['chunks'] == (10, 1000)
+    assert storage_options({}, 1000) == {}
+    assert not 'chunks' in storage_options({'dtype': 'float32', 'chunk_rows': 0}, 1000)
+
+
+@pytest.mark.fast
+@pytest.mark.skipif(not ase_found, reason='requires ase')
+def test_ragged_descriptors(tmpdir):
+    import h5py
+    from neuralxc.datastructures.hdf5 import (RaggedDescriptors, add_data, merge_sets, read_density)
+    from neuralxc.ml.utils import load_sets
+
+    atoms = write_densities(str(tmpdir), ['HH', 'OHH', 'HH', 'OHH', 'HH'])
+    basis = {'O': {'n': 2, 'l': 2, 'r_o': 1.5}, 'H': {'n': 1, 'l': 2, 'r_o': 1.0}, 'projector': 'ortho'}
+    preprocessor = xc.preprocessor.Preprocessor(basis, str(tmpdir), atoms)
+    dense = preprocessor.fit_transform(None)
+    ragged = preprocessor.transform_ragged()
+    assert len(ragged.values) < dense.size
+    assert np.allclose(ragged[:], dense)
+    assert np.allclose(ragged[np.array([4, 0, 1])], dense[[4, 0, 1]])
+    assert np.allclose(ragged.subset(slice(1, None, 2))[:], dense[1::2])
+
+    np.random.seed(42)
+    energies = np.random.rand(len(atoms))
+    with h5py.File(os.path.join(str(tmpdir), 'data.hdf5'), 'w') as file:
+        for system, data in [('dense', dense), ('ragged', ragged)]:
+            add_data('energy', file, energies, system, 'base')
+            add_data('energy', file, energies + 1, system, 'ref')
+            add_data('key', file, data, system, 'base')
+            file[system].attrs['species'] = preprocessor.species_string
+        assert isinstance(read_density(file, 'ragged/base/density/key'), RaggedDescriptors)
+        assert np.allclose(load_sets(file, 'ragged/base', 'ragged/ref', 'key'),
+                           load_sets(file, 'dense/base', 'dense/ref', 'key'))
+
+        # Streaming into ragged storage
+        preprocessor.basis_instructions = dict(basis, storage={'ragged': True})
+        preprocessor.transform_to_hdf5(file, 'stream', 'base', 'key')
+        assert np.allclose(read_density(file, 'stream/base/density/key')[:], dense)
+
+        # Grouping by species directly from ragged storage
+        grouper = xc.formatter.SpeciesGrouper(basis, [preprocessor.species_string] * 2)
+        baseline, reference = ['dense/base', 'ragged/base'], ['dense/ref', 'ragged/ref']
+        features, targets = grouper.transform(load_sets(file, baseline, reference, 'key'))
+        features_lazy, targets_lazy = grouper.transform(load_sets(file, baseline, reference, 'key', lazy=True))
+        for feat, feat_lazy in zip(features, features_lazy):
+            for spec in feat:
+                assert np.allclose(feat[spec], feat_lazy[spec])
+        assert np.allclose(np.concatenate(targets), np.concatenate(targets_lazy))
+
+        # Merging keeps ragged storage, padded sets are added as a single kind
+        for name, sets in [('merged_dense', ['dense/base', 'dense/base']), ('merged', ['ragged/base', 'dense/base'])]:
+            merge_sets(file, sets, 'key', new_name=name, E0={'O': 0, 'H': 0})
+        merged = read_density(file, 'merged/density/key')
+        assert isinstance(merged, RaggedDescriptors)
+        assert np.allclose(merged[:], file['merged_dense/density/key'][:])
+
+
 @pytest.mark.fast
 def test_formatter():
     with open(os.path.join(test_dir, 'h2o_rep.pckl'), 'rb') as file:
@@ -112,6 +451,201 @@ def test_species_grouper():
         assert np.allclose(C[spec], re_grouped[spec])
 
 
+@pytest.mark.fast
+def test_species_grouper_index():
+    basis_set = {'O': {'n': 2, 'l': 3, 'r_o': 1}, 'H': {'n': 2, 'l': 2, 'r_o': 1.5}}
+    vec_len = {'O': 18, 'H': 8}
+    sys_species = ['OHH', 'HOHH']
+    np.random.seed(42)
+    X = np.zeros([7, 1 + 42 + 1])
+    X[:, 0] = [0, 1, 0, 1, 1, 0, 1]
+    X[:, 1:] = np.random.rand(7, 43)
+    X[X[:, 0] == 0, 1 + 34:-1] = 0
+
+    species_grouper = xc.formatter.SpeciesGrouper(basis_set, sys_species)
+    features, targets = species_grouper.transform(X)
+    for sysidx, species in enumerate(sys_species):
+        X_sys = X[X[:, 0] == sysidx]
+        assert np.allclose(targets[sysidx], X_sys[:, -1])
+        idx = 1
+        loc = {'O': 0, 'H': 0}
+        for spec in species:
+            assert np.allclose(features[sysidx][spec][:, loc[spec]], X_sys[:, idx:idx + vec_len[spec]])
+            idx += vec_len[spec]
+            loc[spec] += 1
+    assert len(species_grouper._index_cache) == 2
+
+    X_sorted = np.concatenate([X[X[:, 0] == 0], X[X[:, 0] == 1]])
+    assert np.allclose(species_grouper.inverse_transform(features, targets), X_sorted)
+
+
+@pytest.mark.fast
+@pytest.mark.skipif(not torch_found, reason='requires torch')
+@pytest.mark.parametrize('symmetrizer_type', ['trace', 'mixed_trace'])
+def test_symmetrizers(symmetrizer_type):
+    basis_set = {'O': {'n': 3, 'l': 4, 'r_o': 1}, 'H': {'n': 2, 'l': 1, 'r_o': 1.5}}
+    np.random.seed(42)
+    C = {spec: np.random.rand(5, 2, basis_set[spec]['n'] * basis_set[spec]['l']**2) for spec in basis_set}
+    symmetrizer = xc.symmetrizer.Symmetrizer({'symmetrizer_type': symmetrizer_type, 'basis': basis_set})
+    D = symmetrizer.get_symmetrized(C)
+
+    for spec in basis_set:
+        n, n_l = basis_set[spec]['n'], basis_set[spec]['l']
+        c = C[spec].reshape(5, 2, n, n_l**2)
+        pairs = [(n1, n1) for n1 in range(n)] if symmetrizer_type == 'trace' else \
+                [(n1, n2) for n1 in range(n) for n2 in range(n1, n)]
+        ref = []
+        for n1, n2 in pairs:
+            for l in range(n_l):
+                ref.append(np.sum(c[..., n1, l**2:(l + 1)**2] * c[..., n2, l**2:(l + 1)**2], axis=-1))
+        assert np.allclose(D[spec], np.stack(ref, axis=-1))
+
+    # numpy/torch dispatch is set up once, repeated calls do not wrap again
+    for _ in range(3):
+        D_torch = symmetrizer.get_symmetrized({spec: torch.from_numpy(C[spec]) for spec in C})
+    assert not '_symmetrize_function' in symmetrizer.__dict__
+    for spec in basis_set:
+        assert isinstance(D_torch[spec], torch.Tensor)
+        assert np.allclose(D_torch[spec].numpy(), D[spec])
+
+
+@pytest.mark.fast
+@pytest.mark.skipif(not torch_found, reason='requires torch')
+def test_bispectrum_symmetrizer():
+    n, n_l = 3, 5
+    basis_set = {'X': {'n': n, 'l': n_l, 'r_o': 1}}
+    symmetrizer = xc.symmetrizer.Symmetrizer({'symmetrizer_type': 'bispectrum', 'basis': basis_set})
+
+    # Expand a random point cloud (weights w) in radial functions exp(-(k+1)r) and real spherical harmonics
+    def coefficients(points, w):
+        r = torch.norm(points, dim=-1)
+        Y = xc.utils.geom.SH_all_cartesian(n_l - 1, *(points / r.unsqueeze(-1)).T)
+        radials = torch.stack([torch.exp(-(k + 1) * r) for k in range(n)])
+        return torch.einsum('p,np,kp->nk', w, radials, Y).reshape(1, 1, -1).numpy()
+
+    np.random.seed(42)
+    points = torch.from_numpy(np.random.rand(7, 3) * 2 - 1)
+    w = torch.from_numpy(np.random.rand(7))
+    rotation = np.linalg.qr(np.random.rand(3, 3))[0]
+    rotation = torch.from_numpy(rotation * np.linalg.det(rotation))  # Proper rotation
+    C = {'X': np.concatenate([coefficients(points, w), coefficients(points @ rotation.T, w)])}
+    D = symmetrizer.get_symmetrized(C)['X']
+
+    triples = xc.symmetrizer.symmetrizer.bispectrum_triples(n_l)
+    assert D.shape == (2, 1, n * n_l + n * len(triples))
+    assert np.allclose(D[0], D[1])
+    traces = xc.symmetrizer.symmetrizer.TraceSymmetrizer._symmetrize_function(C['X'], n_l, n)
+    assert np.allclose(D[..., :n * n_l], traces)
+
+    coupling = xc.symmetrizer.symmetrizer.bispectrum_coupling(n_l).to_dense().numpy()
+    c = C['X'].reshape(2, 1, n, n_l**2)
+    bispectrum = np.einsum('tabc,...a,...b,...c->...t', coupling, c, c, c)
+    assert np.allclose(D[..., n * n_l:].reshape(2, 1, n, -1), bispectrum)
+
+
+@pytest.mark.fast
+@pytest.mark.skipif(not torch_found, reason='requires torch')
+def test_torch_path():
+    basis_set = {'O': {'n': 2, 'l': 3, 'r_o': 1}, 'H': {'n': 2, 'l': 2, 'r_o': 1.5}}
+    pipeline = xc.ml.utils.get_default_pipeline(basis_set, ['OHH', 'OHH'])
+    np.random.seed(42)
+    X = np.random.rand(20, 1 + 34 + 1)
+    X[:, 0] = np.arange(20) // 10
+    X[:, 1 + 18:1 + 26] = 0.5  # Zero variance, dropped by var_selector
+
+    steps = [step[1] for step in pipeline.steps]
+    transformed = [X]
+    for step in steps[:-1]:
+        transformed.append(step.fit(transformed[-1]).transform(transformed[-1]))
+    selected, transformed = transformed[3], transformed[-1]
+    estimator = steps[-1]
+    estimator.build_network()
+    estimator._network.build_species_nets(transformed[0][0])
+    predicted = estimator.predict(transformed)[0]
+
+    # Transformers are not re-wrapped by repeated transforms, old (pickled) wrappers are dropped
+    var_selector = steps[2]
+    var_selector._spec_dict['O'].torch_transform = \
+        xc.ml.transformer.convert_torch_wrapper(var_selector._spec_dict['O'].torch_transform)
+    del var_selector._spec_dict['O']._torch_cache
+    for _ in range(3):
+        assert np.allclose(var_selector.transform(steps[1].transform(steps[0].transform(X)))[0][0]['O'],
+                           selected[0][0]['O'])
+    for spec in basis_set:
+        assert not 'torch_transform' in var_selector._spec_dict[spec].__dict__
+
+    pipeline.to_torch()
+    energies = pipeline.forward(torch.from_numpy(X))
+    assert isinstance(energies[0], torch.Tensor)
+    assert np.allclose(energies[0].detach().numpy(), predicted)
+
+
+@pytest.mark.fast
+@pytest.mark.skipif(not torch_found, reason='requires torch')
+@pytest.mark.parametrize('prefetch', [0, 2])
+def test_batch_loader(prefetch):
+    from neuralxc.ml.network import BatchLoader
+    np.random.seed(42)
+    rho = {'O': np.random.rand(23, 1, 5), 'H': np.random.rand(23, 2, 3)}
+    energies = np.arange(23, dtype=float)
+
+    loader = BatchLoader(rho, energies, batch_size=5, shuffle=True, share_memory=True, prefetch=prefetch)
+    assert len(loader) == 5
+    for _ in range(2):
+        batches = list(loader)
+        assert [len(energy) for _, energy in batches] == [5, 5, 5, 5, 3]
+        samples = torch.cat([energy for _, energy in batches])[:, 0].long().numpy()
+        assert sorted(samples) == list(range(23))
+        for spec in rho:
+            assert np.allclose(torch.cat([batch[spec] for batch, _ in batches]).numpy(), rho[spec][samples])
+
+    # Without shuffling batches are slices of the stored tensors
+    loader = BatchLoader(rho, energies, batch_size=10, prefetch=prefetch)
+    batch, energy = next(iter(loader))
+    assert batch['O'].data_ptr() == loader.rho['O'].data_ptr()
+    assert np.allclose(energy[:, 0].numpy(), energies[:10])
+    assert len(list(BatchLoader(rho, energies, prefetch=prefetch))) == 1
+
+
+@pytest.mark.fast
+@pytest.mark.skipif(not torch_found, reason='requires torch')
+def test_train_net(tmpdir, capsys):
+    from neuralxc.ml.network import BatchLoader, EnergyNetwork, train_net
+    np.random.seed(42)
+    torch.manual_seed(42)
+    rho = {'O': np.random.rand(40, 1, 5), 'H': np.random.rand(40, 2, 5)}
+    energies = rho['O'].sum(axis=(1, 2)) + rho['H'].sum(axis=(1, 2))
+    loader = BatchLoader({spec: rho[spec][:30] for spec in rho}, energies[:30], batch_size=10, shuffle=True)
+    loader_val = BatchLoader({spec: rho[spec][30:] for spec in rho}, energies[30:])
+    net = EnergyNetwork(n_nodes=4, n_layers=1, activation='GELU')
+    net.build_species_nets(rho)
+    checkpoint = os.path.join(str(tmpdir), 'checkpoint.pt')
+
+    # Evaluations every 10 epochs, training diverges with large learning rate
+    train_net(net, loader, loader_val, max_steps=200, n_checkpoints=20, lr=10, patience=2, checkpoint=checkpoint)
+    saved = torch.load(checkpoint)
+    assert saved['finished'] and saved['epoch'] < 200
+    assert saved['bad_evaluations'] == 2
+    for key, value in net.state_dict().items():
+        assert torch.equal(value, saved['best_model'][key])
+    with torch.no_grad():
+        val_loss = np.sqrt(torch.nn.MSELoss()(net(loader_val.rho), loader_val.energies).item())
+    assert np.isclose(val_loss, saved['best_loss'])
+
+    # Resume interrupted training
+    net = EnergyNetwork(n_nodes=4, n_layers=1, activation='GELU')
+    net.build_species_nets(rho)
+    train_net(net, loader, loader_val, max_steps=50, n_checkpoints=5, lr=1e-3, checkpoint=checkpoint + '2')
+    assert torch.load(checkpoint + '2')['epoch'] == 41
+    capsys.readouterr()
+    train_net(net, loader, loader_val, max_steps=100, n_checkpoints=10, lr=1e-3, checkpoint=checkpoint + '2',
+              resume=True)
+    output = capsys.readouterr().out
+    assert 'Resuming training from epoch 41' in output
+    assert not 'Epoch 0 ' in output and 'Epoch 50 ' in output
+    assert torch.load(checkpoint + '2')['epoch'] == 91
+
+
 @pytest.mark.skipif(not ase_found, reason='requires ase')
 @pytest.mark.realspace
 def test_neuralxc_benzene():
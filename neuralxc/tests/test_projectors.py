@@ -6,6 +6,7 @@ import copy
 import os
 import sys
 from abc import ABC, abstractmethod
+from types import SimpleNamespace
 
 import dill as pickle
 import matplotlib.pyplot as plt
@@ -275,3 +276,265 @@ def test_gaussian_serialized():
         ref = pickle.load(file)
     for spec in basis_rep:
         assert np.allclose(basis_rep[spec], ref[spec])
+
+
+@pytest.fixture(scope='module', params=['ortho', 'gaussian'])
+def benzene(request):
+    """ Benzene density, positions and basis for both projector types. projector(**options)
+    creates a DensityProjector with options added to the basis instructions.
+    """
+    density_getter = xc.utils.SiestaDensityGetter(binary=True)
+    rho, unitcell, grid = density_getter.get_density(os.path.join(test_dir, 'benzene_test', 'benzene.RHOXC'))
+    positions = ase.io.read(os.path.join(test_dir, 'benzene_test', 'benzene.xyz'), '0').get_positions() / Bohr
+
+    if request.param == 'ortho':
+        basis = {'C': {'n': 3, 'l': 4, 'r_o': 2.0}, 'H': {'n': 2, 'l': 3, 'r_o': 1.5}}
+        species = ['C'] * 6 + ['H'] * 6
+    else:
+        basis = {"file": os.path.join(test_dir, "basis-test"), 'sigma': 2}
+        species = ['X'] * 12
+
+    def projector(**options):
+        basis_instructions = dict({'basis': basis, 'projector': request.param, 'grid': 'euclidean'}, **options)
+        basis_instructions = ConfigFile({"engine":
+            {"application": 'siesta'},
+            "preprocessor": basis_instructions})['preprocessor']
+        return xc.projector.DensityProjector(unitcell=unitcell, grid=grid, basis_instructions=basis_instructions)
+
+    return SimpleNamespace(rho=rho, unitcell=unitcell, grid=grid, positions=positions, species=species,
+                           projector=projector)
+
+
+@pytest.mark.project
+@pytest.mark.parametrize('options', [
+    pytest.param({'batched': True, 'batch_size': 4}, marks=pytest.mark.fast, id='batched'),
+    pytest.param({'stencil_cache': 16, 'stencil_exact': True}, marks=pytest.mark.fast, id='stencil_cache'),
+    pytest.param({'angular': 'cartesian'}, marks=pytest.mark.fast, id='cartesian'),
+    pytest.param({'radial_table': True, 'radial_table_tol': 1e-7}, marks=pytest.mark.fast, id='radial_table'),
+    pytest.param({'tiles': [3, 1, 2], 'tile_workers': 1}, marks=pytest.mark.fast, id='tiles'),
+    pytest.param({'tiles': [3, 1, 2], 'tile_workers': 2}, id='tiles_parallel'),
+])
+def test_projector_options(benzene, options):
+    """ Projection options change how descriptors are computed, not their values
+    """
+    positions = benzene.positions + np.array([0.02, 0.01, 0.12])
+    # First atom placed on a grid point
+    positions[0] = benzene.unitcell.T.dot(np.array([10, 20, 30]) / benzene.grid)
+    rho = np.stack([benzene.rho, benzene.rho])
+
+    reference = benzene.projector().get_basis_rep(rho, positions=positions, species=benzene.species)
+    basis_rep = benzene.projector(**options).get_basis_rep(rho, positions=positions, species=benzene.species)
+    atol = 1e-6 if options.get('radial_table') else 1e-8  # Spline interpolation error
+    for spec in reference:
+        assert np.allclose(basis_rep[spec], reference[spec], atol=atol)
+
+
+@pytest.mark.fast
+@pytest.mark.project
+@pytest.mark.parametrize('options', [{}, {
+    'batched': True
+}, {
+    'stencil_cache': 16,
+    'stencil_exact': True
+}],
+                         ids=['default', 'batched', 'stencil_cache'])
+def test_single_precision_density(benzene, options):
+    """ Memory-mapped single precision densities are projected without a double precision copy of the grid
+    """
+    density_getter = xc.utils.SiestaDensityGetter(binary=True, dtype=np.float32)
+    rho = density_getter.get_density(os.path.join(test_dir, 'benzene_test', 'benzene.RHOXC'))[0]
+    assert rho.dtype == np.float32 and not rho.flags['OWNDATA']
+
+    density_projector = benzene.projector(**options)
+    reference = density_projector.get_basis_rep(benzene.rho, positions=benzene.positions, species=benzene.species)
+    basis_rep = density_projector.get_basis_rep(rho, positions=benzene.positions, species=benzene.species)
+    for spec in reference:
+        assert basis_rep[spec].dtype == np.float64
+        assert np.allclose(basis_rep[spec], reference[spec])
+
+
+@pytest.mark.fast
+@pytest.mark.project
+def test_stencil_cache(benzene):
+    density_projector = benzene.projector(stencil_cache=16, stencil_exact=True)
+    basis_rep = density_projector.get_basis_rep(benzene.rho, positions=benzene.positions, species=benzene.species)
+
+    # Second call is served from cache
+    cached = density_projector.get_basis_rep(benzene.rho, positions=benzene.positions, species=benzene.species)
+    assert density_projector.stencils.hits == 12
+    assert len(density_projector.stencils) == 12
+    for spec in basis_rep:
+        assert np.allclose(cached[spec], basis_rep[spec])
+
+
+@pytest.mark.fast
+@pytest.mark.project
+def test_stencil_quantization(benzene):
+    exact = benzene.projector().get_basis_rep(benzene.rho, positions=benzene.positions, species=benzene.species)
+
+    # Offsets are rounded to 1/stencil_resolution of the grid spacing, error shrinks with finer resolution
+    scale = max([np.max(np.abs(exact[spec])) for spec in exact])
+    errors = []
+    for resolution in [100, 400]:
+        density_projector = benzene.projector(stencil_cache=16, stencil_resolution=resolution)
+        quantized = density_projector.get_basis_rep(benzene.rho, positions=benzene.positions, species=benzene.species)
+        errors.append(max([np.max(np.abs(quantized[spec] - exact[spec])) for spec in exact]))
+    assert errors[0] < 2e-3 * scale
+    assert errors[1] < errors[0] / 2
+
+    # Atoms with offsets that round to the same value share one stencil
+    grid_coordinates = np.array([[10.1001, 20.25, 30.3], [40.1003, 5.2502, 12.2999]])
+    positions = (grid_coordinates / benzene.grid).dot(benzene.unitcell)
+    species = benzene.species[:1] * 2
+    density_projector = benzene.projector(stencil_cache=16)
+    density_projector.get_basis_rep(benzene.rho, positions=positions, species=species)
+    assert len(density_projector.stencils) == 1
+    assert density_projector.stencils.hits == 1
+    density_projector = benzene.projector(stencil_cache=16, stencil_exact=True)
+    density_projector.get_basis_rep(benzene.rho, positions=positions, species=species)
+    assert len(density_projector.stencils) == 2
+
+
+@pytest.mark.fast
+@pytest.mark.project
+def test_radial_table(benzene):
+    density_projector = benzene.projector(radial_table=True, radial_table_tol=1e-7)
+    basis_rep = density_projector.get_basis_rep(benzene.rho, positions=benzene.positions, species=benzene.species)
+    for spec in basis_rep:
+        assert spec in density_projector.radial_tables
+        assert density_projector.radial_tables[spec].error <= 1e-7
+
+
+@pytest.mark.fast
+@pytest.mark.project
+def test_multichannel_projection(benzene):
+    density_projector = benzene.projector()
+    channels = [benzene.rho, benzene.rho**2, np.sqrt(benzene.rho + 1), -benzene.rho]
+    multi = density_projector.get_basis_rep(np.stack(channels), positions=benzene.positions, species=benzene.species)
+    for ic, channel in enumerate(channels):
+        single = density_projector.get_basis_rep(channel, positions=benzene.positions, species=benzene.species)
+        for spec in single:
+            assert np.allclose(multi[spec].reshape(len(single[spec]), len(channels), -1)[:, ic], single[spec])
+
+
+@pytest.mark.fast
+@pytest.mark.project
+@pytest.mark.parametrize('my_box', [[[0, 40], [0, 40], [0, 40]], [[5, 17], [0, 40], [30, 40]]])
+def test_mesh_3d(my_box):
+    unitcell = np.diag([10.0, 11.0, 12.0])
+    unitcell[0, 1] = 1.0
+    grid = np.array([40, 40, 40])
+    basis_instructions = {'X': {'n': 2, 'l': 2, 'r_o': 2.0}}
+    density_projector = xc.projector.OrthoEuclideanProjector(unitcell, grid, basis_instructions)
+    density_projector.set_cell_parameters(torch.from_numpy(unitcell), torch.from_numpy(grid).double())
+    my_box = torch.Tensor(my_box).double()
+    rmax = torch.Tensor([7, 6, 9]).double()
+    for cm in [[0, 0, 0], [39, 3, 20], [-2, 41, 35]]:
+        cm = torch.Tensor(cm).double()
+        Xm, X = density_projector.mesh_3d(density_projector.U, density_projector.a, rmax, my_box, cm, both=True)
+        Xm_ref = density_projector.mesh_3d_traceable(density_projector.U, density_projector.a, rmax, my_box, cm)
+        X_ref = density_projector.mesh_3d_traceable(density_projector.U,
+                                                    density_projector.a,
+                                                    rmax,
+                                                    my_box,
+                                                    cm,
+                                                    scaled=True)
+        cms = xc.projector.projector.shift(cm, density_projector.grid) - my_box[:, 0]
+        Xm_ref = torch.fmod((Xm_ref + cms.view(-1, 1, 1, 1)), density_projector.grid.view(-1, 1, 1, 1))
+        assert Xm.dtype == torch.int64
+        assert Xm.size() == Xm_ref.size()
+        assert torch.all(Xm == Xm_ref.long())
+        assert torch.allclose(X, X_ref)
+
+
+@pytest.mark.fast
+@pytest.mark.project
+def test_radial_spatial_index(monkeypatch):
+    np.random.seed(42)
+    grid_coords = np.random.rand(20000, 3) * 10
+    grid_weights = np.random.rand(20000)
+    rho = np.random.rand(20000)
+    positions = np.random.rand(5, 3) * 10
+    density_projector = xc.projector.OrthoRadialProjector(grid_coords, grid_weights,
+                                                          {'X': {'n': 3, 'l': 3, 'r_o': 2.0}})
+    basis_rep = density_projector.get_basis_rep(rho, positions, ['X'] * 5)
+    tree = density_projector.grid_tree()
+    density_projector.get_basis_rep(rho, positions, ['X'] * 5)
+    assert density_projector.grid_tree() is tree
+
+    # Tracing uses the dense distance calculation
+    monkeypatch.setattr(torch.jit, 'is_tracing', lambda: True)
+    basis_rep_dense = density_projector.get_basis_rep(rho, positions, ['X'] * 5)
+    assert np.allclose(basis_rep['X'], basis_rep_dense['X'])
+
+
+@pytest.mark.fast
+@pytest.mark.project
+@pytest.mark.parametrize('projector_type', ['ortho', 'gaussian'])
+def test_projection_matrix(projector_type):
+    np.random.seed(42)
+    grid_coords = np.random.rand(5000, 3) * 6
+    grid_weights = np.random.rand(5000)
+    grid_weights[:10] = 0
+    rho = np.random.rand(2, 5000)
+    positions = np.random.rand(3, 3) * 6
+    if projector_type == 'ortho':
+        basis = {'X': {'n': 3, 'l': 3, 'r_o': 2.0}, 'Y': {'n': 2, 'l': 2, 'r_o': 2.5}}
+        projector_class = xc.projector.OrthoRadialProjector
+    else:
+        basis = ConfigFile({
+            "engine": {"application": 'pyscf'},
+            "preprocessor": {"basis": {"file": os.path.join(test_dir, "basis-test")}, "projector": "gaussian",
+                             "grid": "radial"}
+        })['preprocessor']
+        basis.update({'Y': basis['X']})
+        projector_class = xc.projector.GaussianRadialProjector
+    species = ['X', 'Y', 'X']
+
+    density_projector = projector_class(grid_coords, grid_weights, basis)
+    basis_matrix = dict(basis, projection_matrix=True)
+    matrix_projector = projector_class(grid_coords, grid_weights, basis_matrix)
+    for channels in [rho[0], rho]:
+        basis_rep = density_projector.get_basis_rep(channels, positions, species)
+        basis_rep_matrix = matrix_projector.get_basis_rep(channels, positions, species)
+        for spec in basis_rep:
+            assert np.allclose(basis_rep[spec], basis_rep_matrix[spec])
+
+    A, _ = matrix_projector.get_projection_matrix(positions, species)
+    assert matrix_projector.get_projection_matrix(positions, species)[0] is A
+
+
+@pytest.mark.fast
+@pytest.mark.project
+def test_spherical_harmonics():
+    from neuralxc.utils import geom
+    theta = torch.linspace(0, np.pi, 50).view(-1, 1).expand(50, 40).double()
+    phi = torch.linspace(-np.pi, np.pi, 40).view(1, -1).expand(50, 40).double()
+    l_max = 5
+    sh_ref = torch.stack([geom.SH(l, m, theta, phi) for l in range(l_max + 1) for m in range(-l, l + 1)])
+    assert torch.allclose(geom.SH_all(l_max, theta, phi), sh_ref)
+    assert torch.allclose(torch.jit.script(geom.SH_all)(l_max, theta, phi), sh_ref)
+
+    # Cartesian evaluation from unit vectors
+    u = torch.stack([torch.sin(theta) * torch.cos(phi), torch.sin(theta) * torch.sin(phi), torch.cos(theta)])
+    assert torch.allclose(geom.SH_all_cartesian(l_max, *u), sh_ref)
+    assert torch.allclose(torch.jit.script(geom.SH_all_cartesian)(l_max, *u), sh_ref)
+
+    theta = theta[1:-1].clone().requires_grad_(True)
+    phi = phi[1:-1].clone().requires_grad_(True)
+    assert torch.autograd.gradcheck(lambda t, p: geom.SH_all(3, t, p), (theta[:3, :3], phi[:3, :3]))
+
+
+@pytest.mark.fast
+@pytest.mark.project
+def test_spline_table_gradient():
+    from neuralxc.utils.spline import SplineTable
+    table = SplineTable(lambda r: torch.stack([torch.sin(r), r**2 * torch.exp(-r)]), 3.0, tol=1e-10)
+    r = torch.linspace(0.01, 3.5, 200).requires_grad_(True)
+    y = table(r)
+    y.sum().backward()
+    within = r.detach() <= 3.0
+    assert torch.allclose(y[0, within], torch.sin(r[within]), atol=1e-9)
+    assert torch.all(y[:, ~within] == 0)
+    grad_ref = torch.cos(r) + (2 * r - r**2) * torch.exp(-r)
+    assert torch.allclose(r.grad[within], grad_ref[within], atol=1e-5)
@@ -0,0 +1,55 @@
+"""
+cache.py
+Simple least-recently-used cache used to store objects that are expensive to
+build but can be reused across calls (e.g. basis function stencils).
+"""
+
+from collections import OrderedDict
+
+
+class LRUCache():
+    def __init__(self, maxsize=128):
+        """ Dictionary-like container that holds at most maxsize entries. If full,
+        the least recently used entry is discarded.
+
+        Parameters
+        ----------
+        maxsize: int
+            Maximum number of entries, if <= 0 the cache is unbounded
+        """
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        if key in self._data:
+            self._data.move_to_end(key)
+            self.hits += 1
+            return self._data[key]
+        self.misses += 1
+        return default
+
+    def __setitem__(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if self.maxsize > 0:
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __getitem__(self, key):
+        value = self.get(key, KeyError)
+        if value is KeyError:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        self._data.clear()
+        self.hits = 0
+        self.misses = 0
@@ -1,11 +1,10 @@
 """Utility functions for real-space grid properties
 """
+import os
 import re
-import struct
 from abc import abstractmethod
 
 import numpy as np
-import pandas as pd
 
 from neuralxc.base import ABCRegistry
 
@@ -22,6 +21,50 @@ def get_dm(mo_coeff, mo_occ):
     return np.einsum('ij,j,jk -> ik', mo_coeff, mo_occ, mo_coeff.T)
 
 
+def read_values(file, count, chunk_size=2**24):
+    """ Parse count whitespace separated numbers from an open text file.
+    The file is tokenized in chunks of chunk_size characters that are split at
+    line breaks, so that only a single chunk is held in memory as text.
+
+    Parameters
+    ----------
+    file: file object
+        Text file, positioned at the first value
+    count: int
+        Number of values to read
+    chunk_size: int
+        Number of characters read at once
+
+    Returns
+    -------
+    np.ndarray float (count)
+    """
+    values = np.empty(count)
+    filled = 0
+    remainder = ''
+    while filled < count:
+        chunk = file.read(chunk_size)
+        if chunk:
+            chunk = remainder + chunk
+            cut = chunk.rfind('\n') + 1
+            if cut == 0:
+                remainder = chunk
+                continue
+            chunk, remainder = chunk[:cut], chunk[cut:]
+        else:
+            chunk, remainder = remainder, ''
+        parsed = np.fromstring(chunk, dtype=np.float64, sep=' ')
+        n = min(len(parsed), count - filled)
+        values[filled:filled + n] = parsed[:n]
+        filled += n
+        if not chunk:
+            break
+
+    if filled < count:
+        raise Exception('Expected {} values in {}, found {}'.format(count, getattr(file, 'name', file), filled))
+    return values
+
+
 class DensityGetterRegistry(ABCRegistry):
     REGISTRY = {}
 
@@ -46,15 +89,21 @@ class CubeDensityGetter(BaseDensityGetter):
 
     def get_density(self, file_path, return_dict=False):
 
-        rho = pd.read_csv(file_path, delim_whitespace=True, skiprows=9, header=None)
-        mask = (~rho.isna()).values.flatten()
-        rho = rho.values.flatten()
-        rho = rho[mask]
-        grid_dh = pd.read_csv(file_path, delim_whitespace=True, skiprows=3, header=None, nrows=3).values
-        grid = grid_dh[:, 0].astype(int)
-        unitcell = grid_dh[:, 1:] * grid
+        with open(file_path, 'r') as cubefile:
+            # two comment lines, number of atoms and origin, grid and voxel vectors
+            cubefile.readline()
+            cubefile.readline()
+            natoms = int(cubefile.readline().split()[0])
+            grid_dh = np.array([cubefile.readline().split()[:4] for i in range(3)], dtype=float)
+            grid = grid_dh[:, 0].astype(int)
+            unitcell = grid_dh[:, 1:] * grid.reshape(-1, 1)
+            for i in range(abs(natoms)):
+                cubefile.readline()
+            # negative number of atoms: additional line containing orbital indices
+            if natoms < 0:
+                cubefile.readline()
+            rho = read_values(cubefile, int(np.prod(grid))).reshape(*grid)
 
-        rho = rho.reshape(*grid)
         res = [rho, unitcell, grid]
 
         if return_dict:
@@ -141,14 +190,16 @@ class SiestaDensityGetter(BaseDensityGetter):
 
     _registry_name = 'siesta'
 
-    def __init__(self, binary, **kwargs):
+    def __init__(self, binary, mmap=True, dtype=np.float64, **kwargs):
         self._binary = binary
+        self._mmap = mmap
+        self._dtype = dtype
 
     def get_density(self, file_path, return_dict=False):
         if self._binary:
-            res = SiestaDensityGetter.get_density_bin(file_path)
+            res = SiestaDensityGetter.get_density_bin(file_path, self._mmap, self._dtype)
         else:
-            res = SiestaDensityGetter.get_density(file_path)
+            res = SiestaDensityGetter.get_density_formatted(file_path)
 
         if return_dict:
             return {'rho': res[0], 'unitcell': res[1], 'grid': res[2]}
@@ -156,31 +207,64 @@ class SiestaDensityGetter(BaseDensityGetter):
             return res
 
     @staticmethod
-    def get_density_bin(file_path):
-        """ Same as get_data for binary (unformatted) files
-        """
-        #Warning: Only works for cubic cells!!!
-        #TODO: Implement for arb. cells
-
-        bin_file = open(file_path, mode='rb')
+    def get_density_bin(file_path, mmap=True, dtype=np.float64):
+        """ Same as get_density_formatted for binary (unformatted) files.
+        The float32 payload is memory-mapped. With dtype=np.float32 it is
+        returned as a strided view without copying, so that only the parts of
+        the grid that are accessed (e.g. the points around atoms during
+        projection) are read from disk. Any other dtype returns a converted copy.
 
-        unitcell = '<I9dI'
-        grid = '<I4iI'
-
-        unitcell = np.array(struct.unpack(unitcell, bin_file.read(struct.calcsize(unitcell))))[1:-1].reshape(3, 3)
+        Parameters
+        -----------
+            file_path: string
+                path to RHO (or RHOXC) file from which density is read
+            mmap: bool
+                memory-map the file, otherwise the payload is read at once
+            dtype: numpy dtype
+                dtype of returned density
 
-        grid = np.array(struct.unpack(grid, bin_file.read(struct.calcsize(grid))))[1:-1]
-        if (grid[0] == grid[1] == grid[2]) and grid[3] == 1:
-            a = grid[0]
+        Returns
+        --------
+            rho: np.ndarray dtype (xpoints, ypoints, zpoints), spin-polarized files
+                are returned as (nspin, xpoints, ypoints, zpoints)
+            unitcell: np.ndarray (3, 3)
+            grid: np.ndarray int (3)
+        """
+        with open(file_path, mode='rb') as bin_file:
+            unitcell = SiestaDensityGetter._read_record(bin_file, '<f8').reshape(3, 3)
+            grid = SiestaDensityGetter._read_record(bin_file, '<i4').astype(int)
+            offset = bin_file.tell()
+            first_record = np.frombuffer(bin_file.read(4), dtype='<u4')
+
+        # One record (marker, x-row, marker) for every spin, z and y
+        nx, ny, nz, nspin = grid
+        shape = (nspin, nz, ny, nx + 2)
+        if len(first_record) != 1 or first_record[0] != 4 * nx or \
+                os.path.getsize(file_path) != offset + 4 * int(np.prod(shape)):
+            raise Exception('{} is not an unformatted SIESTA grid file'.format(file_path))
+
+        if mmap:
+            content = np.memmap(file_path, dtype='<f4', mode='c', offset=offset, shape=shape).view(np.ndarray)
         else:
-            raise Exception('get_data_bin cannot handle non-cubic unitcells or spin')
+            content = np.fromfile(file_path, dtype='<f4', offset=offset).reshape(shape)
 
-        block = '<' + 'I{}fI'.format(a) * a * a
-        content = np.array(struct.unpack(block, bin_file.read(struct.calcsize(block))))
-
-        rho = content.reshape(a + 2, a, a, order='F')[1:-1, :, :]
+        rho = content[..., 1:-1].transpose(0, 3, 2, 1)
+        if nspin == 1:
+            rho = rho[0]
+        if rho.dtype != dtype:
+            rho = rho.astype(dtype)
         return rho, unitcell, grid[:3]
 
+    @staticmethod
+    def _read_record(bin_file, dtype):
+        """ Read a single Fortran record (enclosed by its length in bytes)
+        """
+        length = np.frombuffer(bin_file.read(4), dtype='<u4')[0]
+        content = np.frombuffer(bin_file.read(length), dtype=dtype).copy()
+        if np.frombuffer(bin_file.read(4), dtype='<u4')[0] != length:
+            raise Exception('Corrupted record in {}'.format(bin_file.name))
+        return content
+
     @staticmethod
     def get_density_formatted(file_path):
         """Import data from RHO file (or similar real-space grid files)
@@ -198,7 +282,9 @@ class SiestaDensityGetter(BaseDensityGetter):
 
         Returns
         --------
-            Density
+            rho: np.ndarray (xpoints, ypoints, zpoints) or (nspin, xpoints, ypoints, zpoints)
+            unitcell: np.ndarray (3, 3)
+            grid: np.ndarray int (3)
         """
         unitcell = np.zeros([3, 3])
         grid = np.zeros([4])
@@ -212,16 +298,12 @@ class SiestaDensityGetter(BaseDensityGetter):
             grid[:] = rhofile.readline().split()
             grid = grid.astype(int)
 
-            # initiatialize density with right shape
-            rho = np.zeros(grid)
-
-            for z in range(grid[2]):
-                for y in range(grid[1]):
-                    for x in range(grid[0]):
-                        rho[x, y, z, 0] = rhofile.readline()
+            # one value per line, x runs fastest and spin slowest
+            rho = read_values(rhofile, int(np.prod(grid)))
 
-        # closed shell -> we don't care about spin.
-        rho = rho[:, :, :, 0]
+        rho = rho.reshape(grid[::-1]).transpose(0, 3, 2, 1)
+        if grid[3] == 1:
+            rho = rho[0]
         grid = grid[:3]
         return rho, unitcell, grid
 
@@ -0,0 +1,152 @@
+"""
+executor.py
+Executors that map a function over a list of tasks (engine runs, density
+projections) either serially, with threads, processes or on a local Dask
+cluster. Executors are created once per process through get_executor and
+shared by all drivers, so that repeated calls (self-consistent iterations,
+many-body expansion levels, preprocessing) do not start new pools.
+"""
+import atexit
+from abc import abstractmethod
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from neuralxc.base import ABCRegistry
+
+_executors = {}
+
+
+class ExecutorRegistry(ABCRegistry):
+    REGISTRY = {}
+
+
+class BaseExecutor(metaclass=ExecutorRegistry):
+
+    _registry_name = 'base'
+    # Workers share the working directory of the calling process
+    shares_cwd = False
+
+    def __init__(self, n_workers=1):
+        self.n_workers = n_workers
+
+    @abstractmethod
+    def map(self, func, *iterables):
+        """ Apply func to every set of arguments and yield results in order
+        """
+        pass
+
+    def shutdown(self):
+        pass
+
+
+class SerialExecutor(BaseExecutor):
+
+    _registry_name = 'serial'
+
+    def map(self, func, *iterables):
+        return map(func, *iterables)
+
+
+class ThreadExecutor(BaseExecutor):
+    """ Note that threads share the working directory, engines that change
+    directories (see driver.calculate_system) can not be run with threads.
+    """
+    _registry_name = 'thread'
+    shares_cwd = True
+
+    def __init__(self, n_workers=1):
+        self.n_workers = n_workers
+        self.pool = ThreadPoolExecutor(max_workers=n_workers)
+
+    def map(self, func, *iterables):
+        """ Tasks are submitted while results are consumed, at most n_workers are
+        pending at any time. Arguments created by generators (e.g. density tiles)
+        are therefore not all held in memory at once.
+        """
+        pending = deque()
+        for args in zip(*iterables):
+            if len(pending) >= self.n_workers:
+                yield pending.popleft().result()
+            pending.append(self.pool.submit(func, *args))
+        while pending:
+            yield pending.popleft().result()
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+
+class ProcessExecutor(ThreadExecutor):
+
+    _registry_name = 'process'
+    shares_cwd = False
+
+    def __init__(self, n_workers=1):
+        self.n_workers = n_workers
+        self.pool = ProcessPoolExecutor(max_workers=n_workers)
+
+
+class DaskExecutor(BaseExecutor):
+
+    _registry_name = 'dask'
+
+    def __init__(self, n_workers=1):
+        from dask.distributed import Client, LocalCluster
+        self.n_workers = n_workers
+        self.cluster = LocalCluster(n_workers=n_workers, threads_per_worker=1)
+        print(self.cluster)
+        self.client = Client(self.cluster)
+
+    def map(self, func, *iterables):
+        # pure=False: tasks with identical arguments (e.g. working directories) are not merged
+        futures = self.client.map(func, *iterables, pure=False)
+        return (f.result() for f in futures)
+
+    def shutdown(self):
+        self.client.close()
+        self.cluster.close()
+
+
+def get_executor(backend='dask', n_workers=1):
+    """
+    Return the executor for given backend and number of workers. Executors are
+    only created once and shut down when the interpreter exits. If n_workers <= 1
+    tasks are always executed serially.
+
+    Parameters:
+    ------------
+    backend : str
+        {'serial', 'thread', 'process', 'dask'}
+    n_workers : int
+        Number of workers
+
+    Returns:
+    --------
+    BaseExecutor
+    """
+    if n_workers <= 1:
+        backend, n_workers = 'serial', 1
+
+    registry = BaseExecutor.get_registry()
+    if not backend in registry or backend == 'base':
+        raise Exception('Executor: {} not registered'.format(backend))
+
+    key = (backend, n_workers)
+    if not key in _executors:
+        _executors[key] = registry[backend](n_workers)
+    return _executors[key]
+
+
+@atexit.register
+def shutdown_executors():
+    """ Shut down all executors created by get_executor
+    """
+    for executor in _executors.values():
+        executor.shutdown()
+    _executors.clear()
+
+
+def config_executor(config):
+    """ Shared executor as defined in config file, the backend is set by
+    preprocessor['executor'] (default: 'dask'), the number of workers by n_workers
+    """
+    return get_executor(config['preprocessor'].get('executor', 'dask'), config.get('n_workers', 1))
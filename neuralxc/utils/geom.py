@@ -1,6 +1,7 @@
 # Code adapted from https://github.com/BachiLi/redner/blob/master/pyredner/utils.py #
 # Spherical harmonics utility functions
 import math
+from typing import List
 
 import torch
 
@@ -40,3 +41,98 @@ def SH(l, m, theta, phi):
     else:
         return math.sqrt(2.0) * SH_renormalization(l, -m) * \
             torch.sin(-m * phi) * associated_legendre_polynomial(l, -m, torch.cos(theta), pmm, pll)
+
+
+def SH_all(l_max: int, theta: torch.Tensor, phi: torch.Tensor) -> torch.Tensor:
+    """ All real spherical harmonics up to l_max (physics convention for angles)
+    in one pass. Associated Legendre polynomials and cos(m*phi), sin(m*phi)
+    are built with the standard recurrences and shared between all (l, m).
+    Supports autograd and TorchScript.
+
+    Parameters
+    ----------
+    l_max: int
+        maximum angular momentum quantum number
+    theta: Tensor
+        longitudinal angle
+    phi: Tensor
+        azimuthal angle
+
+    Returns
+    -------
+    Tensor ((l_max + 1)**2, *theta.shape)
+        Stacked Y_lm ordered by l, then m = -l, ..., l (same order and
+        normalization as SH)
+    """
+    x = torch.cos(theta)
+    somx2 = torch.sqrt((1 - x) * (1 + x))
+    return _real_harmonics(l_max, x, somx2, torch.cos(phi), torch.sin(phi))
+
+
+def SH_all_cartesian(l_max: int, ux: torch.Tensor, uy: torch.Tensor, uz: torch.Tensor) -> torch.Tensor:
+    """ Same as SH_all but evaluated directly from the components of unit vectors
+    (real solid harmonics divided by r^l), which avoids acos/atan2 and is
+    regular at the poles.
+
+    Parameters
+    ----------
+    l_max: int
+        maximum angular momentum quantum number
+    ux, uy, uz: Tensor
+        components of unit vectors
+
+    Returns
+    -------
+    Tensor ((l_max + 1)**2, *ux.shape)
+        Stacked Y_lm ordered by l, then m = -l, ..., l
+    """
+    # sin(theta)^m is absorbed into (ux + i uy)^m
+    return _real_harmonics(l_max, uz, torch.ones_like(uz), ux, uy)
+
+
+def _real_harmonics(l_max: int, x: torch.Tensor, somx2: torch.Tensor, cos_phi: torch.Tensor,
+                    sin_phi: torch.Tensor) -> torch.Tensor:
+    """ Real spherical harmonics from cos(theta) (x), sin(theta) (somx2) and
+    cos(phi), sin(phi)
+    """
+    # Associated Legendre polynomials P_lm stored at l * (l + 1) // 2 + m
+    P: List[torch.Tensor] = []
+    for l in range(l_max + 1):
+        for m in range(l + 1):
+            if l == 0:
+                P.append(torch.ones_like(x))
+            elif l == m:
+                P.append(-(2.0 * m - 1.0) * somx2 * P[(l - 1) * l // 2 + m - 1])
+            elif l == m + 1:
+                P.append(x * (2.0 * m + 1.0) * P[(l - 1) * l // 2 + m])
+            else:
+                pl1 = P[(l - 1) * l // 2 + m]
+                pl2 = P[(l - 2) * (l - 1) // 2 + m]
+                P.append(((2.0 * l - 1.0) * x * pl1 - (l + m - 1.0) * pl2) / (l - m))
+
+    # cos(m * phi) and sin(m * phi) by angle addition
+    C: List[torch.Tensor] = [torch.ones_like(cos_phi)]
+    S: List[torch.Tensor] = [torch.zeros_like(cos_phi)]
+    for m in range(1, l_max + 1):
+        C.append(C[m - 1] * cos_phi - S[m - 1] * sin_phi)
+        S.append(S[m - 1] * cos_phi + C[m - 1] * sin_phi)
+
+    Y: List[torch.Tensor] = []
+    for l in range(l_max + 1):
+        for m in range(-l, l + 1):
+            norm = _SH_renormalization(l, abs(m))
+            if m == 0:
+                Y.append(norm * P[l * (l + 1) // 2])
+            elif m > 0:
+                Y.append(math.sqrt(2.0) * norm * C[m] * P[l * (l + 1) // 2 + m])
+            else:
+                Y.append(math.sqrt(2.0) * norm * S[-m] * P[l * (l + 1) // 2 - m])
+    return torch.stack(Y)
+
+
+def _SH_renormalization(l: int, m: int) -> float:
+    # Same as SH_renormalization but without math.factorial (TorchScript)
+    ratio = 1.0
+    for k in range(l - m + 1, l + m + 1):
+        ratio = ratio / k
+    return math.sqrt((2.0 * l + 1.0) * ratio / (4 * math.pi))
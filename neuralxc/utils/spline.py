@@ -0,0 +1,70 @@
+"""
+spline.py
+Tabulation of (radial) functions on a uniform 1d grid with cubic spline
+interpolation. Evaluation is vectorized in torch and differentiable w.r.t. r.
+"""
+
+import numpy as np
+import torch
+from scipy.interpolate import CubicSpline
+
+
+class SplineTable():
+    def __init__(self, func, r_max, tol=1e-8, n_init=64, n_max=2**16):
+        """ Tabulate func on [0, r_max]. The number of grid points is doubled
+        until the interpolation error (measured at the interval midpoints, where
+        it is largest) is below tol or n_max intervals are reached.
+
+        Parameters
+        ----------
+        func: callable
+            maps Tensor r (npoints) to Tensor (nfuncs, npoints)
+        r_max: float
+            upper limit of table, for r > r_max zero is returned
+        tol: float
+            maximum absolute interpolation error
+        n_init: int
+            initial number of intervals
+        n_max: int
+            maximum number of intervals
+        """
+        n = n_init
+        while True:
+            r = np.linspace(0, r_max, n + 1)
+            spline = CubicSpline(r, self._eval(func, r), axis=1)
+            r_mid = (r[1:] + r[:-1]) / 2
+            self.error = np.max(np.abs(spline(r_mid) - self._eval(func, r_mid)))
+            if self.error <= tol or n >= n_max:
+                break
+            n *= 2
+
+        self.r_max = r_max
+        self.h = r_max / n
+        self.n = n
+        # spline.c has shape (4, n, nfuncs), store as (n, 4, nfuncs) so that
+        # coefficients of an interval are contiguous
+        self.coeff = torch.from_numpy(np.ascontiguousarray(spline.c.transpose(1, 0, 2)))
+
+    @staticmethod
+    def _eval(func, r):
+        return func(torch.from_numpy(r)).detach().numpy()
+
+    def __call__(self, r):
+        """ Interpolate tabulated functions at r
+
+        Parameters
+        ----------
+        r: Tensor (any shape)
+
+        Returns
+        -------
+        Tensor (nfuncs, *r.shape)
+        """
+        shape = r.size()
+        r = r.reshape(-1, 1)
+        idx = torch.clamp(torch.floor(r.detach().view(-1) / self.h).long(), 0, self.n - 1)
+        t = r - idx.view(-1, 1).double() * self.h
+        c = self.coeff[idx]
+        y = ((c[:, 0] * t + c[:, 1]) * t + c[:, 2]) * t + c[:, 3]
+        y = torch.where(r <= self.r_max, y, torch.zeros_like(y))
+        return y.T.reshape(-1, *shape)